@@ -15,68 +15,28 @@
 # Add the script to crontab
 # crontab -e
 # 0 2 * * * /path/to/backup.sh >> /var/log/dbkk-library-backup.log 2>&1
+#
+# The app server takes an incremental snapshot (`flask backup create`) into its
+# backup store; the store is then mirrored here. Chunks in the store never
+# change, so rsync only transfers the chunks and the manifest of the new snapshot.
 
 # Configuration
 LOCAL_USER="local_user"              # Local server username
 LOCAL_HOST="local_host"              # Local server hostname or IP
-LOCAL_UPLOADS_DIR="/path/to/uploads" # Local uploads directory
-LOCAL_DB_PATH="/path/to/database.db" # Local SQLite database path
+LOCAL_BACKUP_DIR="/path/to/backups"  # Backup store on the local server ([backup] FOLDER)
+BACKUP_CMD="docker exec dbkk-library flask --app controller backup"  # How to run `flask backup` on the local server
 BACKUP_DIR="/path/to/remote/backups" # Remote backup directory
-TIMESTAMP=$(date +"%Y%m%d%H%M%S")   # Timestamp for backup files
+KEEP=30                              # Snapshots kept on the local server
 
+set -e
 echo "$(date): Backup started"
-# Create remote backup directory if it doesn't exist
 mkdir -p "$BACKUP_DIR"
 
-# Compress the uploads directory on the local server
-UPLOADS_ARCHIVE="/tmp/uploads_$TIMESTAMP.tar.gz"
-ssh "$LOCAL_USER@$LOCAL_HOST" "tar -czf $UPLOADS_ARCHIVE -C $LOCAL_UPLOADS_DIR ."
-
-# Check if the uploads archive has changed compared to the latest backup
-LATEST_UPLOADS_BACKUP=$(ls -t "$BACKUP_DIR"/uploads_*.tar.gz 2>/dev/null | head -n 1)
-if [ -n "$LATEST_UPLOADS_BACKUP" ]; then
-  # Compare the new archive with the latest backup
-  ssh "$LOCAL_USER@$LOCAL_HOST" "cmp --silent $UPLOADS_ARCHIVE <(cat $LATEST_UPLOADS_BACKUP)"
-  if [ $? -eq 0 ]; then
-    echo "No changes in uploads directory. Skipping transfer."
-    ssh "$LOCAL_USER@$LOCAL_HOST" "rm $UPLOADS_ARCHIVE"
-  else
-    echo "Changes detected in uploads directory. Transferring new backup."
-    scp "$LOCAL_USER@$LOCAL_HOST:$UPLOADS_ARCHIVE" "$BACKUP_DIR/uploads_$TIMESTAMP.tar.gz"
-    ssh "$LOCAL_USER@$LOCAL_HOST" "rm $UPLOADS_ARCHIVE"
-  fi
-else
-  echo "No existing uploads backup found. Transferring new backup."
-  scp "$LOCAL_USER@$LOCAL_HOST:$UPLOADS_ARCHIVE" "$BACKUP_DIR/uploads_$TIMESTAMP.tar.gz"
-  ssh "$LOCAL_USER@$LOCAL_HOST" "rm $UPLOADS_ARCHIVE"
-fi
-
-# Backup the SQLite database
-DB_BACKUP="/tmp/db_$TIMESTAMP.db"
-ssh "$LOCAL_USER@$LOCAL_HOST" "sqlite3 $LOCAL_DB_PATH '.backup $DB_BACKUP'"
-
-# Check if the database backup has changed compared to the latest backup
-LATEST_DB_BACKUP=$(ls -t "$BACKUP_DIR"/db_*.db.gz 2>/dev/null | head -n 1)
-if [ -n "$LATEST_DB_BACKUP" ]; then
-  # Compare the new backup with the latest backup
-  ssh "$LOCAL_USER@$LOCAL_HOST" "cmp --silent $DB_BACKUP <(zcat $LATEST_DB_BACKUP)"
-  if [ $? -eq 0 ]; then
-    echo "No changes in database. Skipping transfer."
-    ssh "$LOCAL_USER@$LOCAL_HOST" "rm $DB_BACKUP"
-  else
-    echo "Changes detected in database. Transferring new backup."
-    scp "$LOCAL_USER@$LOCAL_HOST:$DB_BACKUP" "$BACKUP_DIR/db_$TIMESTAMP.db"
-    gzip "$BACKUP_DIR/db_$TIMESTAMP.db"
-    ssh "$LOCAL_USER@$LOCAL_HOST" "rm $DB_BACKUP"
-  fi
-else
-  echo "No existing database backup found. Transferring new backup."
-  scp "$LOCAL_USER@$LOCAL_HOST:$DB_BACKUP" "$BACKUP_DIR/db_$TIMESTAMP.db"
-  gzip "$BACKUP_DIR/db_$TIMESTAMP.db"
-  ssh "$LOCAL_USER@$LOCAL_HOST" "rm $DB_BACKUP"
-fi
+# Snapshot the database (online, the app keeps running) and the changed uploads
+ssh "$LOCAL_USER@$LOCAL_HOST" "$BACKUP_CMD create && $BACKUP_CMD prune --keep $KEEP"
 
-# Optional: Delete backups older than 7 days
-find "$BACKUP_DIR" -type f -mtime +7 -exec rm {} \;
+# Copy the new chunks and manifests. Snapshots pruned on the local server are
+# kept here; prune this copy with `flask backup --folder $BACKUP_DIR prune`
+rsync -a --exclude .lock "$LOCAL_USER@$LOCAL_HOST:$LOCAL_BACKUP_DIR/" "$BACKUP_DIR/"
 
 echo "Pull backup completed."
@@ -0,0 +1,517 @@
+"""Reproducible benchmarks for the library app.
+
+Seed a synthetic catalogue, then run scripted scenarios against the Flask
+test client (in this process) or a real gunicorn instance, and compare the
+throughput and latency percentiles with a stored baseline:
+
+    python benchmarks/bench.py seed --books 20000
+    python benchmarks/bench.py run --target testclient --compare benchmarks/baselines/testclient.json
+    python benchmarks/bench.py run --target gunicorn --workers 4 --concurrency 8 \\
+        --compare benchmarks/baselines/gunicorn.json
+
+The app runs on a copy of the seeded catalogue with its own library.cfg (see
+LIBRARY_CONFIG), so the real database is never touched. ISBN lookups go to a
+local stub of Open Library and Google Books.
+"""
+import json, os, platform, random, re, shutil, socket, sqlite3, subprocess, sys, threading, time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import accumulate
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import click
+import requests
+
+ROOT = Path(__file__).absolute().parents[1]
+WORKDIR = ROOT / "benchmarks" / "work"
+USERNAME = PASSWORD = "bench"
+
+# Words for titles, subjects and search terms. Picked with a Zipf distribution,
+# so like in a real catalogue a few words are in many titles
+TITLE_WORDS = """mountain climbing guide alpine rock ice snow winter summit ridge face north
+    south east west wall route routes peak peaks valley glacier history first ascent ascents
+    expedition expeditions journey adventure adventures life story stories high great last
+    new old the of and in on to a an from with through over under beyond across between
+    world himalaya alps andes everest k2 eiger matterhorn mont blanc denali patagonia
+    norway iceland greenland arctic climbers climber mountaineer mountaineering skiing ski
+    trekking hiking walks walking technique techniques training handbook manual art science
+    survival rescue medicine safety weather avalanche avalanches camp base camps women men
+    life death light dark shadow days years hundred thousand vertical free solo big walls""".split()
+FIRST_NAMES = """Anna Bernd Chris Doug Eva Frank Gaston Heinrich Ingrid Jon Kurt Lene Maurice
+    Nils Ola Paul Reinhold Sara Tom Ulla Walter Yvon Lynn Royal Hermann Junko Wanda Catherine""".split()
+LAST_NAMES = """Messner Bonington Harrer Scott Herzog Rebuffat Buhl Tabei Rutkiewicz Destivelle
+    Hill Robbins Chouinard Whillans Diemberger Kukuczka Kammerlander Lowe Houston Tilman
+    Shipton Mallory Irvine Hunt Hillary Norgay Moran Anker Child Twight House Venables
+    Cave Boardman Tasker Fowler Haston Patey Brown Lindgren Nielsen Jensen Hansen""".split()
+SUBJECT_WORDS = """mountaineering climbing skiing hiking history biography expeditions glaciology
+    geology weather medicine rescue photography travel guidebooks maps fiction poetry
+    children technique equipment training nature botany birds geography""".split()
+REGIONS = """Alps Himalaya Andes Norway Scotland Greenland Alaska Karakoram Patagonia Iceland
+    Pyrenees Dolomites Caucasus Tatra Rockies Yosemite""".split()
+
+
+def zipf_weights(n, s):
+    """Cumulative weights of ranks 1..n for rng.choices."""
+    return list(accumulate(1 / rank ** s for rank in range(1, n + 1)))
+
+def isbn13(rng):
+    digits = [9, 7, 8] + [rng.randrange(10) for _ in range(9)]
+    check = (10 - sum(d * (3 if i % 2 else 1) for i, d in enumerate(digits)) % 10) % 10
+    return "".join(map(str, digits + [check]))
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Catalogue:
+    """Synthetic books, locations and log entries from a seed: the same seed gives the same rows."""
+
+    def __init__(self, seed, books, locations, logs):
+        self.rng = random.Random(seed)
+        self.books, self.locations, self.logs = books, locations, logs
+        rng = self.rng
+        self.authors = list(dict.fromkeys(f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+                                          for _ in range(max(50, books // 3))))
+        self.subjects = list(dict.fromkeys(
+            rng.choice(SUBJECT_WORDS).capitalize() + (f" -- {rng.choice(REGIONS)}" if rng.random() < 0.6 else "")
+            for _ in range(300)))
+        rng.shuffle(self.subjects)
+        self.word_weights = zipf_weights(len(TITLE_WORDS), 1.0)
+        self.author_weights = zipf_weights(len(self.authors), 1.1)
+        self.subject_weights = zipf_weights(len(self.subjects), 1.2)
+        self.location_weights = zipf_weights(locations, 0.7)
+
+    def title(self):
+        rng = self.rng
+        words = rng.choices(TITLE_WORDS, cum_weights=self.word_weights, k=rng.randint(1, 6))
+        title = " ".join(words).capitalize()
+        if rng.random() < 0.2:
+            title += " - " + " ".join(rng.choices(TITLE_WORDS, cum_weights=self.word_weights, k=3))
+        return title
+
+    def location_rows(self):
+        return [{"id": i, "label_name": f"{chr(ord('A') + (i - 1) // 10 % 26)}{(i - 1) % 10 + 1}",
+                 "full_name": f"Shelf {i}, {self.rng.choice(REGIONS)}"} for i in range(1, self.locations + 1)]
+
+    def book_rows(self):
+        rng = self.rng
+        for book_id in range(1, self.books + 1):
+            n_authors = rng.choices((1, 2, 3), (85, 12, 3))[0]
+            authors = dict.fromkeys(rng.choices(self.authors, cum_weights=self.author_weights, k=n_authors))
+            subjects = dict.fromkeys(rng.choices(self.subjects, cum_weights=self.subject_weights, k=rng.randint(0, 4)))
+            yield {
+                "id": book_id,
+                "isbn": isbn13(rng) if rng.random() < 0.9 else "",
+                "title": self.title(),
+                "authors": ", ".join(authors),
+                "publish_date": str(min(2025, max(1850, int(rng.gauss(1990, 20))))),
+                "number_of_pages": str(int(rng.lognormvariate(5.4, 0.5))),
+                "subjects": ", ".join(subjects),
+                "openlibrary_medcover_url": "",
+                "openlibrary_preview_url": "",
+                "olid": "",
+                "dewey_decimal_class": "",
+                "lccn": "",
+                "location": rng.choices(range(1, self.locations + 1), cum_weights=self.location_weights)[0],
+            }
+
+    def log_rows(self):
+        rng = self.rng
+        start = datetime(2015, 1, 1)
+        step = (datetime(2025, 1, 1) - start) / max(1, self.logs)
+        for i in range(self.logs):
+            action = rng.choices(("ADD", "EDIT", "DELETE"), (70, 25, 5))[0]
+            book_id = rng.randint(1, self.books)
+            yield {
+                "timestamp": start + step * i + timedelta(seconds=rng.randrange(60)),
+                "action": action,
+                "book_id": book_id,
+                "book_title": self.title(),
+                "details": json.dumps({"id": book_id, "title": self.title(), "location": "A1, Shelf 1"}),
+            }
+
+
+def write_config(workdir, database, metadata_url="http://127.0.0.1:9"):
+    """library.cfg for a benchmark run; returns its path."""
+    path = workdir / "library.cfg"
+    path.write_text(f"""[secrets]
+USERNAME = {USERNAME}
+PASSWORD = {PASSWORD}
+APP_SECRET_KEY = bench
+
+[database]
+PATH = {database}
+
+[metadata]
+OPENLIBRARY_URL = {metadata_url}
+GOOGLE_BOOKS_URL = {metadata_url}
+CACHE_PATH = {workdir / "metadata_cache.sqlite"}
+
+[covers]
+FOLDER = {workdir / "covers"}
+""")
+    return path
+
+def load_app(config):
+    """Import the controller module configured by `config` (once per process)
+    and create the app. Returns (controller, app)."""
+    os.environ["LIBRARY_CONFIG"] = str(config)
+    sys.path.insert(0, str(ROOT / "src"))
+    import controller
+    return controller, controller.create_app()
+
+
+class MetadataStub(BaseHTTPRequestHandler):
+    """Answers Open Library and Google Books ISBN lookups after `latency` seconds."""
+
+    latency = 0.05
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/api/books":
+            key = query["bibkeys"][0]
+            body = {key: {"title": "Stub Book", "subtitle": "For Benchmarks",
+                          "authors": [{"name": "Stub Author"}], "publish_date": "2001",
+                          "subjects": [{"name": "Mountaineering"}], "number_of_pages": 240}}
+        elif url.path == "/books/v1/volumes":
+            body = {"items": [{"volumeInfo": {"title": "Stub Book", "authors": ["Stub Author"],
+                                              "publishedDate": "2001", "categories": ["Mountaineering"]}}]}
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metadata_stub(latency):
+    MetadataStub.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MetadataStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class TestClient:
+    """Requests through the Flask test client, in this process."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        body = response.get_data(as_text=True)  # also runs streamed responses to the end
+        response.close()
+        return response.status_code, body
+
+class HttpClient:
+    """Requests to a running server over HTTP, with keep-alive."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def request(self, method, path, data=None):
+        response = self.session.request(method, self.base_url + path, data=data, allow_redirects=False, timeout=60)
+        return response.status_code, response.text
+
+
+# Scenarios: each runs one user action through `call(method, path, data)`,
+# which times the request and returns the response body. `ctx` describes the
+# seeded catalogue.
+SORT_KEYS = ["title", "authors", "publish_date", "subjects", "location"]
+
+def scenario_index(call, rng, ctx):
+    """Browse the index: an offset page in some sort order, or the first cursor pages."""
+    sort_by, sort_order = rng.choice(SORT_KEYS), rng.choice(["asc", "desc"])
+    if rng.random() < 0.5:
+        page = min(int(rng.paretovariate(1.2)), ctx["books"] // 50 or 1)
+        call("GET", f"/index/{page}?sort_by={sort_by}&sort_order={sort_order}")
+    else:
+        body = call("GET", f"/index/?cursor=&sort_by={sort_by}&sort_order={sort_order}")
+        for _ in range(2):
+            cursor = re.search(r'[?&;]cursor=([\w%=-]+)[^"]*"\s+class="nav-link">\s*Next', body or "")
+            if not cursor:
+                break
+            body = call("GET", f"/index/?cursor={cursor.group(1)}&sort_by={sort_by}&sort_order={sort_order}")
+
+def scenario_search(call, rng, ctx):
+    """A keystroke burst of the instant search: one API request per prefix of a word."""
+    word = rng.choices(TITLE_WORDS, cum_weights=ctx["word_weights"])[0]
+    if len(word) < 4:
+        word += " " + rng.choice(TITLE_WORDS)
+    for end in range(2, len(word) + 1):
+        call("GET", f"/api/v1/search?q={word[:end]}")
+
+def scenario_suggest(call, rng, ctx):
+    """A keystroke burst of the search box suggestions: one request per prefix of a word."""
+    word = rng.choices(TITLE_WORDS, cum_weights=ctx["word_weights"])[0]
+    for end in range(1, len(word) + 1):
+        call("GET", f"/api/suggest?q={word[:end]}")
+
+def scenario_detail(call, rng, ctx):
+    """Open a book page."""
+    call("GET", f"/detail/{rng.randint(1, ctx['books'])}")
+
+def scenario_add_book(call, rng, ctx):
+    """Look up an ISBN (served by the metadata stub) and add the book."""
+    isbn = isbn13(rng)
+    call("POST", "/add_book", {"search_isbn": "1", "isbn": isbn})
+    call("POST", "/add_book", {"submit_book": "1", "isbn": isbn, "title": "Stub Book - For Benchmarks",
+                               "authors": "Stub Author", "year": "2001", "subjects": "Mountaineering",
+                               "location": str(rng.randint(1, ctx["locations"]))})
+
+def scenario_logs(call, rng, ctx):
+    """The log: the first page and the next ones by cursor."""
+    body = call("GET", "/logs")
+    for _ in range(rng.randint(0, 3)):
+        cursor = re.search(r'cursor=([\w%=-]+)[^"]*"[^>]*>\s*(?:Next|Older)', body or "")
+        if not cursor:
+            break
+        body = call("GET", f"/logs?cursor={cursor.group(1)}")
+
+SCENARIOS = {
+    "index": (scenario_index, False),  # (function, needs login)
+    "search": (scenario_search, False),
+    "suggest": (scenario_suggest, False),
+    "detail": (scenario_detail, False),
+    "add_book": (scenario_add_book, True),
+    "logs": (scenario_logs, False),
+}
+
+
+def run_scenario(name, make_client, seconds, concurrency, seed, ctx):
+    """Run a scenario from `concurrency` threads for `seconds`. Returns its result row."""
+    function, login = SCENARIOS[name]
+    latencies, errors = [], []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(i):
+        client = make_client()
+        if login:
+            client.request("POST", "/login", {"username": USERNAME, "password": PASSWORD})
+        rng = random.Random(f"{seed}-{name}-{i}")
+
+        def call(method, path, data=None):
+            started = time.perf_counter()
+            try:
+                status, body = client.request(method, path, data)
+            except requests.RequestException as e:
+                with lock:
+                    errors.append(type(e).__name__)
+                return None
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if status >= 400:
+                    errors.append(f"HTTP {status}")
+            return body
+
+        while time.perf_counter() < deadline:
+            function(call, rng, ctx)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "errors": len(errors),
+    }
+
+def copy_database(source, target):
+    """Copy a SQLite database with the backup API (consistent also in WAL mode)."""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(f"{target}{suffix}"):
+            os.remove(f"{target}{suffix}")
+    with sqlite3.connect(source) as src, sqlite3.connect(target) as dst:
+        src.backup(dst)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_gunicorn(config, workers, threads):
+    """Start gunicorn with the benchmark config; returns (process, base URL) once it answers."""
+    port = free_port()
+    env = dict(os.environ, LIBRARY_CONFIG=str(config), PYTHONPATH=str(ROOT / "src"))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{port}", "-w", str(workers),
+         "--threads", str(threads), "--log-level", "warning", "controller:create_app()"], env=env, cwd=ROOT)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(url + "/index/", timeout=5)
+            return process, url
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                raise click.ClickException("gunicorn exited during startup")
+            time.sleep(0.2)
+    process.terminate()
+    raise click.ClickException("gunicorn did not start")
+
+
+@click.group()
+def cli():
+    """Seed a synthetic catalogue and benchmark the app against it."""
+
+@cli.command()
+@click.option("--books", default=20000, show_default=True)
+@click.option("--locations", default=40, show_default=True)
+@click.option("--logs", default=50000, show_default=True, help="Transaction log entries.")
+@click.option("--seed", default=1, show_default=True)
+@click.option("--output", type=click.Path(dir_okay=False, path_type=Path),
+              default=WORKDIR / "catalogue.sqlite", show_default=True)
+def seed(books, locations, logs, seed, output):
+    """Create a catalogue of synthetic books, locations and log entries."""
+    output = output.absolute()
+    output.parent.mkdir(parents=True, exist_ok=True)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(f"{output}{suffix}"):
+            os.remove(f"{output}{suffix}")
+    controller, app = load_app(write_config(output.parent, output))
+    catalogue = Catalogue(seed, books, locations, logs)
+    started = time.perf_counter()
+    with app.app_context():
+        db = controller.db
+        db.create_all()
+        db.session.execute(controller.Location.__table__.insert(), catalogue.location_rows())
+        for table, rows in ((controller.Book.__table__, catalogue.book_rows()),
+                            (controller.TransactionLog.__table__, catalogue.log_rows())):
+            while batch := [row for _, row in zip(range(5000), rows)]:
+                db.session.execute(table.insert(), batch)
+        db.session.commit()
+        controller.rebuild_facets.callback()
+        controller.backfill_isbn13.callback()
+        controller.init_search_index(rebuild=True)
+        controller.init_trigram_index(rebuild=True)
+        controller.init_sort_indexes()
+        db.session.execute(db.text("ANALYZE"))
+        db.session.commit()
+    meta = {"books": books, "locations": locations, "logs": logs, "seed": seed}
+    Path(f"{output}.json").write_text(json.dumps(meta))
+    click.echo(f"Seeded {output} ({books} books, {locations} locations, {logs} log entries) "
+               f"in {time.perf_counter() - started:.1f}s")
+
+@cli.command()
+@click.option("--target", default="testclient", show_default=True,
+              help="testclient, gunicorn, or the URL of a running instance (only anonymous scenarios).")
+@click.option("--catalogue", type=click.Path(dir_okay=False, path_type=Path),
+              default=WORKDIR / "catalogue.sqlite", show_default=True, help="Seeded catalogue (see seed).")
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(list(SCENARIOS)),
+              help="Scenarios to run (default: all).")
+@click.option("--seconds", default=10.0, show_default=True, help="Per scenario.")
+@click.option("--concurrency", default=1, show_default=True, help="Simulated users per scenario.")
+@click.option("--workers", default=2, show_default=True, help="gunicorn worker processes.")
+@click.option("--threads", default=1, show_default=True, help="Threads per gunicorn worker.")
+@click.option("--stub-latency", default=50.0, show_default=True, help="Milliseconds per ISBN lookup.")
+@click.option("--seed", default=1, show_default=True, help="Seed of the simulated users.")
+@click.option("--save", type=click.Path(dir_okay=False, path_type=Path), help="Write the results as a baseline.")
+@click.option("--compare", type=click.Path(exists=True, dir_okay=False, path_type=Path),
+              help="Baseline to compare with; exits 1 on a regression.")
+@click.option("--tolerance", default=0.2, show_default=True,
+              help="Allowed relative drop in req/s or rise in p50 before a regression is reported.")
+def run(target, catalogue, scenarios, seconds, concurrency, workers, threads, stub_latency, seed, save,
+        compare, tolerance):
+    """Run the scenarios and report requests/s and latency percentiles."""
+    catalogue = catalogue.absolute()
+    if not catalogue.exists():
+        raise click.ClickException(f"{catalogue} does not exist; create it with `bench.py seed`.")
+    meta = json.loads(Path(f"{catalogue}.json").read_text())
+    settings = dict(meta, concurrency=concurrency, seconds=seconds, stub_latency_ms=stub_latency,
+                    **({"workers": workers, "threads": threads} if target == "gunicorn" else {}))
+    baseline = json.loads(compare.read_text()) if compare else {"meta": {}, "results": {}}
+    # The page cache warms up during a run, so only runs of the same length,
+    # load and catalogue are comparable
+    different = {key: (value, baseline["meta"][key]) for key, value in settings.items()
+                 if key in baseline["meta"] and baseline["meta"][key] != value}
+    if different:
+        raise click.ClickException("The baseline was run with other settings: " + ", ".join(
+            f"{key} {base} (now {value})" for key, (value, base) in different.items()))
+    ctx = dict(meta, word_weights=zipf_weights(len(TITLE_WORDS), 1.0))
+    scenarios = list(scenarios or SCENARIOS)
+
+    # A fresh copy per run: add_book writes to it
+    rundir = catalogue.parent / "run"
+    shutil.rmtree(rundir, ignore_errors=True)
+    rundir.mkdir(parents=True)
+    database = rundir / "books.sqlite"
+    copy_database(catalogue, database)
+    stub, stub_url = start_metadata_stub(stub_latency / 1000)
+    config = write_config(rundir, database, stub_url)
+
+    process = None
+    if target == "testclient":
+        _, app = load_app(config)
+        make_client = lambda: TestClient(app)
+    else:
+        if target == "gunicorn":
+            process, url = start_gunicorn(config, workers, threads)
+        else:
+            url = target
+            scenarios = [name for name in scenarios if not SCENARIOS[name][1]]
+        make_client = lambda: HttpClient(url)
+
+    results = {}
+    try:
+        for name in scenarios:
+            results[name] = run_scenario(name, make_client, seconds, concurrency, seed, ctx)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        stub.shutdown()
+
+    baseline = baseline["results"]
+    click.echo(f"{target}: {meta['books']} books, {concurrency} users, {seconds:g}s per scenario"
+               + (f", {workers} workers x {threads} threads" if target == "gunicorn" else ""))
+    click.echo(f"{'scenario':10} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}"
+               + ("  vs baseline" if baseline else ""))
+    regressions = []
+    for name, result in results.items():
+        line = (f"{name:10} {result['requests']:9d} {result['rps']:8.1f} {result['p50_ms']:8.2f} "
+                f"{result['p95_ms']:8.2f} {result['p99_ms']:8.2f} {result['errors']:7d}")
+        base = baseline.get(name)
+        if base:
+            change = {key: result[key] / base[key] - 1 if base[key] else 0 for key in ("rps", "p50_ms", "p95_ms")}
+            # The tail of millisecond requests is too noisy to judge on; it is shown only
+            regressed = change["rps"] < -tolerance or change["p50_ms"] > tolerance
+            line += (f"  req/s {change['rps']:+6.1%}  p50 {change['p50_ms']:+6.1%}  p95 {change['p95_ms']:+6.1%}"
+                     + ("  REGRESSION" if regressed else ""))
+            if regressed:
+                regressions.append(name)
+        click.echo(line)
+
+    if save:
+        save.parent.mkdir(parents=True, exist_ok=True)
+        save.write_text(json.dumps({
+            "meta": dict(settings, target=target if target in ("testclient", "gunicorn") else "url",
+                         python=platform.python_version(), machine=platform.machine(), cpus=os.cpu_count()),
+            "results": results,
+        }, indent=2) + "\n")
+        click.echo(f"Saved baseline to {save}")
+    if regressions:
+        raise click.ClickException(f"Regression in: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    cli()
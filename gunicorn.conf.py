@@ -0,0 +1,57 @@
+"""gunicorn settings for the library, used by the Dockerfile.
+
+Run `gunicorn -c gunicorn.conf.py`. Options on the command line or in
+GUNICORN_CMD_ARGS override these; WEB_CONCURRENCY sets the number of workers.
+"""
+import multiprocessing
+import os
+import sys
+
+wsgi_app = "controller:create_app()"
+bind = "0.0.0.0:5000"
+
+# Build the app once in the master and fork the workers from it. The imported
+# modules are shared copy-on-write instead of loaded again by every worker, and
+# a recycled worker starts without importing anything. Code changes need a
+# restart, not a HUP.
+preload_app = True
+
+# One request per worker process. Most requests are short and CPU bound (SQLite
+# reads and template rendering), which threads would not run in parallel. The
+# threaded worker (gthread) also drops the connection it holds when it is
+# recycled (gunicorn 23), one failed request per restart.
+worker_class = "sync"
+threads = 1
+workers = int(os.environ.get("WEB_CONCURRENCY", 2 * multiprocessing.cpu_count() + 1))
+
+# Replace a worker after this many requests, to bound slow memory growth (e.g.
+# from PDF text extraction). The jitter keeps workers from restarting together.
+max_requests = 1000
+max_requests_jitter = 100
+
+# Worker heartbeats in memory; /tmp may be a slow overlay filesystem in Docker
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
+
+def when_ready(server):
+    """Load the per-worker caches (e.g. the search suggestions) before the workers are forked."""
+    app = server.app.wsgi()
+    with app.app_context():
+        try:
+            sys.modules[app.import_name].warm_caches()
+        except Exception as e:  # e.g. a database that is not migrated yet
+            server.log.warning(f"Caches not preloaded: {e}")
+
+
+def post_fork(server, worker):
+    """Forget the database connections a worker inherited from the master.
+
+    Two processes must not use the same SQLite connection. dispose(close=False)
+    leaves the connections open for their owner and only empties this worker's
+    pool, so it opens its own.
+    """
+    app = worker.app.wsgi()
+    with app.app_context():
+        for engine in app.extensions["sqlalchemy"].engines.values():
+            engine.dispose(close=False)
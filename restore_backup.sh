@@ -1,31 +1,23 @@
 #!/bin/bash
 
+# Restore a snapshot taken by backup.sh
+# Usage: restore_backup.sh [SNAPSHOT]        (default: latest)
+#        restore_backup.sh --at 2025-01-31T12:00
+# List the snapshots with `flask backup --folder $BACKUP_DIR list`.
+# Stop the app first, and run this where `flask` finds the app (FLASK_APP).
+
 # Configuration
 BACKUP_DIR="/path/to/remote/backups" # Remote backup directory
 RESTORE_UPLOADS_DIR="/path/to/restore/uploads" # Directory to restore uploads
 RESTORE_DB_PATH="/path/to/restore/database.db" # Path to restore the SQLite database
 
-# Find the latest uploads backup
-LATEST_UPLOADS_BACKUP=$(ls -t "$BACKUP_DIR"/uploads_*.tar.gz 2>/dev/null | head -n 1)
-if [ -z "$LATEST_UPLOADS_BACKUP" ]; then
-  echo "No uploads backup found in $BACKUP_DIR."
-  exit 1
-fi
-
-# Find the latest database backup
-LATEST_DB_BACKUP=$(ls -t "$BACKUP_DIR"/db_*.db.gz 2>/dev/null | head -n 1)
-if [ -z "$LATEST_DB_BACKUP" ]; then
-  echo "No database backup found in $BACKUP_DIR."
-  exit 1
-fi
-
-# Restore the uploads directory
-echo "Restoring uploads from $LATEST_UPLOADS_BACKUP..."
-mkdir -p "$RESTORE_UPLOADS_DIR"
-tar -xzf "$LATEST_UPLOADS_BACKUP" -C "$RESTORE_UPLOADS_DIR"
+set -e
+# Check the snapshots before overwriting anything
+flask backup --folder "$BACKUP_DIR" verify
 
-# Restore the SQLite database
-echo "Restoring database from $LATEST_DB_BACKUP..."
-zcat "$LATEST_DB_BACKUP" > "$RESTORE_DB_PATH"
+# Restore the database and the uploads. A leftover write-ahead log of the old
+# database is removed, so it is not applied to the restored one
+flask backup --folder "$BACKUP_DIR" restore "${@:-latest}" \
+  --database "$RESTORE_DB_PATH" --uploads "$RESTORE_UPLOADS_DIR" --prune --yes
 
 echo "Restore completed successfully."
@@ -18,7 +18,7 @@ setup(
     python_requires=">=3.10",
     entry_points={
         "console_scripts": [
-            "library-org = src.controller:app",  # Entry point for running the app
+            "library-org = src.controller:create_app",  # Entry point for running the app
         ],
     },
 )
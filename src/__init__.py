@@ -1 +1 @@
-from .controller import app
+from .controller import create_app
@@ -1,37 +1,79 @@
-from flask import Flask, render_template, redirect, url_for, flash, request, session, send_from_directory
-from flask_migrate import Migrate
+from flask import Flask, Blueprint, current_app, g, render_template, redirect, url_for, flash, request, session, send_file, Response, stream_with_context, abort
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.sql.expression import or_, asc, desc
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import validates
+from sqlalchemy.sql.expression import or_, asc, desc, tuple_
 from flask_wtf import FlaskForm
 from wtforms import SelectField
-import requests, json, configparser, os, re, sys, pprint
+from markupsafe import Markup, escape
+import json, configparser, os, re, base64, time, sqlite3, threading, csv, io, itertools, zlib, tempfile, hashlib, mimetypes, bisect, contextvars, hmac, fcntl, importlib, unicodedata, heapq, random, shutil, gzip, posixpath
+from array import array
+from datetime import datetime
+from collections import OrderedDict, namedtuple
+from functools import wraps, cache
+import click
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 # for file upload
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import ClosingIterator
+from urllib.parse import urlparse
+# requests, Pillow (resized covers), pypdf (document search) and brotli (static
+# assets) are imported on first use, so starting a worker does not pay for them
+@cache
+def optional_import(name):
+    """Import module `name` on first use; None when it is not installed."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
 
 # Configuration setup
 p = Path(__file__).absolute()
 CONFIG_FILE = "library.cfg"
 PROJECT_ROOT = p.parents[1]
-CONFIG_PATH = next((fpath / CONFIG_FILE for fpath in [PROJECT_ROOT, p.parent] if (fpath / CONFIG_FILE).is_file()), None)
-if not CONFIG_PATH:
-    sys.exit(f"{CONFIG_FILE} not found in src or parent dir. Create it from 'LIBRARY.cfg_EXAMPLE'.")
-
+# LIBRARY_CONFIG points to another config file, e.g. for the benchmarks
+CONFIG_PATH = os.environ.get("LIBRARY_CONFIG") or next(
+    (fpath / CONFIG_FILE for fpath in [PROJECT_ROOT, p.parent] if (fpath / CONFIG_FILE).is_file()), None)
+# Without a config file the defaults below apply; create_app refuses to start
 CONFIG = configparser.ConfigParser()
-CONFIG.read(CONFIG_PATH)
-APP_SECRET_KEY = CONFIG.get("secrets", "APP_SECRET_KEY")
-USER = {"username": CONFIG.get("secrets", "USERNAME"), "password": CONFIG.get("secrets", "PASSWORD")}
+if CONFIG_PATH:
+    CONFIG.read(CONFIG_PATH)
 
 # Database setup
 db_name = "books.sqlite"
-sqlite_db = f"sqlite:////{os.path.join(PROJECT_ROOT, 'database', db_name)}"
-
-app = Flask(__name__)
-app.config['DEBUG'] = True
-app.config['SECRET_KEY'] = APP_SECRET_KEY
-app.config["SQLALCHEMY_DATABASE_URI"] = sqlite_db
+db_path = CONFIG.get("database", "PATH", fallback=os.path.join(PROJECT_ROOT, 'database', db_name))
+sqlite_db = f"sqlite:///{os.path.abspath(db_path)}"
+
+# Routes, CLI commands and template helpers are registered on this blueprint;
+# create_app builds the app around it
+bp = Blueprint("library", __name__, cli_group=None)
+
+# SQLite tuning, set on every new connection (see set_sqlite_pragmas). WAL lets
+# readers run while a gunicorn worker writes; busy_timeout makes a writer wait
+# for the lock instead of failing with "database is locked". An empty value
+# leaves the SQLite default.
+SQLITE_PRAGMAS = {
+    "journal_mode": CONFIG.get("database", "JOURNAL_MODE", fallback="WAL"),
+    "synchronous": CONFIG.get("database", "SYNCHRONOUS", fallback="NORMAL"),
+    "mmap_size": CONFIG.get("database", "MMAP_SIZE", fallback=str(256 * 1024 * 1024)),
+    "cache_size": CONFIG.get("database", "CACHE_SIZE", fallback="-20000"),  # negative: KiB
+    "busy_timeout": CONFIG.get("database", "BUSY_TIMEOUT", fallback="5000"),  # ms
+    "foreign_keys": CONFIG.get("database", "FOREIGN_KEYS", fallback="OFF"),
+}
+# Connections per worker process. Requests hold one for their duration, the
+# background import threads one each.
+ENGINE_OPTIONS = {
+    "pool_size": CONFIG.getint("database", "POOL_SIZE", fallback=5),
+    "max_overflow": CONFIG.getint("database", "MAX_OVERFLOW", fallback=5),
+    "pool_timeout": CONFIG.getint("database", "POOL_TIMEOUT", fallback=30),
+}
 
 # Serve the app from a url/path, ie example.com/apps/library
 # Set the ENV: SCRIPT_NAME = apps/library when starting the app
@@ -46,29 +88,333 @@ class ScriptNameMiddleware:
         return self.app(environ, start_response)
 
 
-# Trust reverse proxy headers (Caddy)
-app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
 
-# Mount under a URL prefix when set (e.g. /apps/dbkk)
-app.wsgi_app = ScriptNameMiddleware(app.wsgi_app, os.environ.get("SCRIPT_NAME", ""))
+# Instrumentation
+# Request latency, database queries and outbound HTTP calls are measured in
+# every worker process and exported in the Prometheus text format on /metrics.
+# Requests slower than SLOW_REQUEST are logged with the queries they spent
+# their time on.
+METRICS_ENABLED = CONFIG.getboolean("metrics", "ENABLED", fallback=True)
+# Bearer token /metrics asks for; empty: open to everyone
+METRICS_TOKEN = CONFIG.get("metrics", "TOKEN", fallback="")
+SLOW_REQUEST = CONFIG.getfloat("metrics", "SLOW_REQUEST", fallback=1.0)  # seconds
+SLOW_REQUEST_TOP_QUERIES = 5
+
+def prometheus_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Counter:
+    """Prometheus counter with labels."""
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield f"{self.name}{prometheus_labels(self.labels, label_values)} {value}"
+
+class Histogram:
+    """Prometheus histogram with labels. An observation counts in one bucket;
+    the buckets are made cumulative when rendered."""
+
+    def __init__(self, name, help, labels=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.series = {}  # label values: [counts per bucket and +Inf, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            series = [(label_values, list(counts), total) for label_values, (counts, total) in self.series.items()]
+        names = (*self.labels, "le")
+        for label_values, counts, total in series:
+            for bound, count in zip((*self.buckets, "+Inf"), itertools.accumulate(counts)):
+                yield f"{self.name}_bucket{prometheus_labels(names, (*label_values, bound))} {count}"
+            yield f"{self.name}_sum{prometheus_labels(self.labels, label_values)} {total:.6f}"
+            yield f"{self.name}_count{prometheus_labels(self.labels, label_values)} {sum(counts)}"
+
+REQUEST_DURATION = Histogram("library_request_duration_seconds",
+                             "Time from receiving a request until its response is sent.",
+                             ("endpoint", "method", "status"))
+REQUEST_QUERIES = Histogram("library_request_db_queries", "Database queries run per request.",
+                            ("endpoint",), buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+DB_QUERY_DURATION = Histogram("library_db_query_duration_seconds",
+                              "Database query time, per endpoint (\"background\" outside requests).",
+                              ("endpoint",), buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1))
+HTTP_CLIENT_DURATION = Histogram("library_http_client_duration_seconds",
+                                 "Outbound HTTP calls (metadata lookups, cover downloads) until the response "
+                                 "headers, including retries.", ("host", "status"))
+SLOW_REQUESTS = Counter("library_slow_requests_total", f"Requests slower than {SLOW_REQUEST} s.", ("endpoint",))
+METRICS = [REQUEST_DURATION, REQUEST_QUERIES, DB_QUERY_DURATION, HTTP_CLIENT_DURATION, SLOW_REQUESTS]
+
+class RequestStats:
+    """Queries and outbound HTTP time of one request. Metadata lookups add to it from their threads."""
+
+    def __init__(self):
+        self.endpoint = "unmatched"  # set by the before_request hook once routed
+        self.queries = 0
+        self.query_time = 0.0
+        self.statements = {}  # statement: [count, time]
+        self.http_calls = 0
+        self.http_time = 0.0
+        self.lock = threading.Lock()
+
+    def add_query(self, statement, elapsed):
+        with self.lock:
+            self.queries += 1
+            self.query_time += elapsed
+            entry = self.statements.setdefault(statement, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def add_http_call(self, elapsed):
+        with self.lock:
+            self.http_calls += 1
+            self.http_time += elapsed
+
+    def top_queries(self, n=SLOW_REQUEST_TOP_QUERIES):
+        with self.lock:
+            return sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:n]
+
+# Stats of the request being handled, None outside requests. A ContextVar (not
+# a thread-local) so thread pools can carry it into their threads (see
+# copy_context in fetch_book_details)
+current_request_stats = contextvars.ContextVar("current_request_stats", default=None)
+
+class TimingMiddleware:
+    """Times each request until its response is sent (for a streamed page, the
+    last row), and logs slow requests."""
+
+    def __init__(self, app, logger):
+        self.app = app
+        self.logger = logger
 
-# Initialize extensions
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        stats = RequestStats()
+        current_request_stats.set(stats)
+        status = ["500"]
+
+        def timed_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line.split(" ", 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        def finish():
+            current_request_stats.set(None)
+            self.record(environ, status[0], stats, time.perf_counter() - started)
+
+        try:
+            response = self.app(environ, timed_start_response)
+        except BaseException:
+            finish()
+            raise
+        return ClosingIterator(response, finish)
+
+    def record(self, environ, status, stats, elapsed):
+        REQUEST_DURATION.observe(elapsed, stats.endpoint, environ.get("REQUEST_METHOD", ""), status)
+        REQUEST_QUERIES.observe(stats.queries, stats.endpoint)
+        if elapsed >= SLOW_REQUEST:
+            SLOW_REQUESTS.inc(stats.endpoint)
+            top = "".join(f"\n  {count}x {total * 1000:.1f} ms  {' '.join(statement.split())[:300]}"
+                          for statement, (count, total) in stats.top_queries())
+            self.logger.warning(
+                f"Slow request: {environ.get('REQUEST_METHOD')} {environ.get('PATH_INFO')} {status} "
+                f"{elapsed:.3f}s, {stats.queries} queries in {stats.query_time:.3f}s, "
+                f"{stats.http_calls} HTTP calls in {stats.http_time:.3f}s{top}")
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    stats = current_request_stats.get()
+    DB_QUERY_DURATION.observe(elapsed, stats.endpoint if stats else "background")
+    if stats:
+        stats.add_query(statement, elapsed)
+
+def timed_http_adapter(**kwargs):
+    """requests HTTPAdapter that records the time of each outbound call, by host
+    and status. The class is built on first use, like the import of requests."""
+    from requests.adapters import HTTPAdapter
+
+    class TimedHTTPAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            started = time.perf_counter()
+            status = "error"
+            try:
+                response = super().send(request, **kwargs)
+                status = str(response.status_code)
+                return response
+            finally:
+                elapsed = time.perf_counter() - started
+                HTTP_CLIENT_DURATION.observe(elapsed, urlparse(request.url).hostname or "", status)
+                stats = current_request_stats.get()
+                if stats:
+                    stats.add_http_call(elapsed)
+
+    return TimedHTTPAdapter(**kwargs)
+
+if METRICS_ENABLED:
+    # The request timing itself is wrapped around the app by create_app
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+    @bp.before_app_request
+    def label_request_stats():
+        stats = current_request_stats.get()
+        if stats and request.endpoint:
+            stats.endpoint = request.endpoint
+
+# Tables that are created outside the models (see init_search_index,
+# init_trigram_index and init_document_index). Alembic must not try to drop them when autogenerating
+# migrations.
+UNMANAGED_TABLE_PREFIXES = ("book_fts", "document_", "trigram_", "suggest_")
+
+def include_in_migrations(object, name, type_, reflected, compare_to):
+    """Hide unmanaged tables (FTS5 index and its shadow tables) from `flask db migrate`."""
+    if type_ == "table" and reflected and compare_to is None:
+        return not name.startswith(UNMANAGED_TABLE_PREFIXES)
+    return True
+
+def apply_sqlite_pragmas(connection, pragmas=SQLITE_PRAGMAS):
+    """Run `PRAGMA name = value` on a sqlite3 connection for each configured value."""
+    cursor = connection.cursor()
+    for name, value in pragmas.items():
+        value = str(value).strip()
+        if value:
+            if not re.fullmatch(r"-?\w+", value):
+                raise ValueError(f"Invalid value for PRAGMA {name}: {value!r}")
+            cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        apply_sqlite_pragmas(dbapi_connection)
+
+# Initialize extensions (bound to the app in create_app)
+db = SQLAlchemy()
 
 # Configuration for file uploads
 UPLOAD_FOLDER = os.path.join(PROJECT_ROOT, 'uploads')
 ALLOWED_EXTENSIONS = {'pdf'}  # Only allow PDF files
 MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB
+# Uploaded documents are stored once per content, as documents/<sha256[:2]>/<sha256>.pdf
+# below UPLOAD_FOLDER. Book.document_path holds that relative path, so books
+# with the same file share it; the file goes with the last book using it.
+DOCUMENT_FOLDER = os.path.join(UPLOAD_FOLDER, 'documents')
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Text extracted per document for the search index (characters); the rest of a
+# very long document is not searchable
+DOCUMENT_TEXT_LIMIT = CONFIG.getint("documents", "TEXT_LIMIT", fallback=2_000_000)
+# bm25 scale of a hit in a document relative to a hit in the book fields, so a
+# title match ranks above a word on page 200
+DOCUMENT_RANK_WEIGHT = CONFIG.getfloat("documents", "RANK_WEIGHT", fallback=0.5)
+
+# Typo-tolerant search: how similar (0..1, shared trigrams) a word must be to a
+# search word to match it; 0 turns it off. Overridden by ?similarity=
+SEARCH_SIMILARITY = CONFIG.getfloat("search", "SIMILARITY", fallback=0.3)
+# Duplicate detection: how similar (0..1) the title and authors of two books
+# must be to list them as probable duplicates
+DEDUP_THRESHOLD = CONFIG.getfloat("dedup", "THRESHOLD", fallback=0.6)
+
+# ISBN metadata lookups (Open Library, Google Books) and their cache
+OPENLIBRARY_URL = CONFIG.get("metadata", "OPENLIBRARY_URL", fallback="https://openlibrary.org")
+GOOGLE_BOOKS_URL = CONFIG.get("metadata", "GOOGLE_BOOKS_URL", fallback="https://www.googleapis.com")
+METADATA_CACHE_PATH = CONFIG.get("metadata", "CACHE_PATH",
+                                 fallback=os.path.join(PROJECT_ROOT, "database", "metadata_cache.sqlite"))
+# Seconds a found record is trusted, per source, and how long a "not found" is remembered
+METADATA_CACHE_TTL = {
+    "openlibrary": CONFIG.getint("metadata", "CACHE_TTL_OPENLIBRARY", fallback=30 * 24 * 3600),
+    "googlebooks": CONFIG.getint("metadata", "CACHE_TTL_GOOGLEBOOKS", fallback=30 * 24 * 3600),
+}
+METADATA_CACHE_NEGATIVE_TTL = CONFIG.getint("metadata", "CACHE_NEGATIVE_TTL", fallback=24 * 3600)
+METADATA_CACHE_MAX_ENTRIES = CONFIG.getint("metadata", "CACHE_MAX_ENTRIES", fallback=20000)
+# Seconds we wait for each source; a lookup never takes longer than the largest
+METADATA_TIMEOUT = {
+    "openlibrary": CONFIG.getfloat("metadata", "TIMEOUT_OPENLIBRARY", fallback=5.0),
+    "googlebooks": CONFIG.getfloat("metadata", "TIMEOUT_GOOGLEBOOKS", fallback=5.0),
+}
+# Retries for connection errors and 429/5xx answers, with exponential backoff
+METADATA_RETRIES = CONFIG.getint("metadata", "RETRIES", fallback=2)
+METADATA_BACKOFF = CONFIG.getfloat("metadata", "BACKOFF", fallback=0.3)
+
+# Bulk ISBN import: books per transaction and parallel metadata lookups
+IMPORT_FOLDER = os.path.join(PROJECT_ROOT, 'uploads', 'imports')
+IMPORT_BATCH_SIZE = CONFIG.getint("import", "BATCH_SIZE", fallback=500)
+IMPORT_WORKERS = CONFIG.getint("import", "WORKERS", fallback=8)
+
+# Cover images: downloaded once from the book's thumbnail URL, stored by content
+# hash and served resized from /cover/<book_id>
+COVER_FOLDER = CONFIG.get("covers", "FOLDER", fallback=os.path.join(PROJECT_ROOT, "covers"))
+# Bounding boxes (width, height) of the resized variants
+COVER_SIZES = {"thumb": (120, 180), "detail": (400, 600)}
+COVER_QUALITY = CONFIG.getint("covers", "QUALITY", fallback=80)
+# Seconds browsers may reuse a cover without asking again (then revalidated by
+# ETag). Cover links change when the thumbnail URL is edited (see cover_url)
+COVER_MAX_AGE = CONFIG.getint("covers", "MAX_AGE", fallback=30 * 24 * 3600)
+# Seconds before a cover that could not be downloaded is tried again
+COVER_RETRY_AFTER = CONFIG.getint("covers", "RETRY_AFTER", fallback=24 * 3600)
+COVER_MAX_BYTES = 5 * 1024 * 1024
+COVER_PLACEHOLDER = "dist/images/lincoln-inaug-bible.jpg"
+
+# Static assets: `flask build-assets` copies static/dist to static/build with
+# the content hash in every file name, so a built file never changes and
+# browsers may keep it for good (see asset_url and static_file)
+STATIC_FOLDER = os.path.join(p.parent, "static")
+ASSET_SOURCE = "dist"
+ASSET_BUILD = "build"
+ASSET_MAX_AGE = 365 * 24 * 3600
+# Files also stored compressed, and the encodings in order of preference
+ASSET_COMPRESS = (".css", ".js", ".svg", ".json", ".txt")
+ASSET_ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+# Rendered pages kept per worker for anonymous visitors (about 35 kB each for a
+# 50 book index page). 0 disables the cache
+RESPONSE_CACHE_MAX_ENTRIES = CONFIG.getint("cache", "MAX_ENTRIES", fallback=500)
+
+# Backups (flask backup): store folder, chunk size, and snapshots kept by `flask backup prune`
+BACKUP_FOLDER = CONFIG.get("backup", "FOLDER", fallback=os.path.join(PROJECT_ROOT, "backups"))
+BACKUP_CHUNK_SIZE = CONFIG.getint("backup", "CHUNK_SIZE", fallback=64 * 1024)
+BACKUP_KEEP = CONFIG.getint("backup", "KEEP", fallback=30)
+
+# Rows fetched per round-trip when streaming an export
+EXPORT_CHUNK_ROWS = 1000
 
 PAGINATE_BY_HOWMANY = 50
-
-# Ensure the upload folder exists
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
+# Largest page a request may ask for (?per_page=), and the page size above
+# which the index is streamed to the client while the rows are read
+MAX_PER_PAGE = CONFIG.getint("pagination", "MAX_PER_PAGE", fallback=1000)
+STREAM_ABOVE = CONFIG.getint("pagination", "STREAM_ABOVE", fallback=100)
+LOGS_PER_PAGE = 100
+# Pagination mode for the index: "offset" (page numbers) or "keyset" (cursors).
+# A `cursor` query argument always selects keyset mode.
+PAGINATION_MODE = CONFIG.get("pagination", "MODE", fallback="offset")
+# Seconds a total row count is reused for keyset pages
+COUNT_CACHE_TTL = CONFIG.getint("pagination", "COUNT_CACHE_TTL", fallback=60)
 
 class Location(db.Model):
     """Locations have a shortname and a pkey ID.
@@ -93,10 +439,13 @@ class TransactionLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime, default=db.func.current_timestamp())  # Auto-timestamp
     action = db.Column(db.String(50), nullable=False)  # "ADD", "EDIT", "DELETE"
-    book_id = db.Column(db.Integer, db.ForeignKey("book.id"), nullable=True)  # Reference the book
+    book_id = db.Column(db.Integer, db.ForeignKey("book.id"), nullable=True, index=True)  # Reference the book
     book_title = db.Column(db.String(200))  # Store the title at the time of change
     details = db.Column(db.Text)  # Store what changed
 
+    # view_logs pages by (timestamp, id)
+    __table_args__ = (db.Index("ix_transaction_log_timestamp_id", "timestamp", "id"),)
+
 
 class Book(db.Model):
     """Build a model based on the available fields in the openlibrary.org API.
@@ -126,17 +475,620 @@ class Book(db.Model):
     openlibrary_preview_url = db.Column(db.String(500), unique=False)
     dewey_decimal_class = db.Column(db.String(50), unique=False)
     location = db.Column(
-        db.Integer, db.ForeignKey("location.id"), default=None, nullable=True
+        db.Integer, db.ForeignKey("location.id"), default=None, nullable=True, index=True
     )
-    document_path = db.Column(db.String(500), unique=False)
+    document_path = db.Column(db.String(500), unique=False, index=True)
+    # Canonical form of `isbn` (see normalize_isbn), None if it is not a valid
+    # ISBN. Unique, so "0-306-40615-2" and "9780306406157" are one book
+    isbn13 = db.Column(db.String(13), unique=True, index=True)
 
     def __init__(self, **kwargs):
         super(Book, self).__init__(**kwargs)
 
+    @validates("isbn")
+    def set_isbn13(self, key, isbn):
+        self.isbn13 = normalize_isbn(isbn)
+        return isbn
+
     def __repr__(self):
         return "<Title: >".format(self.title)
 
 
+# Authors and subjects, split out of the comma separated Book.authors and
+# Book.subjects strings so "all books by X" is an index lookup. The
+# association tables are filled by sync_book_facets on every book write.
+book_author = db.Table(
+    "book_author",
+    db.Column("book_id", db.Integer, db.ForeignKey("book.id"), primary_key=True),
+    db.Column("author_id", db.Integer, db.ForeignKey("author.id"), primary_key=True),
+    db.Index("ix_book_author_author_id_book_id", "author_id", "book_id"),
+)
+
+book_subject = db.Table(
+    "book_subject",
+    db.Column("book_id", db.Integer, db.ForeignKey("book.id"), primary_key=True),
+    db.Column("subject_id", db.Integer, db.ForeignKey("subject.id"), primary_key=True),
+    db.Index("ix_book_subject_subject_id_book_id", "subject_id", "book_id"),
+)
+
+
+class Author(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), unique=True, nullable=False)
+
+
+class Subject(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(500), unique=True, nullable=False)
+
+
+class Version(db.Model):
+    """Change counters shared by all workers, e.g. "catalogue" counts the changes
+    of books and locations. Caches key their entries on it (see ResponseCache)."""
+
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+# Models whose changes bump a version counter
+VERSIONED_MODELS = {"catalogue": (Book, Location), "locations": (Location,)}
+
+def bump_version(name, connection=None):
+    """Increment counter `name` in the current transaction, so it commits (or rolls back) with the change."""
+    connection = connection or db.session.connection()
+    statement = sqlite_insert(Version.__table__).values(name=name, version=1)
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=["name"], set_={"version": Version.__table__.c.version + 1}))
+    g.pop("versions", None)
+
+def get_version(name):
+    """Current value of counter `name`, or None if the table does not exist yet (not migrated).
+
+    All counters are read in one query, once per request, so the caches keyed
+    on them (pages, locations) share it.
+    """
+    if "versions" not in g:
+        try:
+            g.versions = dict(db.session.query(Version.name, Version.version).all())
+        except OperationalError:
+            db.session.rollback()
+            g.versions = None
+    return None if g.versions is None else g.versions.get(name, 0)
+
+@event.listens_for(db.session, "after_flush")
+def bump_versions_on_flush(session, flush_context):
+    # Every write route (and the bulk import) flushes its book/location changes
+    # through the session, so the counters need no calls in the routes
+    changed = list(itertools.chain(session.new, session.dirty, session.deleted))
+    for name, models in VERSIONED_MODELS.items():
+        if any(isinstance(obj, models) for obj in changed):
+            bump_version(name, session.connection())
+    if any(isinstance(obj, Location) for obj in changed):
+        location_registry.invalidate()
+    # New, retitled and deleted books go into the trigram index in the same transaction
+    if any(isinstance(obj, Book) for obj in changed) and trigram_index_exists(session.connection()):
+        books = [book for book in itertools.chain(session.new, session.dirty) if isinstance(book, Book)
+                 and (book in session.new or any(db.inspect(book).attrs[name].history.has_changes()
+                                                 for name in ("title", "authors")))]
+        index_book_trigrams(session.connection(), [(book.id, book.title, book.authors) for book in books],
+                            [book.id for book in session.deleted if isinstance(book, Book)])
+    # The books whose suggestions changed, under the new catalogue version
+    if any(isinstance(obj, VERSIONED_MODELS["catalogue"]) for obj in changed) and suggest_log_exists(session.connection()):
+        log_suggest_changes(session.connection(), [
+            book.id for book in changed if isinstance(book, Book)
+            and (book in session.new or book in session.deleted
+                 or any(db.inspect(book).attrs[name].history.has_changes() for name in ("title", "authors", "subjects")))])
+
+
+# Location registry
+# Most pages need the locations (form choices, log labels, the book page), which
+# rarely change. Each worker keeps them in memory and reloads them when the
+# "locations" counter moved, i.e. after any worker added, edited or deleted one.
+# The counter is read once per request (see get_version).
+LocationEntry = namedtuple("LocationEntry", "id label_name full_name")
+
+class LocationRegistry:
+    """Per-worker copy of the locations, sorted by label_name."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.locations = []
+        self.by_id = {}
+
+    def _current(self):
+        version = get_version("locations")
+        with self.lock:
+            # None: no version table (not migrated), so nothing tells us about changes
+            if version is None or version != self.version:
+                rows = db.session.query(Location.id, Location.label_name, Location.full_name) \
+                    .order_by(Location.label_name).all()
+                self.locations = [LocationEntry(*row) for row in rows]
+                self.by_id = {location.id: location for location in self.locations}
+                self.version = version
+            return self.locations, self.by_id
+
+    def invalidate(self):
+        """Reload on the next use; this worker does not wait for the counter."""
+        with self.lock:
+            self.version = None
+
+    def all(self):
+        return self._current()[0]
+
+    def get(self, location_id):
+        return self._current()[1].get(location_id)
+
+    def choices(self):
+        """[(id, "label, full name")] for a location select field."""
+        return [(location.id, format_location_label(location)) for location in self.all()]
+
+location_registry = LocationRegistry()
+
+
+# Full-text search
+# An external-content FTS5 table mirrors the searchable Book columns. The
+# triggers keep it in sync on every INSERT/UPDATE/DELETE of a book, so add_book,
+# edit_book, delete_book and restore_book need no extra bookkeeping.
+# https://www.sqlite.org/fts5.html#external_content_tables
+FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5(
+        title, authors, subjects, isbn,
+        content='book', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_ai AFTER INSERT ON book BEGIN
+        INSERT INTO book_fts(rowid, title, authors, subjects, isbn)
+        VALUES (new.id, new.title, new.authors, new.subjects, new.isbn);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_ad AFTER DELETE ON book BEGIN
+        INSERT INTO book_fts(book_fts, rowid, title, authors, subjects, isbn)
+        VALUES ('delete', old.id, old.title, old.authors, old.subjects, old.isbn);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_fts_au AFTER UPDATE OF title, authors, subjects, isbn ON book BEGIN
+        INSERT INTO book_fts(book_fts, rowid, title, authors, subjects, isbn)
+        VALUES ('delete', old.id, old.title, old.authors, old.subjects, old.isbn);
+        INSERT INTO book_fts(rowid, title, authors, subjects, isbn)
+        VALUES (new.id, new.title, new.authors, new.subjects, new.isbn);
+    END""",
+]
+# bm25 column weights: title, authors, subjects, isbn
+FTS_RANK = "bm25(book_fts, 10.0, 5.0, 1.0, 2.0)"
+
+_fts_available = None
+
+def init_search_index(rebuild=False):
+    """Create the FTS5 index and its triggers if missing. Returns False if FTS5 is unavailable.
+
+    The index is (re)built from the book table when it is first created. Runs
+    in `flask rebuild-search-index` and before the workers start (warm_caches),
+    not in a request: building reads the whole catalogue. Other errors (e.g.
+    "database is locked") are raised, so they are not mistaken for a missing FTS5.
+    """
+    global _fts_available
+    if db.engine.dialect.name != "sqlite":
+        _fts_available = False
+        return False
+    try:
+        with db.engine.begin() as conn:
+            exists = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'book_fts'").first()
+            for statement in FTS_SCHEMA:
+                conn.exec_driver_sql(statement)
+            if rebuild or not exists:
+                conn.exec_driver_sql("INSERT INTO book_fts(book_fts) VALUES ('rebuild')")
+    except OperationalError as e:
+        if "no such module: fts5" not in str(e.orig):
+            raise
+        current_app.logger.warning(f"FTS5 search index unavailable, using ILIKE search: {e}")
+        _fts_available = False
+        return False
+    _fts_available = True
+    return True
+
+def fts_available():
+    """Whether the search index exists. Until init_search_index created it, searches use ILIKE."""
+    global _fts_available
+    if _fts_available is None and db.engine.dialect.name == "sqlite" and db.session.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'book_fts'")).first():
+        _fts_available = True
+    return bool(_fts_available)
+
+def fts_match_query(s):
+    """Turn free text into an FTS5 query: every word must match as a prefix."""
+    words = re.findall(r"\w+", s)
+    return " ".join(f'"{word}"*' for word in words)
+
+@bp.cli.command("rebuild-search-index")
+def rebuild_search_index():
+    """Create (if needed) and rebuild the full-text and trigram search indexes."""
+    if init_search_index(rebuild=True):
+        click.echo("Search index rebuilt.")
+    else:
+        click.echo("FTS5 is not available; search falls back to ILIKE.")
+    if init_trigram_index(rebuild=True):
+        click.echo("Trigram index rebuilt.")
+
+
+# Typo-tolerant search
+# The words of the titles and authors are indexed by their trigrams, padded like
+# pg_trgm ("  word " -> "  w", " wo", "wor", "ord", "rd "). A misspelt word
+# shares most trigrams with the right one. A search looks up the words sharing
+# trigrams with each search word, keeps those similar enough (Jaccard index of
+# the trigram sets), then the books containing them; both steps read index
+# ranges, not the catalogue. The after_flush hook keeps the index in sync.
+TRIGRAM_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS trigram_word (
+        id INTEGER PRIMARY KEY, word TEXT NOT NULL UNIQUE, trigrams INTEGER NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS trigram_index (
+        trigram TEXT NOT NULL, word_id INTEGER NOT NULL, PRIMARY KEY (trigram, word_id)) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS trigram_book (
+        word_id INTEGER NOT NULL, book_id INTEGER NOT NULL, PRIMARY KEY (word_id, book_id)) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS ix_trigram_book_book_id ON trigram_book (book_id)",
+]
+# Shorter words have too few trigrams to tell a typo from another word; they
+# are left to the full-text search
+TRIGRAM_MIN_WORD = 4
+# Books with a word similar to every search word. :words is a JSON list of the
+# search words' trigram lists. The length filter skips words that cannot reach
+# the threshold. The rank (1 - mean similarity) is >= 0, so these hits sort
+# after the bm25 (negative) ranks of the full-text hits.
+TRIGRAM_HITS = """SELECT book_id, 1 - sum(best) / json_array_length(:words) AS rank FROM (
+        SELECT trigram_book.book_id, similar.n, max(similar.similarity) AS best
+        FROM (
+            SELECT search.key AS n, trigram_word.id AS word_id,
+                count(*) * 1.0 / (json_array_length(search.value) + trigram_word.trigrams - count(*)) AS similarity
+            FROM json_each(:words) AS search, json_each(search.value) AS trigram
+            JOIN trigram_index ON trigram_index.trigram = trigram.value
+            JOIN trigram_word ON trigram_word.id = trigram_index.word_id
+            WHERE trigram_word.trigrams BETWEEN json_array_length(search.value) * :similarity
+                AND json_array_length(search.value) / :similarity
+            GROUP BY search.key, trigram_word.id
+            HAVING similarity >= :similarity
+        ) AS similar
+        JOIN trigram_book ON trigram_book.word_id = similar.word_id
+        GROUP BY trigram_book.book_id, similar.n)
+    GROUP BY book_id HAVING count(*) = json_array_length(:words)"""
+
+_trigram_available = None
+_trigram_index_exists = False
+
+def fold_text(text):
+    """Casefold `text` and remove its accents: "Les Misérables" -> "les miserables"."""
+    text = unicodedata.normalize("NFKD", (text or "").casefold())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+def similarity_words(text):
+    """The words of `text` that are indexed for typo-tolerant search."""
+    return list(dict.fromkeys(word for word in re.findall(r"\w+", fold_text(text)) if len(word) >= TRIGRAM_MIN_WORD))
+
+def word_trigrams(word):
+    padded = f"  {word} "
+    return sorted({padded[i:i + 3] for i in range(len(padded) - 2)})
+
+def trigram_word_ids(conn, words):
+    """Ids of `words` in the trigram vocabulary, adding the missing ones with their trigrams."""
+    select = db.text("SELECT word, id FROM trigram_word WHERE word IN :words") \
+        .bindparams(db.bindparam("words", expanding=True))
+    ids = {}
+    for chunk in range(0, len(words), 500):
+        ids.update(conn.execute(select, {"words": words[chunk:chunk + 500]}).all())
+    for word in words:
+        if word not in ids:
+            trigrams = word_trigrams(word)
+            ids[word] = conn.exec_driver_sql(
+                "INSERT INTO trigram_word (word, trigrams) VALUES (?, ?)", (word, len(trigrams))).lastrowid
+            conn.exec_driver_sql("INSERT INTO trigram_index (trigram, word_id) VALUES (?, ?)",
+                                 [(trigram, ids[word]) for trigram in trigrams])
+    return ids
+
+def index_book_trigrams(conn, books, deleted_ids=()):
+    """Replace the indexed words of `books` [(id, title, authors)] and drop those of `deleted_ids`.
+
+    Words no book uses any more stay in the vocabulary; they match no books.
+    """
+    book_ids = [book_id for book_id, _, _ in books] + list(deleted_ids)
+    delete = db.text("DELETE FROM trigram_book WHERE book_id IN :ids") \
+        .bindparams(db.bindparam("ids", expanding=True))
+    for chunk in range(0, len(book_ids), 500):
+        conn.execute(delete, {"ids": book_ids[chunk:chunk + 500]})
+    words = {book_id: similarity_words(f"{title or ''} {authors or ''}") for book_id, title, authors in books}
+    ids = trigram_word_ids(conn, list(dict.fromkeys(itertools.chain.from_iterable(words.values()))))
+    links = [(ids[word], book_id) for book_id, book_words in words.items() for word in book_words]
+    if links:
+        conn.exec_driver_sql("INSERT INTO trigram_book (word_id, book_id) VALUES (?, ?)", links)
+
+def build_trigram_index(conn):
+    """Index the words of all books, from scratch."""
+    for table in ("trigram_book", "trigram_index", "trigram_word"):
+        conn.exec_driver_sql(f"DELETE FROM {table}")
+    last_id = 0
+    while True:
+        books = conn.exec_driver_sql(
+            "SELECT id, title, authors FROM book WHERE id > ? ORDER BY id LIMIT 1000", (last_id,)).all()
+        if not books:
+            break
+        index_book_trigrams(conn, books)
+        last_id = books[-1][0]
+
+def init_trigram_index(rebuild=False):
+    """Create the trigram tables if missing. Returns False if not on SQLite.
+
+    The index is (re)built from the book table when it is first created. Like
+    init_search_index, this runs before the workers start (warm_caches) or in
+    `flask rebuild-search-index`, not in a request; errors are raised.
+    """
+    global _trigram_index_exists, _trigram_available
+    if db.engine.dialect.name != "sqlite":
+        _trigram_available = False
+        return False
+    with db.engine.begin() as conn:
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'trigram_book'").first()
+        for statement in TRIGRAM_SCHEMA:
+            conn.exec_driver_sql(statement)
+        if rebuild or not exists:
+            build_trigram_index(conn)
+    _trigram_index_exists = _trigram_available = True
+    return True
+
+def trigram_available():
+    """Whether the trigram index exists. Until init_trigram_index created it, searches skip the fuzzy hits."""
+    global _trigram_available
+    if _trigram_available is None and db.engine.dialect.name == "sqlite" and trigram_index_exists(db.session.connection()):
+        _trigram_available = True
+    return bool(_trigram_available)
+
+def trigram_index_exists(conn):
+    """Whether book writes must update the trigram index.
+
+    Checked on the writing connection: creating the index from the book writes
+    would wait on their own transaction. Until init_trigram_index creates it,
+    writes skip it; the first build then reads all books.
+    """
+    global _trigram_index_exists
+    if not _trigram_index_exists and conn.dialect.name == "sqlite":
+        _trigram_index_exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'trigram_book'").first() is not None
+    return _trigram_index_exists
+
+
+# Search suggestions
+# Completions for the search box: the titles, authors and subjects whose text,
+# or one of its words, starts with what was typed. Each worker keeps them in a
+# sorted array of (folded word suffix, kind, text), where the completions of a
+# prefix are one bisected range. Every change of the catalogue records the ids
+# of the books it changed in suggest_change, under the new "catalogue" version.
+# When the counter moved, a worker reads only those books, and removes and adds
+# their completions. gunicorn builds the array in the master before forking
+# (see warm_caches).
+SUGGEST_FIELDS = ["kind", "text", "books"]
+SUGGEST_LIMIT = 8
+MAX_SUGGEST_LIMIT = 20
+# Words of a text that start a suffix; completing the 10th word of a subtitle is rare
+SUGGEST_MAX_WORDS = 8
+# Prefixes with more keys than this (the first letter or two) keep their
+# completions until the next change, instead of ranking the range every time
+SUGGEST_MEMO_ABOVE = 1000
+# Catalogue versions kept in suggest_change; a worker further behind reads all books again
+SUGGEST_CHANGES_KEPT = 10000
+SUGGEST_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS suggest_change (version INTEGER NOT NULL, book_id INTEGER)",
+    "CREATE INDEX IF NOT EXISTS ix_suggest_change_version ON suggest_change (version)",
+]
+_suggest_log_exists = False
+
+def suggest_log_exists(conn):
+    """Whether book writes must record their changes, checked on the writing connection (see trigram_index_exists)."""
+    global _suggest_log_exists
+    if not _suggest_log_exists and conn.dialect.name == "sqlite":
+        _suggest_log_exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'suggest_change'").first() is not None
+    return _suggest_log_exists
+
+def init_suggest_log():
+    """Create suggest_change if missing. Returns False if not on SQLite."""
+    global _suggest_log_exists
+    if db.engine.dialect.name != "sqlite":
+        return False
+    with db.engine.begin() as conn:
+        for statement in SUGGEST_SCHEMA:
+            conn.exec_driver_sql(statement)
+    _suggest_log_exists = True
+    return True
+
+def log_suggest_changes(conn, book_ids):
+    """Record `book_ids` under the catalogue version this transaction bumped to.
+
+    A change without books (e.g. of a location, or an indexed document) still
+    gets a row, so a gap in the versions means lost changes. Every other bump
+    of "catalogue" must log one too.
+    """
+    version = conn.execute(db.select(Version.version).where(Version.name == "catalogue")).scalar()
+    conn.exec_driver_sql("INSERT INTO suggest_change (version, book_id) VALUES (?, ?)",
+                         [(version, book_id) for book_id in book_ids or [None]])
+    conn.exec_driver_sql("DELETE FROM suggest_change WHERE version <= ?", (version - SUGGEST_CHANGES_KEPT,))
+
+class SuggestIndex:
+    """Per-worker prefix index of the titles, authors and subjects."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.books = {}   # book id: its entries, to remove them when it changes
+        self.counts = {}  # (kind, text): number of books
+        self.keys = []    # sorted (key, kind, text)
+        self.memo = {}    # prefix: completions, for prefixes with many keys
+
+    @staticmethod
+    def entries(book):
+        title, authors, subjects = book
+        entries = [("author", name) for name in split_names(authors)]
+        entries += [("subject", name) for name in split_names(subjects)]
+        if title and title.strip():
+            entries.append(("title", title.strip()))
+        return entries
+
+    @staticmethod
+    def entry_keys(text):
+        folded = " ".join(fold_text(text).split())
+        starts = [match.start() for match in itertools.islice(re.finditer(r"\w+", folded), SUGGEST_MAX_WORDS)]
+        return {folded[start:] for start in starts}
+
+    def _add(self, entry):
+        count = self.counts.get(entry, 0)
+        self.counts[entry] = count + 1
+        if not count:
+            for key in self.entry_keys(entry[1]):
+                bisect.insort(self.keys, (key, *entry))
+
+    def _remove(self, entry):
+        count = self.counts.pop(entry) - 1
+        if count:
+            self.counts[entry] = count
+        else:
+            for key in self.entry_keys(entry[1]):
+                del self.keys[bisect.bisect_left(self.keys, (key, *entry))]
+
+    def _load(self):
+        counts = {}
+        entries = {}  # each entry once, so the books share the tuples of counts
+        self.books = {}
+        for book_id, *book in db.session.execute(db.select(Book.id, Book.title, Book.authors, Book.subjects)):
+            self.books[book_id] = tuple(entries.setdefault(entry, entry) for entry in self.entries(book))
+            for entry in self.books[book_id]:
+                counts[entry] = counts.get(entry, 0) + 1
+        self.counts = counts
+        self.keys = sorted((key, *entry) for entry in counts for key in self.entry_keys(entry[1]))
+
+    def _changed_books(self, version):
+        """Ids of the books changed after self.version up to `version`, or None when some changes are not logged."""
+        if (self.version is None or version is None or version < self.version
+                or not suggest_log_exists(db.session.connection())):
+            return None
+        rows = db.session.execute(db.text(
+            "SELECT version, book_id FROM suggest_change WHERE version > :old AND version <= :new"),
+            {"old": self.version, "new": version}).all()
+        if len({row.version for row in rows}) != version - self.version:
+            return None
+        return {row.book_id for row in rows if row.book_id is not None}
+
+    def _sync(self, version):
+        changed = self._changed_books(version)
+        if changed is None:
+            # Logged from now on, so the next change needs no full read
+            if version is not None:
+                init_suggest_log()
+            self._load()
+        else:
+            books = {}
+            changed = sorted(changed)
+            for start in range(0, len(changed), 500):
+                books.update((row[0], tuple(row[1:])) for row in db.session.execute(
+                    db.select(Book.id, Book.title, Book.authors, Book.subjects)
+                    .where(Book.id.in_(changed[start:start + 500]))))
+            for book_id in changed:
+                for entry in self.books.pop(book_id, ()):
+                    self._remove(entry)
+                if book_id in books:
+                    self.books[book_id] = tuple(self.entries(books[book_id]))
+                    for entry in self.books[book_id]:
+                        self._add(entry)
+        self.memo = {}
+
+    def _complete(self, prefix):
+        low = bisect.bisect_left(self.keys, (prefix,))
+        high = bisect.bisect_left(self.keys, (prefix + chr(0x10FFFF),))
+        if high - low > SUGGEST_MEMO_ABOVE and prefix in self.memo:
+            return self.memo[prefix]
+        # Most books first, then the shortest (closest) completion
+        entries = {(kind, text) for _, kind, text in self.keys[low:high]}
+        completions = [[kind, text, self.counts[kind, text]] for kind, text in heapq.nsmallest(
+            MAX_SUGGEST_LIMIT, entries, key=lambda entry: (-self.counts[entry], len(entry[1]), entry))]
+        if high - low > SUGGEST_MEMO_ABOVE:
+            self.memo[prefix] = completions
+        return completions
+
+    def refresh(self):
+        version = get_version("catalogue")
+        with self.lock:
+            # None: no version table (not migrated), so nothing tells us about changes
+            if version is None or version != self.version:
+                self._sync(version)
+                self.version = version
+
+    def suggest(self, prefix, limit=SUGGEST_LIMIT):
+        """The `limit` best completions of `prefix` as [kind, text, books]."""
+        prefix = " ".join(fold_text(prefix).split())
+        if not prefix:
+            return []
+        self.refresh()
+        with self.lock:
+            return self._complete(prefix)[:limit]
+
+suggest_index = SuggestIndex()
+
+def warm_caches():
+    """Load the per-worker caches (locations, search suggestions, asset manifest). Call in an app context.
+
+    gunicorn calls this in the master (gunicorn.conf.py), so the workers are
+    forked with them instead of each reading the catalogue on its first requests.
+    The search indexes are created here too, if missing.
+    """
+    init_search_index()
+    init_trigram_index()
+    location_registry.all()
+    suggest_index.refresh()
+    asset_manifest()
+
+
+# Sort keys for the index, also used as keyset pagination keys. NULLs are
+# coalesced so they sort, and compare in a cursor, like empty strings. Text
+# sorts ignore case.
+# The coalesce defaults are inlined (not bound parameters) so the expressions
+# match the sort indexes below
+BOOK_SORT_KEYS = {
+    "title": db.func.coalesce(Book.title, db.literal_column("''")).collate("NOCASE"),
+    "authors": db.func.coalesce(Book.authors, db.literal_column("''")).collate("NOCASE"),
+    "publish_date": db.func.coalesce(Book.publish_date, db.literal_column("''")),
+    "subjects": db.func.coalesce(Book.subjects, db.literal_column("''")).collate("NOCASE"),
+    "location": db.func.coalesce(Book.location, db.literal_column("0")),
+}
+
+# Expression indexes matching BOOK_SORT_KEYS, so sorted pages are read in index
+# order instead of sorting the whole table. Alembic cannot reflect expression
+# indexes, so like the search index they are created here rather than in a
+# migration (and `flask db migrate` leaves them alone).
+SORT_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_book_sort_title ON book (coalesce(title, '') COLLATE NOCASE, id)",
+    "CREATE INDEX IF NOT EXISTS ix_book_sort_authors ON book (coalesce(authors, '') COLLATE NOCASE, id)",
+    "CREATE INDEX IF NOT EXISTS ix_book_sort_publish_date ON book (coalesce(publish_date, ''), id)",
+    "CREATE INDEX IF NOT EXISTS ix_book_sort_subjects ON book (coalesce(subjects, '') COLLATE NOCASE, id)",
+    "CREATE INDEX IF NOT EXISTS ix_book_sort_location ON book (coalesce(location, 0), id)",
+]
+
+_sort_indexes_ready = False
+
+def init_sort_indexes():
+    """Create the sort indexes if missing (once per process).
+
+    ANALYZE is run whenever an index has no statistics yet (new sort indexes,
+    or indexes added by `flask db upgrade`). Without them SQLite guesses the
+    join order and may drive the index page from `location` and sort every book.
+    """
+    global _sort_indexes_ready
+    if not _sort_indexes_ready and db.engine.dialect.name == "sqlite":
+        with db.engine.begin() as conn:
+            for statement in SORT_INDEXES:
+                conn.exec_driver_sql(statement)
+            analyzed = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").first()
+            stale = not analyzed or conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND tbl_name IN ('book', 'transaction_log') "
+                "AND name NOT IN (SELECT idx FROM sqlite_stat1 WHERE idx IS NOT NULL)").first()
+            if stale:
+                conn.exec_driver_sql("ANALYZE")
+    _sort_indexes_ready = True
+
+
 class LocationForm(FlaskForm):
     # attach form.location.choices = location_options after instantiation!!
     # http://wtforms.readthedocs.io/en/latest/fields.html#wtforms.fields.SelectField
@@ -148,18 +1100,463 @@ def allowed_file(filename):
     """Check if the file has an allowed extension."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def fetch_book_details(isbn):
-    # fetch book details using an ISBN
-    google_books_url = f'https://www.googleapis.com/books/v1/volumes?q=isbn:{isbn}'
-    open_library_url = f'https://openlibrary.org/api/books?bibkeys=ISBN:{isbn}&format=json&jscmd=data'
+def store_document(stream, max_size=MAX_UPLOAD_SIZE):
+    """Copy a PDF from `stream` into the document store and return its document_path.
+
+    The file is hashed while it is copied to a temp file in chunks, then renamed
+    to its content address, so an upload is never held in memory and identical
+    files end up as one. Raises ValueError for an empty, non-PDF or too large file.
+    """
+    os.makedirs(DOCUMENT_FOLDER, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=DOCUMENT_FOLDER, suffix=".tmp", delete=False) as tmp:
+        try:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+                if size == 0 and not chunk.startswith(b"%PDF-"):
+                    raise ValueError("The file is not a PDF.")
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise ValueError(f"The file is larger than {max_size // (1024 * 1024)} MB.")
+                digest.update(chunk)
+                tmp.write(chunk)
+            if size == 0:
+                raise ValueError("The file is empty.")
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    sha256 = digest.hexdigest()
+    document_path = f"documents/{sha256[:2]}/{sha256}.pdf"
+    os.makedirs(os.path.dirname(document_file(document_path)), exist_ok=True)
+    # Also when the file exists: a rename is atomic, and it restores a copy
+    # that a concurrent release_document might just have removed
+    os.replace(tmp.name, document_file(document_path))
+    return document_path
+
+def document_file(document_path):
+    """Absolute path of a stored document.
+
+    Uploads from before the document store kept an absolute path to a file
+    directly in UPLOAD_FOLDER (see `flask migrate-documents`).
+    """
+    if os.path.isabs(document_path):
+        return os.path.join(UPLOAD_FOLDER, os.path.basename(document_path))
+    return os.path.join(UPLOAD_FOLDER, document_path)
+
+def release_document(document_path):
+    """Remove a stored document unless a book still uses it. Call after committing the change."""
+    if not document_path:
+        return
+    path = document_file(document_path)
+    # Every document_path of the same file: the path itself and, for a file
+    # directly in UPLOAD_FOLDER, its legacy absolute path and its relative one
+    paths = {document_path}
+    if os.path.dirname(path) == UPLOAD_FOLDER:
+        paths |= {os.path.basename(path), path}
+    if db.session.query(Book.id).filter(Book.document_path.in_(paths)).first():
+        return
+    if os.path.exists(path):
+        os.remove(path)
+    drop_document_index(document_path)
+
+@bp.cli.command("migrate-documents")
+def migrate_documents():
+    """Move documents uploaded before the document store into it."""
+    moved = 0
+    legacy = Book.query.filter(Book.document_path.isnot(None), Book.document_path != "",
+                               Book.document_path.notlike("documents/%")).all()
+    for book in legacy:
+        old_path = book.document_path
+        try:
+            with open(document_file(old_path), "rb") as f:
+                book.document_path = store_document(f, max_size=None)
+        except (OSError, ValueError) as e:
+            click.echo(f"Book {book.id}: cannot move {old_path}: {e}")
+            continue
+        db.session.commit()
+        release_document(old_path)
+        moved += 1
+    click.echo(f"Moved {moved} of {len(legacy)} documents to {DOCUMENT_FOLDER}.")
+
+
+# Full-text search inside documents
+# The text of each stored PDF is extracted in a background thread after the
+# upload (see queue_document_index) into document_fts, one row per document.
+# document_index records which file content was indexed, so a document is only
+# extracted again when its file changes. Books find their document's row
+# through Book.document_path.
+DOCUMENT_INDEX_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS document_index (
+        id INTEGER PRIMARY KEY,
+        document_path TEXT NOT NULL UNIQUE,
+        sha256 TEXT NOT NULL,
+        pages INTEGER,
+        error TEXT,
+        indexed_at TEXT NOT NULL)""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS document_fts USING fts5(
+        text, tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+]
+# Search hits in documents, one row per book, ranked like the book_fts hits
+DOCUMENT_HITS = f"""SELECT book.id AS book_id, bm25(document_fts) * {DOCUMENT_RANK_WEIGHT} AS rank
+    FROM document_fts
+    JOIN document_index ON document_index.id = document_fts.rowid
+    JOIN book ON book.document_path = document_index.document_path
+    WHERE document_fts MATCH :match"""
+# Marks around the matched words in a snippet, replaced by <mark> when rendered
+SNIPPET_START, SNIPPET_END = "\x02", "\x03"
+
+_document_index_available = None
+_document_executor = None
+_document_lock = threading.Lock()
+
+def init_document_index():
+    """Create the document index tables if missing. Returns False if FTS5 is unavailable."""
+    if db.engine.dialect.name != "sqlite":
+        return False
+    try:
+        with db.engine.begin() as conn:
+            for statement in DOCUMENT_INDEX_SCHEMA:
+                conn.exec_driver_sql(statement)
+    except OperationalError as e:
+        current_app.logger.warning(f"FTS5 document index unavailable: {e}")
+        return False
+    return True
+
+def document_index_available():
+    """Lazily set up the document index once per process."""
+    global _document_index_available
+    if _document_index_available is None:
+        _document_index_available = init_document_index()
+    return _document_index_available
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def document_sha256(document_path):
+    """Content hash of a stored document. Documents in the store are named by it."""
+    if document_path.startswith("documents/"):
+        return os.path.splitext(os.path.basename(document_path))[0]
+    return file_sha256(document_file(document_path))
+
+def extract_document_text(path):
+    """(pages, text) of a PDF, the text cut at DOCUMENT_TEXT_LIMIT characters."""
+    reader = optional_import("pypdf").PdfReader(path)
+    parts, size = [], 0
+    for page in reader.pages:
+        text = page.extract_text() or ""
+        parts.append(text)
+        size += len(text)
+        if size >= DOCUMENT_TEXT_LIMIT:
+            break
+    return len(reader.pages), "\n".join(parts)[:DOCUMENT_TEXT_LIMIT]
+
+def index_document(document_path, force=False):
+    """Extract the text of a stored document into the search index.
+
+    Skipped (returns False) when the same file content is already indexed,
+    unless `force`. A PDF that cannot be read is recorded with its error, so it
+    is not tried again until the file changes.
+    """
+    if not document_path or optional_import("pypdf") is None or not document_index_available():
+        return False
+    path = document_file(document_path)
+    if not os.path.exists(path):
+        return False
+    sha256 = document_sha256(document_path)
+    with db.engine.connect() as conn:
+        indexed = conn.exec_driver_sql(
+            "SELECT sha256 FROM document_index WHERE document_path = ?", (document_path,)).scalar()
+    if indexed == sha256 and not force:
+        return False
 
-    # Fetch data from Open Library
-    open_library_response = requests.get(open_library_url)
-    open_library_data = open_library_response.json() if open_library_response.status_code == 200 else {}
+    # Outside of any transaction: extraction takes a while for large documents
+    pages, text, error = None, "", None
+    try:
+        pages, text = extract_document_text(path)
+    except Exception as e:  # pypdf raises many kinds of errors for broken files
+        error = f"{type(e).__name__}: {e}"
+        current_app.logger.warning(f"Cannot extract the text of {document_path}: {error}")
+
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(
+            "DELETE FROM document_fts WHERE rowid IN (SELECT id FROM document_index WHERE document_path = ?)",
+            (document_path,))
+        conn.exec_driver_sql("DELETE FROM document_index WHERE document_path = ?", (document_path,))
+        row_id = conn.exec_driver_sql(
+            "INSERT INTO document_index (document_path, sha256, pages, error, indexed_at) "
+            "VALUES (?, ?, ?, ?, datetime('now'))", (document_path, sha256, pages, error)).lastrowid
+        if text.strip():
+            conn.exec_driver_sql("INSERT INTO document_fts (rowid, text) VALUES (?, ?)", (row_id, text))
+        # Search results change: let cached pages go
+        bump_version("catalogue", conn)
+        if suggest_log_exists(conn):
+            log_suggest_changes(conn, [])
+    return True
+
+def drop_document_index(document_path):
+    """Remove a document from the search index (when its file is removed)."""
+    if not document_path or not document_index_available():
+        return
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(
+            "DELETE FROM document_fts WHERE rowid IN (SELECT id FROM document_index WHERE document_path = ?)",
+            (document_path,))
+        conn.exec_driver_sql("DELETE FROM document_index WHERE document_path = ?", (document_path,))
+
+def document_executor():
+    """Single background thread that indexes uploaded documents, one at a time."""
+    global _document_executor
+    with _document_lock:
+        if _document_executor is None:
+            _document_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="documents")
+        return _document_executor
+
+def run_index_document(app, document_path):
+    with app.app_context():
+        try:
+            index_document(document_path)
+        except Exception:
+            current_app.logger.exception(f"Indexing {document_path} failed")
+
+def queue_document_index(document_path):
+    """Index a document in the background, so the upload does not wait for the extraction.
+
+    Documents missed here (e.g. the worker was restarted) are picked up by
+    `flask index-documents`.
+    """
+    if document_path and optional_import("pypdf") is not None:
+        document_executor().submit(run_index_document, current_app._get_current_object(), document_path)
+
+def document_snippets(match, book_ids):
+    """{book_id: snippet} of the documents of `book_ids` (the page shown) matching an FTS5 query.
+
+    The matched words are wrapped in SNIPPET_START / SNIPPET_END (see the
+    `highlight` filter). Snippets are expensive for long documents, so only
+    the documents of the given books are read.
+    """
+    if not match or not book_ids or not document_index_available():
+        return {}
+    rows = db.session.execute(db.text(
+        "SELECT book.id, snippet(document_fts, 0, char(2), char(3), '…', 16) "
+        "FROM document_fts "
+        "JOIN document_index ON document_index.id = document_fts.rowid "
+        "JOIN book ON book.document_path = document_index.document_path "
+        "WHERE document_fts MATCH :match AND document_fts.rowid IN ("
+        "  SELECT document_index.id FROM book "
+        "  JOIN document_index ON document_index.document_path = book.document_path "
+        "  WHERE book.id IN :book_ids) AND book.id IN :book_ids"
+    ).bindparams(db.bindparam("book_ids", expanding=True)), {"match": match, "book_ids": list(book_ids)})
+    return dict(rows.all())
+
+@bp.app_template_filter("highlight")
+def highlight(snippet):
+    """A document snippet as HTML, its matched words in <mark>."""
+    html = str(escape(snippet))
+    return Markup(html.replace(SNIPPET_START, "<mark>").replace(SNIPPET_END, "</mark>"))
+
+@bp.cli.command("index-documents")
+@click.option("--force", is_flag=True, help="Extract every document again, also unchanged ones.")
+def index_documents(force):
+    """Add the text of stored documents to the search index (skips unchanged files)."""
+    if optional_import("pypdf") is None:
+        raise click.ClickException("pypdf is not installed; documents cannot be indexed.")
+    if not document_index_available():
+        raise click.ClickException("FTS5 is not available; documents cannot be indexed.")
+    paths = [path for (path,) in db.session.query(Book.document_path).filter(
+        Book.document_path.isnot(None), Book.document_path != "").distinct()]
+    indexed = 0
+    for document_path in paths:
+        started = time.perf_counter()
+        if index_document(document_path, force=force):
+            indexed += 1
+            click.echo(f"{document_path}: {time.perf_counter() - started:.1f}s")
+    # Entries of documents no book uses any more
+    with db.engine.begin() as conn:
+        orphans = [path for (path,) in conn.exec_driver_sql("SELECT document_path FROM document_index")
+                   if path not in paths]
+    for document_path in orphans:
+        drop_document_index(document_path)
+    click.echo(f"Indexed {indexed} of {len(paths)} documents, removed {len(orphans)} stale entries.")
+
+class MetadataCache:
+    """Persistent cache of ISBN lookups, one row per (ISBN-13, source).
+
+    Found records live for METADATA_CACHE_TTL[source] seconds, "not found"
+    answers (stored as NULL) for METADATA_CACHE_NEGATIVE_TTL. When the table
+    grows beyond `max_entries` the least recently used rows are dropped.
+    It is a plain sqlite3 file next to the catalogue, so it is shared by all
+    workers and survives restarts, and is not part of the migrations.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS metadata_cache (
+            isbn13 TEXT NOT NULL,
+            source TEXT NOT NULL,
+            details TEXT,
+            fetched_at REAL NOT NULL,
+            accessed_at REAL NOT NULL,
+            PRIMARY KEY (isbn13, source))""",
+        "CREATE INDEX IF NOT EXISTS ix_metadata_cache_accessed_at ON metadata_cache (accessed_at)",
+        """CREATE TABLE IF NOT EXISTS metadata_cache_stats (
+            source TEXT PRIMARY KEY,
+            hits INTEGER NOT NULL DEFAULT 0,
+            misses INTEGER NOT NULL DEFAULT 0)""",
+    ]
+
+    def __init__(self, path, ttl, negative_ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        # Every lookup writes (LRU stamp, counters); keep those commits cheap
+        conn.execute("PRAGMA synchronous = NORMAL")
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode = WAL")
+            with self._lock, conn:
+                for statement in self.SCHEMA:
+                    conn.execute(statement)
+            self._initialized = True
+        return conn
+
+    def get(self, isbn13, source):
+        """Return (True, details) on a hit, where details is {} for a cached "not found"; (False, None) on a miss."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute(
+                    "SELECT details, fetched_at FROM metadata_cache WHERE isbn13 = ? AND source = ?",
+                    (isbn13, source)).fetchone()
+                ttl = self.negative_ttl if row and row[0] is None else self.ttl.get(source, 0)
+                hit = row is not None and now - row[1] < ttl
+                if hit:
+                    conn.execute("UPDATE metadata_cache SET accessed_at = ? WHERE isbn13 = ? AND source = ?",
+                                 (now, isbn13, source))
+                conn.execute("INSERT OR IGNORE INTO metadata_cache_stats (source) VALUES (?)", (source,))
+                conn.execute(f"UPDATE metadata_cache_stats SET {'hits' if hit else 'misses'} = "
+                             f"{'hits' if hit else 'misses'} + 1 WHERE source = ?", (source,))
+        finally:
+            conn.close()
+        if not hit:
+            return False, None
+        return True, json.loads(row[0]) if row[0] is not None else {}
+
+    def put(self, isbn13, source, details):
+        """Store a lookup result. An empty `details` is stored as a negative entry."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO metadata_cache (isbn13, source, details, fetched_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (isbn13, source, json.dumps(details) if details else None, now, now))
+                # Evict the least recently used entries beyond the size bound
+                conn.execute(
+                    "DELETE FROM metadata_cache WHERE rowid IN (SELECT rowid FROM metadata_cache "
+                    "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        finally:
+            conn.close()
+
+    def stats(self):
+        """Entries and hit/miss counters per source."""
+        conn = self._connect()
+        try:
+            counters = {source: {"hits": hits, "misses": misses} for source, hits, misses in
+                        conn.execute("SELECT source, hits, misses FROM metadata_cache_stats")}
+            for source, entries, negative in conn.execute(
+                    "SELECT source, count(*), count(*) - count(details) FROM metadata_cache GROUP BY source"):
+                counters.setdefault(source, {"hits": 0, "misses": 0}).update(entries=entries, negative=negative)
+        finally:
+            conn.close()
+        return counters
+
+    def clear(self):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM metadata_cache")
+                conn.execute("DELETE FROM metadata_cache_stats")
+        finally:
+            conn.close()
+
+
+metadata_cache = MetadataCache(METADATA_CACHE_PATH, METADATA_CACHE_TTL,
+                               METADATA_CACHE_NEGATIVE_TTL, METADATA_CACHE_MAX_ENTRIES)
+
+@bp.cli.group("metadata-cache")
+def metadata_cache_cli():
+    """Inspect or clear the ISBN metadata cache."""
+
+@metadata_cache_cli.command("stats")
+def metadata_cache_stats():
+    """Print entries and hit/miss counters per source."""
+    for source, counters in sorted(metadata_cache.stats().items()):
+        click.echo(f"{source}: {counters.get('entries', 0)} entries ({counters.get('negative', 0)} not found), "
+                   f"{counters['hits']} hits, {counters['misses']} misses")
+
+@metadata_cache_cli.command("clear")
+def metadata_cache_clear():
+    """Drop all cached lookups and reset the counters."""
+    metadata_cache.clear()
+    click.echo("Metadata cache cleared.")
+
+
+_http_session = None
+_metadata_executor = None
+_metadata_lock = threading.Lock()
+
+def http_session():
+    """Process-wide requests.Session, so lookups reuse pooled keep-alive connections."""
+    global _http_session
+    with _metadata_lock:
+        if _http_session is None:
+            import requests
+            from urllib3.util.retry import Retry
+            retry = Retry(total=METADATA_RETRIES, backoff_factor=METADATA_BACKOFF,
+                          status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+            adapter = timed_http_adapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
+
+def metadata_executor():
+    """Thread pool that runs the per-source lookups concurrently."""
+    global _metadata_executor
+    with _metadata_lock:
+        if _metadata_executor is None:
+            _metadata_executor = ThreadPoolExecutor(max_workers=2 * IMPORT_WORKERS, thread_name_prefix="metadata")
+        return _metadata_executor
+
+def fetch_openlibrary(isbn):
+    """Book details from Open Library. {} if the ISBN is unknown, None if the request failed."""
+    import requests
+    open_library_url = f'{OPENLIBRARY_URL}/api/books?bibkeys=ISBN:{isbn}&format=json&jscmd=data'
+    try:
+        open_library_response = http_session().get(open_library_url, timeout=METADATA_TIMEOUT["openlibrary"])
+    except requests.RequestException:
+        return None
+    if open_library_response.status_code != 200:
+        return None
+    try:
+        open_library_data = open_library_response.json()
+    except ValueError:
+        return None
     # pprint.pprint((open_library_data))
 
     book_details = {}
-    # Open Library data
     if f'ISBN:{isbn}' in open_library_data:
         open_library_info = open_library_data[f'ISBN:{isbn}']
 
@@ -180,97 +1577,1714 @@ def fetch_book_details(isbn):
         book_details['number_of_pages'] = open_library_info.get('number_of_pages', '')
         book_details['preview_link'] = f"https://openlibrary.org{open_library_info.get('key', '')}"  # Link to borrow or more info
         book_details['thumbnail'] = open_library_info.get('cover', {}).get('medium', '')
+    return book_details
 
-    # If no Open Library data, try Google Books
-    if not book_details.get('title'):
-        google_books_response = requests.get(google_books_url)
-        google_books_data = google_books_response.json() if google_books_response.status_code == 200 else {}
-        # pprint.pprint((google_books_data))
-
-        if 'items' in google_books_data:
-            google_book = google_books_data['items'][0]
-            google_info = google_book.get('volumeInfo', {})
-
-            google_title = google_info.get('title', '')
-            google_subtitle = google_info.get('subtitle', '')
-            # Combine title and subtitle (if subtitle exists)
-            if google_subtitle:
-                book_details['title'] = f"{google_title} - {google_subtitle}"
-            else:
-                book_details['title'] = google_title
+def fetch_google_books(isbn):
+    """Book details from Google Books. {} if the ISBN is unknown, None if the request failed."""
+    import requests
+    google_books_url = f'{GOOGLE_BOOKS_URL}/books/v1/volumes?q=isbn:{isbn}'
+    try:
+        google_books_response = http_session().get(google_books_url, timeout=METADATA_TIMEOUT["googlebooks"])
+    except requests.RequestException:
+        return None
+    if google_books_response.status_code != 200:
+        return None
+    try:
+        google_books_data = google_books_response.json()
+    except ValueError:
+        return None
+    # pprint.pprint((google_books_data))
+
+    book_details = {}
+    if 'items' in google_books_data:
+        google_book = google_books_data['items'][0]
+        google_info = google_book.get('volumeInfo', {})
+
+        google_title = google_info.get('title', '')
+        google_subtitle = google_info.get('subtitle', '')
+        # Combine title and subtitle (if subtitle exists)
+        if google_subtitle:
+            book_details['title'] = f"{google_title} - {google_subtitle}"
+        else:
+            book_details['title'] = google_title
+
+        book_details['authors'] = google_info.get('authors', [])
+        book_details['publishedDate'] = google_info.get('publishedDate', '')
+        book_details['description'] = google_info.get('description', '')
+        book_details['thumbnail'] = google_info.get('imageLinks', {}).get('thumbnail', '')
+        book_details['subjects'] = google_info.get('categories', [])
+        book_details['number_of_pages'] = google_info.get('pageCount', '')
+        book_details['preview_link'] = google_info.get('previewLink', '')
+    return book_details
+
+# Lookup order is also priority order when merging the answers
+METADATA_SOURCES = {
+    "openlibrary": fetch_openlibrary,
+    "googlebooks": fetch_google_books,
+}
+
+def fetch_source_cached(source, isbn13):
+    """Look up one source through the metadata cache. Failed requests are not cached."""
+    hit, book_details = metadata_cache.get(isbn13, source)
+    if hit:
+        return book_details
+    book_details = METADATA_SOURCES[source](isbn13)
+    if book_details is None:
+        return {}
+    metadata_cache.put(isbn13, source, book_details)
+    return book_details
 
-            book_details['authors'] = google_info.get('authors', [])
-            book_details['publishedDate'] = google_info.get('publishedDate', '')
-            book_details['description'] = google_info.get('description', '')
-            book_details['thumbnail'] = google_info.get('imageLinks', {}).get('thumbnail', '')
-            book_details['subjetcs'] = google_info.get('categories', [])
-            book_details['number_of_pages'] = google_info.get('pageCount', '')
-            book_details['preview_link'] = google_info.get('previewLink', '')
+def is_complete(book_details):
+    return bool(book_details.get("title") and book_details.get("authors"))
+
+def fetch_book_details(isbn):
+    # fetch book details using an ISBN
+    # Both the cache and the remote lookups use the canonical ISBN-13
+    isbn13 = normalize_isbn(isbn) or isbn
+
+    # Query all sources at once and wait at most for the slowest source's
+    # deadline. A source that misses it keeps running in the pool and still
+    # fills the cache for the next lookup. The lookups run in a copy of this
+    # context, so their HTTP time counts for this request.
+    futures = {source: metadata_executor().submit(contextvars.copy_context().run, fetch_source_cached, source, isbn13)
+               for source in METADATA_SOURCES}
+    deadline = time.monotonic() + max(METADATA_TIMEOUT.values())
+    results = {}
+    pending = set(futures.values())
+    preferred = next(iter(METADATA_SOURCES))
+    while pending:
+        done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for source, future in futures.items():
+            if future in done:
+                results[source] = future.result()
+        # A complete answer from the preferred source needs nothing from the others
+        if is_complete(results.get(preferred, {})):
+            break
+
+    # Merge: the first source with a value for a field wins
+    book_details = {}
+    for source in METADATA_SOURCES:
+        for key, value in results.get(source, {}).items():
+            if value and not book_details.get(key):
+                book_details[key] = value
 
     # Return the combined details
     return book_details
 
+def write_file_atomic(path, data):
+    """Write bytes to `path` through a temp file and rename, so readers never see half a file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+        f.write(data)
+    os.replace(f.name, path)
+
+def download_cover(url):
+    """Download an image and store it under its sha256. Returns the stored file name or None."""
+    import requests
+    try:
+        with http_session().get(url, timeout=max(METADATA_TIMEOUT.values()), stream=True) as response:
+            content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+            if response.status_code != 200 or not content_type.startswith("image/"):
+                return None
+            data = b""
+            for chunk in response.iter_content(64 * 1024):
+                data += chunk
+                if len(data) > COVER_MAX_BYTES:
+                    return None
+    except requests.RequestException as e:
+        current_app.logger.warning(f"Cover download failed for {url}: {e}")
+        return None
+    digest = hashlib.sha256(data).hexdigest()
+    name = digest + (mimetypes.guess_extension(content_type) or "")
+    path = os.path.join(COVER_FOLDER, digest[:2], name)
+    if not os.path.exists(path):
+        write_file_atomic(path, data)
+    return name
+
+def fetch_cover(url, force=False):
+    """Stored file name of the cover at `url`, downloading it the first time.
+
+    A small pointer file per URL (covers/urls/) holds the file name, so books
+    sharing an image, or an edited URL pointing to the same image, share one
+    copy. An empty pointer remembers a failed download for COVER_RETRY_AFTER.
+    """
+    if not url or not url.startswith(("http://", "https://")):
+        return None
+    key = hashlib.sha256(url.encode()).hexdigest()
+    pointer = os.path.join(COVER_FOLDER, "urls", key[:2], key)
+    if not force and os.path.exists(pointer):
+        with open(pointer) as f:
+            name = f.read().strip()
+        if name and os.path.exists(os.path.join(COVER_FOLDER, name[:2], name)):
+            return name
+        if not name and time.time() - os.path.getmtime(pointer) < COVER_RETRY_AFTER:
+            return None
+    name = download_cover(url)
+    write_file_atomic(pointer, (name or "").encode())
+    return name
+
+@cache
+def cover_formats():
+    """Formats of the resized covers: WebP when Pillow can write it, and JPEG."""
+    features = optional_import("PIL.features")
+    return ["webp", "jpeg"] if features and features.check("webp") else ["jpeg"]
+
+def cover_variant(name, size, fmt="jpeg"):
+    """Path and mimetype of stored cover `name` resized to COVER_SIZES[size] as `fmt`.
+
+    Variants are made on first use and kept next to the original. Without
+    Pillow, or for an image Pillow cannot read, the original is returned.
+    """
+    original = os.path.join(COVER_FOLDER, name[:2], name)
+    Image = optional_import("PIL.Image")
+    if Image is None or size not in COVER_SIZES:
+        return original, mimetypes.guess_type(original)[0]
+    digest = name.split(".")[0]
+    path = os.path.join(COVER_FOLDER, digest[:2], f"{digest}_{size}.{fmt}")
+    if not os.path.exists(path):
+        try:
+            with Image.open(original) as image:
+                image.thumbnail(COVER_SIZES[size])
+                if fmt == "jpeg" or image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGB")
+                buffer = io.BytesIO()
+                image.save(buffer, fmt.upper(), quality=COVER_QUALITY)
+        except (OSError, Image.DecompressionBombError) as e:
+            current_app.logger.warning(f"Cannot resize cover {name}: {e}")
+            return original, mimetypes.guess_type(original)[0]
+        write_file_atomic(path, buffer.getvalue())
+    return path, f"image/{fmt}"
+
+@bp.cli.command("prefetch-covers")
+@click.option("--workers", default=IMPORT_WORKERS, show_default=True, help="Parallel downloads.")
+@click.option("--force", is_flag=True, help="Download again, also covers that failed recently.")
+def prefetch_covers(workers, force):
+    """Download and resize the covers of the whole catalogue."""
+    urls = {url for (url,) in db.session.query(Book.openlibrary_medcover_url)
+            .filter(Book.openlibrary_medcover_url.isnot(None), Book.openlibrary_medcover_url != "")}
+
+    def prefetch(url):
+        name = fetch_cover(url, force=force)
+        if name:
+            for size in COVER_SIZES:
+                for fmt in cover_formats():
+                    cover_variant(name, size, fmt)
+        return name
+
+    stored = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        with click.progressbar(executor.map(prefetch, urls), length=len(urls), label="Covers") as names:
+            stored = sum(1 for name in names if name)
+    click.echo(f"{stored} of {len(urls)} covers stored in {COVER_FOLDER}.")
+    if optional_import("PIL.Image") is None:
+        click.echo("Pillow is not installed, so the original images are served without resizing.")
+
+# Separators found in printed and scanned ISBNs
+ISBN_SEPARATORS = str.maketrans("", "", "- .")
+ISBN_PATTERN = re.compile(r"\d{9}[\dX]|97[89]\d{10}")
+
+def normalize_isbn(isbn:str|None) -> str|None:
+    """Canonical ISBN-13 for a valid ISBN-10 or ISBN-13, ignoring hyphens and spaces. None if invalid.
+
+    https://en.wikipedia.org/wiki/ISBN#Check_digits
+    """
+    if not isbn:
+        return None
+    isbn = isbn.strip().translate(ISBN_SEPARATORS).upper()
+    if not ISBN_PATTERN.fullmatch(isbn):
+        return None
+    if len(isbn) == 10:
+        # Weights 10..1, the check digit (X = 10) included; an ISBN-10 sums to a multiple of 11
+        check = 10 if isbn[9] == "X" else int(isbn[9])
+        if (sum(weight * int(digit) for weight, digit in zip(range(10, 1, -1), isbn)) + check) % 11:
+            return None
+        isbn = "978" + isbn[:9]
+        return isbn + str(-(sum(map(int, isbn[::2])) + 3 * sum(map(int, isbn[1::2]))) % 10)
+    # Weights 1, 3, 1, ..., the check digit included; an ISBN-13 sums to a multiple of 10
+    if (sum(map(int, isbn[::2])) + 3 * sum(map(int, isbn[1::2]))) % 10:
+        return None
+    return isbn
+
+def normalize_isbns(isbns):
+    """normalize_isbn of many ISBNs (an import file, a scanner dump), in order.
+
+    A scanner dump repeats the ISBNs of copies; each value is checked once.
+    """
+    normalized = {}
+    for isbn in isbns:
+        if isbn not in normalized:
+            normalized[isbn] = normalize_isbn(isbn)
+    return [normalized[isbn] for isbn in isbns]
+
 def check_isbn(isbn:str|None) -> bool:
-    """Check we have a ISBN
+    """Check we have a ISBN: 10 or 13 digits (an ISBN-10 may end in X) with a valid check digit."""
+    return normalize_isbn(isbn) is not None
+
+def find_isbn13s(isbn13s):
+    """{isbn13: book id} of the books with any of `isbn13s`, one index probe each."""
+    isbn13s = list({isbn13 for isbn13 in isbn13s if isbn13})
+    found = {}
+    for chunk in range(0, len(isbn13s), 500):
+        found.update(db.session.query(Book.isbn13, Book.id).filter(Book.isbn13.in_(isbn13s[chunk:chunk + 500])))
+    return found
+
+@bp.cli.command("backfill-isbn13")
+def backfill_isbn13():
+    """Set Book.isbn13 of all books from Book.isbn, e.g. after the migration that adds it.
+
+    An ISBN-13 shared by several books stays with the oldest one; the others
+    are listed and left without, until they are merged or corrected.
+    """
+    rows = db.session.query(Book.id, Book.isbn).order_by(Book.id).all()
+    owners, updates, invalid = {}, [], 0
+    for (book_id, isbn), isbn13 in zip(rows, normalize_isbns([isbn for _, isbn in rows])):
+        if isbn13 is None:
+            invalid += bool(isbn)
+        elif isbn13 in owners:
+            click.echo(f"Duplicate ISBN {isbn13}: book {book_id} ({isbn!r}), kept on book {owners[isbn13]}")
+            isbn13 = None
+        else:
+            owners[isbn13] = book_id
+        updates.append({"id": book_id, "isbn13": isbn13})
+    # Cleared first, so no book takes an ISBN-13 another still holds
+    db.session.execute(db.update(Book).values(isbn13=None))
+    if updates:
+        db.session.execute(db.update(Book), updates)
+    db.session.commit()
+    click.echo(f"Set the ISBN-13 of {len(owners)} of {len(rows)} books; {invalid} have an invalid ISBN.")
+
+class KeysetPage:
+    """One page of a keyset (seek) paginated query.
 
-    https://stackoverflow.com/a/4047709
-    https://rosettacode.org/wiki/ISBN13_check_digit#Python
+    Mirrors the parts of flask_sqlalchemy's Pagination used by the templates,
+    but navigates with opaque cursors instead of page numbers.
+    """
+    keyset = True
+
+    def __init__(self, items, has_prev, has_next, prev_cursor, next_cursor, total=None):
+        self.items = items
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+        self.total = total
+
+def encode_cursor(key, direction):
+    """Pack a (sort value, id) key and a direction ("next"/"prev") into a URL-safe token."""
+    raw = json.dumps([direction, list(key)], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor. Returns (direction, key) or None for a missing/invalid cursor."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        direction, key = json.loads(raw)
+        # The key becomes bind parameters: only accept what encode_cursor writes
+        if (direction not in ("next", "prev") or not isinstance(key, list) or len(key) != 2
+                or not all(value is None or isinstance(value, (str, int, float)) for value in key)):
+            return None
+        return direction, tuple(key)
+    except (ValueError, TypeError):
+        return None
+
+def keyset_paginate(query, sort_key, id_key, descending=False, cursor=None, per_page=PAGINATE_BY_HOWMANY, total=None):
+    """Fetch one page of `query` ordered by (sort_key, id_key) starting after `cursor`.
+
+    The page is located with a `WHERE (sort, id) > (?, ?)` seek instead of an
+    OFFSET, so page 1000 costs the same as page 1, and no COUNT(*) is issued.
+    `query` must not be ordered yet. Items are the rows of `query`; the two key
+    columns added here are stripped again.
     """
+    position = decode_cursor(cursor)
+    backwards = position is not None and position[0] == "prev"
+    key = tuple_(sort_key, id_key)
+    # Walking backwards flips both the comparison and the ordering
+    if descending != backwards:
+        order = (sort_key.desc(), id_key.desc())
+        seek = key < tuple_(*position[1]) if position else None
+    else:
+        order = (sort_key.asc(), id_key.asc())
+        seek = key > tuple_(*position[1]) if position else None
+
+    query = query.add_columns(sort_key.label("sort_key"), id_key.label("sort_id"))
+    if seek is not None:
+        query = query.filter(seek)
+    rows = query.order_by(*order).limit(per_page + 1).all()
+
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    keys = [(row.sort_key, row.sort_id) for row in rows]
+    items = [row[0] if len(row) == 3 else tuple(row[:-2]) for row in rows]
+
+    has_prev = more if backwards else position is not None
+    has_next = True if backwards else more
+    return KeysetPage(
+        items,
+        has_prev=bool(rows) and has_prev,
+        has_next=bool(rows) and has_next,
+        prev_cursor=encode_cursor(keys[0], "prev") if rows and has_prev else None,
+        next_cursor=encode_cursor(keys[-1], "next") if rows and has_next else None,
+        total=total,
+    )
 
-    if isbn is None:
-        return False
+def stream_rows(query, offset, limit, batch_size=100):
+    """The rows of one page of `query`, read in batches while the template iterates them."""
+    yield from db.session.execute(query.limit(limit).offset(offset).statement).yield_per(batch_size)
 
-    isbn = isbn.replace("-", "").replace(" ", "").upper();
-    if len(isbn) == 10:
-        match = re.search(r'^(\d{9})(\d|X)$', isbn)
-        if not match:
-            return False
+def stream_page(template_name, **context):
+    """Render a template as a streamed response, sent in chunks while it renders.
 
-        digits = match.group(1)
-        check_digit = 10 if match.group(2) == 'X' else int(match.group(2))
+    Like flask.stream_template, but buffered, so a large page is not sent in
+    thousands of tiny writes.
+    """
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(100)
+    return Response(stream_with_context(stream), mimetype="text/html")
+
+_count_cache = {}
+
+def cached_count(cache_key, query):
+    """Row count of `query`, reused for COUNT_CACHE_TTL seconds. Good enough for "about N books"."""
+    hit = _count_cache.get(cache_key)
+    now = time.monotonic()
+    if hit and now - hit[0] < COUNT_CACHE_TTL:
+        return hit[1]
+    total = query.order_by(None).count()
+    if len(_count_cache) > 1000:
+        _count_cache.clear()
+    _count_cache[cache_key] = (now, total)
+    return total
+
+class ResponseCache:
+    """In-process LRU of rendered responses for anonymous visitors.
+
+    Keys include the "catalogue" version, so an entry is never served after a
+    change: the next request has a new key and the old entries age out.
+    """
 
-        result = sum((i + 1) * int(digit) for i, digit in enumerate(digits))
-        return (result % 11) == check_digit
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES)
+
+def cached_page(view):
+    """Serve GET requests of anonymous visitors from response_cache, with a strong ETag.
+
+    The key is the endpoint, view arguments, normalised query arguments, the
+    AJAX header (fragment or full page) and the catalogue version. Logged-in
+    users, pending flash messages and non-200 responses bypass the cache.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if (not RESPONSE_CACHE_MAX_ENTRIES or request.method != "GET"
+                or session.get("logged_in") or session.get("_flashes")):
+            return view(*args, **kwargs)
+        version = get_version("catalogue")
+        if version is None:
+            return view(*args, **kwargs)
+        query_args = tuple(sorted((k, v) for k, v in request.args.items(multi=True) if v != ""))
+        key = (request.endpoint, request.script_root, tuple(sorted(kwargs.items())), query_args,
+               request.headers.get("X-Requested-With") == "XMLHttpRequest", version)
+        entry = response_cache.get(key)
+        if entry is None:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            body = response.get_data()
+            entry = (body, response.mimetype, hashlib.sha256(body).hexdigest()[:32])
+            response_cache.put(key, entry)
+        body, mimetype, etag = entry
+        response = Response(body, mimetype=mimetype)
+        response.set_etag(etag)
+        # Browsers and proxies may store the page but must revalidate (cheap 304s)
+        response.cache_control.no_cache = True
+        response.vary.add("Cookie")
+        response.vary.add("X-Requested-With")
+        return response.make_conditional(request)
+    return wrapper
+
+def format_location_label(location):
+    return f"{location.label_name}, {location.full_name}" if location else "Unknown"
+
+def book_log_details(book, location_label, **extra):
+    """All book details as a JSON string, stored with ADD, DELETE and MERGE log entries (and used by restore_book)."""
+    return json.dumps({
+        "isbn": book.isbn,
+        "title": book.title,
+        "authors": book.authors,
+        "publish_date": book.publish_date,
+        "subjects": book.subjects,
+        "pages": book.number_of_pages,
+        "openlibrary_preview_url": book.openlibrary_preview_url,
+        "thumbnail": book.openlibrary_medcover_url,
+        "location_id": book.location,
+        "location_label": location_label,
+        "document_path": book.document_path,
+        **extra,
+    })
+
+# Bulk import
+def iter_import_rows(stream):
+    """Yield (line number, isbn, location label or None) from a CSV file or a plain ISBN list.
+
+    A CSV file needs a header with an `isbn` column and may have a `location`
+    column with location labels. Otherwise the first field of every line is the
+    ISBN, which covers barcode-scanner dumps.
+    """
+    lines = iter(stream)
+    first = next(lines, None)
+    if first is None:
+        return
+    header = [field.strip().lower() for field in next(csv.reader([first]))]
+    if "isbn" in header:
+        isbn_col = header.index("isbn")
+        location_col = header.index("location") if "location" in header else None
+        for line_no, row in enumerate(csv.reader(lines), start=2):
+            if len(row) > isbn_col and row[isbn_col].strip():
+                location = row[location_col].strip() if location_col is not None and len(row) > location_col else None
+                yield line_no, row[isbn_col].strip(), location or None
+        return
+    for line_no, line in enumerate(itertools.chain([first], lines), start=1):
+        isbn = line.split(",", 1)[0].strip()
+        if isbn:
+            yield line_no, isbn, None
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_checkpoint(path, checkpoint):
+    # Write to a temp file and rename, so a crash never leaves half a checkpoint
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+def import_isbns(rows, default_location_id=None, checkpoint_path=None, progress=None,
+                 batch_size=IMPORT_BATCH_SIZE, workers=IMPORT_WORKERS):
+    """Add a book for every new ISBN in `rows` (as yielded by iter_import_rows).
+
+    ISBNs are validated with normalize_isbns and skipped when the catalogue
+    already has the same ISBN-13 (Book.isbn13). Details are fetched with `workers` parallel
+    fetch_book_details calls, and every `batch_size` books are inserted,
+    together with their ADD log entries, in one transaction. After each batch
+    the position is saved to `checkpoint_path`, so a rerun resumes after the
+    last committed batch. Needs an app context. Returns the checkpoint dict.
+    """
+    checkpoint = (read_checkpoint(checkpoint_path) if checkpoint_path else None) or {
+        "line": 0, "added": 0, "duplicates": 0, "invalid": 0, "not_found": [], "done": False,
+    }
+    locations = {l.label_name: l for l in location_registry.all()}
+    # ISBN-13s of this import, for ISBNs repeated in the file
+    seen = set()
+
+    def flush(batch, last_line):
+        if batch:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="import") as pool:
+                details = list(pool.map(lambda row: fetch_book_details(row[0]), batch))
+            books = []
+            # Added meanwhile, e.g. on the Add book page
+            added = find_isbn13s(isbn13 for isbn13, _ in batch)
+            for (isbn13, location_id), book_data in zip(batch, details):
+                if isbn13 in added:
+                    checkpoint["duplicates"] += 1
+                    continue
+                if not book_data.get("title"):
+                    checkpoint["not_found"].append(isbn13)
+                    continue
+                books.append(Book(
+                    isbn=isbn13,
+                    title=book_data.get("title", ""),
+                    authors=", ".join(book_data.get("authors", [])),
+                    publish_date=book_data.get("publishedDate", ""),
+                    subjects=", ".join(book_data.get("subjects", [])),
+                    openlibrary_medcover_url=book_data.get("thumbnail", ""),
+                    openlibrary_preview_url=book_data.get("preview_link", ""),
+                    number_of_pages=str(book_data.get("number_of_pages", "")),
+                    dewey_decimal_class="",  # Not used
+                    lccn="", # not used
+                    olid="", # not used
+                    location=location_id,
+                ))
+            db.session.add_all(books)
+            db.session.flush()  # assigns the ids for the log entries
+            sync_book_facets(books)
+            db.session.add_all(TransactionLog(
+                action="ADD",
+                book_id=book.id,
+                book_title=f"{book.authors} - {book.title}",
+                details=book_log_details(book, format_location_label(location_registry.get(book.location))),
+            ) for book in books)
+            db.session.commit()
+            checkpoint["added"] += len(books)
+        checkpoint["line"] = last_line
+        if checkpoint_path:
+            write_checkpoint(checkpoint_path, checkpoint)
+        if progress:
+            progress(checkpoint)
+
+    batch = []
+    line_no = checkpoint["line"]
+    rows = (row for row in rows if row[0] > checkpoint["line"])
+    # Validated, and checked against the catalogue, a chunk of rows at a time
+    while chunk := list(itertools.islice(rows, batch_size)):
+        isbn13s = normalize_isbns([isbn for _, isbn, _ in chunk])
+        known = find_isbn13s(isbn13s)
+        for (line_no, isbn, label), isbn13 in zip(chunk, isbn13s):
+            if isbn13 is None:
+                checkpoint["invalid"] += 1
+                continue
+            if isbn13 in known or isbn13 in seen:
+                checkpoint["duplicates"] += 1
+                continue
+            seen.add(isbn13)
+            location = locations.get(label) if label else None
+            batch.append((isbn13, location.id if location else default_location_id))
+            if len(batch) >= batch_size:
+                flush(batch, line_no)
+                batch = []
+    checkpoint["done"] = True
+    flush(batch, line_no)
+    return checkpoint
+
+@bp.cli.command("import-isbns")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--location", "location_label_name", help="Location label for books without a location column.")
+@click.option("--batch-size", default=IMPORT_BATCH_SIZE, show_default=True, help="Books per transaction.")
+@click.option("--workers", default=IMPORT_WORKERS, show_default=True, help="Parallel metadata lookups.")
+@click.option("--restart", is_flag=True, help="Ignore an existing checkpoint and start from the top.")
+def import_isbns_command(path, location_label_name, batch_size, workers, restart):
+    """Import books from a CSV file or a newline separated ISBN list.
+
+    Progress is saved to PATH.checkpoint; rerun the command to resume.
+    """
+    location_id = None
+    if location_label_name:
+        location = Location.query.filter_by(label_name=location_label_name).first()
+        if location is None:
+            raise click.BadParameter(f"No location with label '{location_label_name}'.")
+        location_id = location.id
+
+    checkpoint_path = f"{path}.checkpoint"
+    if restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    def report(checkpoint):
+        click.echo(f"line {checkpoint['line']}: {checkpoint['added']} added, {checkpoint['duplicates']} duplicates, "
+                   f"{checkpoint['invalid']} invalid, {len(checkpoint['not_found'])} not found")
+
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        checkpoint = import_isbns(iter_import_rows(f), location_id, checkpoint_path, progress=report,
+                                  batch_size=batch_size, workers=workers)
+    for isbn in checkpoint["not_found"]:
+        click.echo(f"not found: {isbn}")
+
+# Export
+# The exports stream rows from the database cursor in chunks of
+# EXPORT_CHUNK_ROWS, so memory use does not depend on the size of the catalogue.
+def export_books_query():
+    """Plain (non-ORM) rows: every book column plus its location's label and full name."""
+    return (db.select(*Book.__table__.c,
+                      Location.label_name.label("location_label"),
+                      Location.full_name.label("location_name"))
+            .outerjoin(Location, Book.location == Location.id)
+            .order_by(Book.id))
+
+def export_logs_query(since=None):
+    query = db.select(*TransactionLog.__table__.c).order_by(TransactionLog.id)
+    if since is not None:
+        # Compare with the stored timestamp text, see view_logs
+        query = query.where(db.type_coerce(TransactionLog.timestamp, db.String) >= since.strftime("%Y-%m-%d %H:%M:%S"))
+    return query
+
+def iter_export(query, fmt):
+    """Encode the rows of `query` as CSV (with header) or JSON Lines, yielding one chunk of text per batch."""
+    result = db.session.execute(query.execution_options(yield_per=EXPORT_CHUNK_ROWS))
+    columns = list(result.keys())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(columns)
+    for rows in result.partitions():
+        for row in rows:
+            if fmt == "csv":
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(columns, row)), default=str, ensure_ascii=False))
+                buffer.write("\n")
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def iter_encoded(chunks, compress=False):
+    """UTF-8 encode the chunks, optionally as one gzip stream."""
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31: gzip container
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        yield compressor.compress(data) if compressor else data
+    if compressor:
+        yield compressor.flush()
+
+def parse_since(value):
+    """The `since` filter: an ISO date or datetime."""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+def snapshot_database(path):
+    """Copy the live database to `path` with the sqlite3 backup API (consistent, does not block writers for long).
+
+    In WAL mode the copy is made in one step: it reads one consistent version of
+    the database while writers carry on. Otherwise it copies 1024 pages at a
+    time, letting writers in between (a write restarts the copy).
+    """
+    source = db.engine.raw_connection()
+    try:
+        wal = source.driver_connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        destination = sqlite3.connect(path)
+        try:
+            source.driver_connection.backup(destination, pages=-1 if wal else 1024)
+        finally:
+            destination.close()
+    finally:
+        source.close()
+
+@bp.cli.command("export")
+@click.argument("what", type=click.Choice(["books", "logs", "snapshot"]))
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default="csv", show_default=True)
+@click.option("--gzip", "compress", is_flag=True, help="Gzip the output.")
+@click.option("--since", help="Only log entries from this ISO date/time on.")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="Output file (default: stdout). Required for snapshot.")
+def export_command(what, fmt, compress, since, output):
+    """Export the books (with locations), the transaction log, or an sqlite snapshot."""
+    if what == "snapshot":
+        if not output:
+            raise click.UsageError("A snapshot needs --output.")
+        snapshot_database(output)
+        return
+    since_date = parse_since(since)
+    if since and since_date is None:
+        raise click.BadParameter(f"Not an ISO date: {since}")
+    query = export_books_query() if what == "books" else export_logs_query(since_date)
+    out = open(output, "wb") if output else click.get_binary_stream("stdout")
+    try:
+        for data in iter_encoded(iter_export(query, fmt), compress):
+            out.write(data)
+    finally:
+        if output:
+            out.close()
+
+# Backups
+class BackupStore:
+    """Snapshots of the database and the uploads, stored as deduplicated chunks.
+
+        chunks/<sha256[:2]>/<sha256>   a zlib-compressed piece of a file, named by the hash of its content
+        snapshots/<id>.json            manifest: the chunks of the database and of every upload
+
+    Files are cut into BACKUP_CHUNK_SIZE pieces (a multiple of the SQLite page
+    size), so a snapshot only stores the pieces that changed since any earlier
+    one. Chunks are written before the manifest that uses them, so an
+    interrupted backup leaves no half snapshot.
+    """
+
+    def __init__(self, folder, chunk_size=BACKUP_CHUNK_SIZE):
+        self.folder = os.path.abspath(folder)
+        self.chunk_size = chunk_size
+        self.chunk_folder = os.path.join(self.folder, "chunks")
+        self.snapshot_folder = os.path.join(self.folder, "snapshots")
+
+    def lock(self):
+        """Exclusive lock of the store, held while creating or pruning snapshots."""
+        os.makedirs(self.folder, exist_ok=True)
+        f = open(os.path.join(self.folder, ".lock"), "w")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_folder, digest[:2], digest)
+
+    def put_file(self, path, counters):
+        """Store the chunks of a file. Returns its manifest entry; counts new chunks/bytes in `counters`."""
+        file_digest = hashlib.sha256()
+        chunks = []
+        size = 0
+        with open(path, "rb") as f:
+            for data in iter(lambda: f.read(self.chunk_size), b""):
+                file_digest.update(data)
+                size += len(data)
+                digest = hashlib.sha256(data).hexdigest()
+                chunks.append(digest)
+                if not os.path.exists(self.chunk_path(digest)):
+                    compressed = zlib.compress(data, 6)
+                    write_file_atomic(self.chunk_path(digest), compressed)
+                    counters["chunks"] += 1
+                    counters["bytes"] += len(compressed)
+        return {"size": size, "sha256": file_digest.hexdigest(), "chunks": chunks}
+
+    def get_chunk(self, digest):
+        """The content of a chunk. Raises ValueError if it is missing or damaged."""
+        try:
+            with open(self.chunk_path(digest), "rb") as f:
+                data = zlib.decompress(f.read())
+        except (OSError, zlib.error) as e:
+            raise ValueError(f"chunk {digest}: {e}")
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"chunk {digest}: content does not match its hash")
+        return data
+
+    def write_file(self, entry, path):
+        """Assemble a file from its chunks at `path` (through a temp file), checking its hash."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as tmp:
+            try:
+                for chunk in entry["chunks"]:
+                    data = self.get_chunk(chunk)
+                    digest.update(data)
+                    tmp.write(data)
+                if digest.hexdigest() != entry["sha256"]:
+                    raise ValueError(f"{path}: restored file does not match its hash")
+            except BaseException:
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+        os.replace(tmp.name, path)
+
+    def snapshots(self):
+        """Snapshot ids, oldest first. The ids are local times, e.g. 20250101T020000."""
+        if not os.path.isdir(self.snapshot_folder):
+            return []
+        return sorted(name[:-len(".json")] for name in os.listdir(self.snapshot_folder) if name.endswith(".json"))
+
+    def load(self, snapshot_id):
+        with open(os.path.join(self.snapshot_folder, f"{snapshot_id}.json")) as f:
+            return json.load(f)
+
+    def find(self, snapshot_id="latest", at=None):
+        """The id of a snapshot: `snapshot_id`, "latest", or the last one taken at or before `at`."""
+        snapshots = self.snapshots()
+        if at is not None:
+            snapshots = [s for s in snapshots if datetime.strptime(s, "%Y%m%dT%H%M%S") <= at]
+        elif snapshot_id != "latest":
+            snapshots = [s for s in snapshots if s == snapshot_id]
+        if not snapshots:
+            raise ValueError("No such snapshot.")
+        return snapshots[-1]
+
+    def create(self, upload_folder=UPLOAD_FOLDER):
+        """Snapshot the live database and the upload folder. Returns the manifest."""
+        started = time.perf_counter()
+        counters = {"chunks": 0, "bytes": 0}
+        with self.lock():
+            snapshots = self.snapshots()
+            previous = self.load(snapshots[-1])["uploads"] if snapshots else {}
+            with tempfile.TemporaryDirectory(dir=self.folder) as tmp:
+                copy = os.path.join(tmp, "books.sqlite")
+                snapshot_database(copy)
+                database = self.put_file(copy, counters)
+
+            uploads = {}
+            for root, dirs, files in os.walk(upload_folder):
+                # Do not back up the backups (when the store is inside the upload folder)
+                dirs[:] = [d for d in dirs if os.path.join(root, d) != self.folder]
+                for name in files:
+                    if name.endswith(".tmp"):  # unfinished upload
+                        continue
+                    path = os.path.join(root, name)
+                    key = Path(os.path.relpath(path, upload_folder)).as_posix()
+                    stat = os.stat(path)
+                    entry = previous.get(key)
+                    # Unchanged files are not read again
+                    if not (entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns):
+                        entry = dict(self.put_file(path, counters), mtime_ns=stat.st_mtime_ns)
+                    uploads[key] = entry
+
+            now = datetime.now()
+            snapshot_id = now.strftime("%Y%m%dT%H%M%S")
+            if snapshots and snapshot_id <= snapshots[-1]:
+                raise click.ClickException(f"Snapshot {snapshots[-1]} is not older than this one; try again.")
+            manifest = {
+                "id": snapshot_id,
+                "created": now.isoformat(timespec="seconds"),
+                "database": database,
+                "uploads": uploads,
+                "stats": {"new_chunks": counters["chunks"], "new_bytes": counters["bytes"],
+                          "seconds": round(time.perf_counter() - started, 2)},
+            }
+            write_file_atomic(os.path.join(self.snapshot_folder, f"{snapshot_id}.json"),
+                              json.dumps(manifest, separators=(",", ":")).encode())
+        return manifest
+
+    def restore(self, snapshot_id, database_path, upload_folder, prune=False):
+        """Write a snapshot's database and uploads. The app must be stopped."""
+        manifest = self.load(snapshot_id)
+        missing = {chunk for entry in [manifest["database"], *manifest["uploads"].values()]
+                   for chunk in entry["chunks"] if not os.path.exists(self.chunk_path(chunk))}
+        if missing:
+            raise ValueError(f"{len(missing)} chunks of snapshot {snapshot_id} are missing")
+        self.write_file(manifest["database"], database_path)
+        # A write-ahead log of the replaced database must not be applied to the restored one
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(database_path + suffix):
+                os.remove(database_path + suffix)
+        restored = 0
+        for key, entry in manifest["uploads"].items():
+            path = os.path.join(upload_folder, *key.split("/"))
+            if os.path.exists(path) and os.path.getsize(path) == entry["size"] and file_sha256(path) == entry["sha256"]:
+                continue
+            self.write_file(entry, path)
+            os.utime(path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+            restored += 1
+        removed = 0
+        if prune:
+            for root, dirs, files in os.walk(upload_folder):
+                dirs[:] = [d for d in dirs if os.path.join(root, d) != self.folder]
+                for name in files:
+                    path = os.path.join(root, name)
+                    if Path(os.path.relpath(path, upload_folder)).as_posix() not in manifest["uploads"]:
+                        os.remove(path)
+                        removed += 1
+        return restored, removed
+
+    def verify(self, snapshot_ids, deep=False):
+        """Problems found in the given snapshots: missing or damaged chunks, and with
+        `deep` a failing SQLite integrity check of the restored database."""
+        problems = []
+        checked = {}
+        for snapshot_id in snapshot_ids:
+            manifest = self.load(snapshot_id)
+            files = [("database", manifest["database"])] + list(manifest["uploads"].items())
+            for name, entry in files:
+                for chunk in entry["chunks"]:
+                    if chunk not in checked:
+                        try:
+                            self.get_chunk(chunk)
+                            checked[chunk] = None
+                        except ValueError as e:
+                            checked[chunk] = str(e)
+                    if checked[chunk]:
+                        problems.append(f"{snapshot_id} {name}: {checked[chunk]}")
+            if deep and not any(checked[chunk] for chunk in manifest["database"]["chunks"]):
+                with tempfile.TemporaryDirectory() as tmp:
+                    path = os.path.join(tmp, "books.sqlite")
+                    try:
+                        self.write_file(manifest["database"], path)
+                        with sqlite3.connect(path) as connection:
+                            result = connection.execute("PRAGMA integrity_check").fetchone()[0]
+                        if result != "ok":
+                            problems.append(f"{snapshot_id} database: integrity check: {result}")
+                    except (ValueError, sqlite3.DatabaseError) as e:
+                        problems.append(f"{snapshot_id} database: {e}")
+        return problems
+
+    def prune(self, keep):
+        """Delete all but the newest `keep` snapshots and the chunks only they used.
+
+        Returns (snapshots removed, chunks removed, bytes freed).
+        """
+        with self.lock():
+            snapshots = self.snapshots()
+            old = snapshots[:-keep] if keep else snapshots
+            for snapshot_id in old:
+                os.remove(os.path.join(self.snapshot_folder, f"{snapshot_id}.json"))
+            used = set()
+            for snapshot_id in self.snapshots():
+                manifest = self.load(snapshot_id)
+                for entry in [manifest["database"], *manifest["uploads"].values()]:
+                    used.update(entry["chunks"])
+            chunks = freed = 0
+            for root, dirs, files in os.walk(self.chunk_folder):
+                for name in files:
+                    # Unused chunks, and temp files of an interrupted backup
+                    if name not in used:
+                        path = os.path.join(root, name)
+                        freed += os.path.getsize(path)
+                        os.remove(path)
+                        chunks += 1
+        return len(old), chunks, freed
+
+def format_size(size):
+    for unit in ("B", "kB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+@bp.cli.group("backup")
+@click.option("--folder", default=BACKUP_FOLDER, show_default=True, help="Backup store.")
+@click.pass_context
+def backup_cli(ctx, folder):
+    """Incremental snapshots of the database and the uploads."""
+    ctx.meta["backup_store"] = BackupStore(folder)
+
+def backup_store():
+    return click.get_current_context().meta["backup_store"]
+
+@backup_cli.command("create")
+def backup_create():
+    """Snapshot the database (online) and the uploads, storing only what changed."""
+    manifest = backup_store().create()
+    stats = manifest["stats"]
+    click.echo(f"Snapshot {manifest['id']}: database {format_size(manifest['database']['size'])}, "
+               f"{len(manifest['uploads'])} uploaded files. Stored {stats['new_chunks']} new chunks "
+               f"({format_size(stats['new_bytes'])}) in {stats['seconds']:.1f}s.")
+
+@backup_cli.command("list")
+def backup_list():
+    """List the snapshots with their size and the data each one added."""
+    store = backup_store()
+    click.echo(f"{'snapshot':16} {'database':>10} {'files':>6} {'uploads':>10} {'added':>10} {'time':>7}")
+    for snapshot_id in store.snapshots():
+        manifest = store.load(snapshot_id)
+        stats = manifest["stats"]
+        uploads = sum(entry["size"] for entry in manifest["uploads"].values())
+        click.echo(f"{snapshot_id:16} {format_size(manifest['database']['size']):>10} {len(manifest['uploads']):6d} "
+                   f"{format_size(uploads):>10} {format_size(stats['new_bytes']):>10} {stats['seconds']:6.1f}s")
+
+@backup_cli.command("restore")
+@click.argument("snapshot", default="latest")
+@click.option("--at", "at", help="Restore the last snapshot taken at or before this ISO date/time.")
+@click.option("--database", "database_path", default=db_path, show_default=True, type=click.Path(dir_okay=False))
+@click.option("--uploads", "upload_folder", default=UPLOAD_FOLDER, show_default=True, type=click.Path(file_okay=False))
+@click.option("--prune", is_flag=True, help="Delete uploaded files that are not in the snapshot.")
+@click.option("--yes", is_flag=True, help="Do not ask for confirmation.")
+def backup_restore(snapshot, at, database_path, upload_folder, prune, yes):
+    """Restore a snapshot (default: the latest). Stop the app first."""
+    store = backup_store()
+    at_date = parse_since(at)
+    if at and at_date is None:
+        raise click.BadParameter(f"Not an ISO date: {at}")
+    try:
+        snapshot_id = store.find(snapshot, at_date)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if not yes:
+        click.confirm(f"Replace {database_path} and the files in {upload_folder} with snapshot {snapshot_id}?",
+                      abort=True)
+    try:
+        restored, removed = store.restore(snapshot_id, os.path.abspath(database_path), upload_folder, prune)
+    except ValueError as e:
+        raise click.ClickException(f"Restore failed, run `flask backup verify`: {e}")
+    click.echo(f"Restored snapshot {snapshot_id}: the database, {restored} changed uploaded files"
+               + (f", removed {removed} files" if prune else "") + ".")
+
+@backup_cli.command("verify")
+@click.argument("snapshots", nargs=-1)
+@click.option("--deep", is_flag=True, help="Also restore each database to a temp file and run an integrity check.")
+def backup_verify(snapshots, deep):
+    """Check that the chunks of the snapshots (default: all) are present and intact."""
+    store = backup_store()
+    snapshots = snapshots or store.snapshots()
+    problems = store.verify(snapshots, deep=deep)
+    for problem in problems:
+        click.echo(problem)
+    if problems:
+        raise click.ClickException(f"{len(problems)} problems found.")
+    click.echo(f"{len(snapshots)} snapshots ok.")
+
+@backup_cli.command("prune")
+@click.option("--keep", default=BACKUP_KEEP, show_default=True, help="Number of newest snapshots to keep.")
+def backup_prune(keep):
+    """Delete old snapshots and the chunks no remaining snapshot uses."""
+    snapshots, chunks, freed = backup_store().prune(keep)
+    click.echo(f"Removed {snapshots} snapshots and {chunks} chunks, freed {format_size(freed)}.")
+
+# Facets
+def split_names(value):
+    """'a, b, a' -> ['a', 'b']: the names in a comma separated authors/subjects string."""
+    return list(dict.fromkeys(part.strip() for part in (value or "").split(",") if part.strip()))
+
+def name_ids(model, names):
+    """Ids of the Author/Subject rows with these names, creating the missing ones."""
+    ids = {}
+    for chunk in range(0, len(names), 500):
+        part = names[chunk:chunk + 500]
+        ids.update({name: id for id, name in db.session.query(model.id, model.name).filter(model.name.in_(part))})
+    missing = [name for name in names if name not in ids]
+    if missing:
+        db.session.execute(db.insert(model), [{"name": name} for name in missing])
+        for chunk in range(0, len(missing), 500):
+            part = missing[chunk:chunk + 500]
+            ids.update({name: id for id, name in db.session.query(model.id, model.name).filter(model.name.in_(part))})
+    return ids
+
+def drop_book_facets(book_ids):
+    db.session.execute(book_author.delete().where(book_author.c.book_id.in_(book_ids)))
+    db.session.execute(book_subject.delete().where(book_subject.c.book_id.in_(book_ids)))
+
+def sync_book_facets(books):
+    """Rewrite the author/subject links of `books` from their Book.authors/Book.subjects strings.
+
+    Runs in the caller's transaction; the books must have ids (flush first).
+    """
+    books = [book for book in books if book.id is not None]
+    if not books:
+        return
+    drop_book_facets([book.id for book in books])
+    for model, table, column, attribute in ((Author, book_author, "author_id", "authors"),
+                                            (Subject, book_subject, "subject_id", "subjects")):
+        names = {book.id: split_names(getattr(book, attribute)) for book in books}
+        ids = name_ids(model, list(dict.fromkeys(name for book_names in names.values() for name in book_names)))
+        links = [{"book_id": book_id, column: ids[name]} for book_id, book_names in names.items() for name in book_names]
+        if links:
+            db.session.execute(table.insert(), links)
+
+@bp.cli.command("rebuild-facets")
+def rebuild_facets():
+    """Fill the author/subject tables from all books, e.g. after the migration that adds them."""
+    total = 0
+    last_id = 0
+    while True:
+        books = Book.query.filter(Book.id > last_id).order_by(Book.id).limit(1000).all()
+        if not books:
+            break
+        sync_book_facets(books)
+        db.session.commit()
+        total += len(books)
+        last_id = books[-1].id
+    # Author/subject filters of cached index pages may have changed
+    bump_version("catalogue")
+    if suggest_log_exists(db.session.connection()):
+        log_suggest_changes(db.session.connection(), [])
+    db.session.commit()
+    click.echo(f"Indexed authors and subjects of {total} books.")
+
+FACET_TABLES = {
+    "authors": (Author, book_author, book_author.c.author_id),
+    "subjects": (Subject, book_subject, book_subject.c.subject_id),
+}
+
+def filter_books(query, author=None, subject=None, location=None):
+    """Narrow a Book query to one author / subject (by exact name) and/or location id."""
+    if author:
+        query = query.filter(Book.id.in_(
+            db.select(book_author.c.book_id).join(Author, Author.id == book_author.c.author_id)
+            .where(Author.name == author)))
+    if subject:
+        query = query.filter(Book.id.in_(
+            db.select(book_subject.c.book_id).join(Subject, Subject.id == book_subject.c.subject_id)
+            .where(Subject.name == subject)))
+    if location:
+        query = query.filter(Book.location == location)
+    return query
+
+def facet_counts(facet, filters, prefix=None, limit=50):
+    """[(id, name, count)] for the authors / subjects / locations of the books matching `filters`, largest first."""
+    if facet == "locations":
+        query = (db.session.query(Location.id, Location.label_name, db.func.count(Book.id))
+                 .join(Book, Book.location == Location.id))
+        if prefix:
+            query = query.filter(Location.label_name.startswith(prefix))
+        query = query.group_by(Location.id)
     else:
-        result = (sum(int(ch) for ch in isbn[::2]) + sum(int(ch) * 3 for ch in isbn[1::2]))
-        return result % 10 == 0
+        model, table, column = FACET_TABLES[facet]
+        query = (db.session.query(model.id, model.name, db.func.count(table.c.book_id))
+                 .select_from(table).join(model, model.id == column))
+        if prefix:
+            query = query.filter(model.name.startswith(prefix))
+        if any(filters.values()):
+            query = query.filter(table.c.book_id.in_(filter_books(db.session.query(Book.id), **filters)))
+        query = query.group_by(column)
+    if facet == "locations" and any(filters.values()):
+        query = filter_books(query, **filters)
+    return query.order_by(db.func.count().desc()).limit(limit).all()
+
+def book_search_query(s=None, filters=None, similarity=None):
+    """(Book, Location) rows matching the search term and facet filters, unordered.
+
+    Returns (query, fts_hits); fts_hits is the subquery of the search hits
+    (with a `rank` column, lower is better) when an index was used, else None.
+    similarity is the threshold of the typo-tolerant search (default
+    SEARCH_SIMILARITY, 0: off).
+    """
+    # Create the query to select books
+    query = db.session.query(Book, Location).join(Location, Book.location == Location.id)
+    query = filter_books(query, **(filters or {}))
+    # Search the FTS5 index when available. It matches every word as a prefix
+    # and ranks the hits with bm25. Books whose document matches are found
+    # too, each book ranked by its best hit. Books with words similar to the
+    # search words (typos) follow the exact hits.
+    fts_hits = None
+    hits, params = [], {}
+    match = fts_match_query(s) if s else ""
+    if match and fts_available():
+        hits.append(f"SELECT rowid AS book_id, {FTS_RANK} AS rank FROM book_fts WHERE book_fts MATCH :match")
+        if document_index_available():
+            hits.append(DOCUMENT_HITS)
+        params["match"] = match
+    similarity = SEARCH_SIMILARITY if similarity is None else similarity
+    words = similarity_words(s) if s and similarity > 0 else []
+    if words and trigram_available():
+        hits.append(TRIGRAM_HITS)
+        params.update(words=json.dumps([word_trigrams(word) for word in words]), similarity=min(similarity, 1.0))
+    if hits:
+        if len(hits) > 1:
+            hits = [f"SELECT book_id, min(rank) AS rank FROM ({' UNION ALL '.join(hits)}) GROUP BY book_id"]
+        fts_hits = (
+            db.text(hits[0])
+            .bindparams(**params)
+            .columns(book_id=db.Integer, rank=db.Float)
+            .subquery("fts_hits")
+        )
+        query = query.join(fts_hits, fts_hits.c.book_id == Book.id)
+    # Otherwise fall back to fuzzy filtering if a search term is provided
+    # Use ilike method instead of contains. The ilike method allows for pattern
+    # matching with wildcards, which can be used to create a more flexible,
+    # fuzzy search.
+    elif s:
+        search_pattern = f"%{s}%"
+        query = query.filter(
+            or_(
+                Book.title.ilike(search_pattern),
+                Book.authors.ilike(search_pattern),
+                Book.subjects.ilike(search_pattern),
+                Book.isbn.ilike(search_pattern),
+            )
+        )
+    return query, fts_hits
+
+# Duplicate detection
+# Books without an ISBN (e.g. converted from the old MDB) may be in the
+# catalogue twice, spelled a little differently. Rather than comparing every
+# pair of books, candidate pairs come from
+# - a blocking key: the same words in the title and authors, in any order
+# - MinHash/LSH: the signature of a book is the minimum of each of
+#   DEDUP_HASHES hash functions over the character trigrams of its title and
+#   authors. Two books agree on a value with a probability equal to the
+#   Jaccard index of their trigrams, so books agreeing on a whole band of
+#   DEDUP_BAND values are likely similar (16 bands of 4 find 9 of 10 pairs at 0.6).
+# Each book of a bucket is compared with the first one only, and the pairs
+# above the threshold are joined into clusters, so the work grows linearly
+# with the catalogue.
+DEDUP_HASHES = 64
+DEDUP_BAND = 4
+# (a, b) of the hash functions ((a * x + b) mod 2^64) >> 32, fixed so runs agree
+_dedup_random = random.Random(0)
+DEDUP_COEFFICIENTS = [(_dedup_random.getrandbits(64) | 1, _dedup_random.getrandbits(64)) for _ in range(DEDUP_HASHES)]
+# Fields of a merged duplicate that fill the empty ones of the book kept
+MERGE_FIELDS = ["isbn", "publish_date", "subjects", "number_of_pages", "openlibrary_medcover_url",
+                "openlibrary_preview_url", "document_path"]
+# Clusters shown on the duplicates page
+DUPLICATES_PER_PAGE = 100
+
+def dedup_text(text):
+    """`text` as folded words, the form books are compared in."""
+    return " ".join(re.findall(r"\w+", fold_text(text)))
+
+def dedup_shingles(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)} or {text}
+
+def book_similarity(a, b):
+    """Similarity of two books as (title, authors) dedup texts: the lower Jaccard index of their trigrams.
+
+    Both must match, so neither a common title nor a prolific author alone
+    makes a duplicate. Titles with different numbers (volumes, years) are
+    different books.
+    """
+    if re.findall(r"\d+", a[0]) != re.findall(r"\d+", b[0]):
+        return 0.0
+    return min(len(x & y) / len(x | y) if x or y else 1.0
+               for x, y in ((dedup_shingles(a[0]), dedup_shingles(b[0])),
+                            (dedup_shingles(a[1]) if a[1] else set(), dedup_shingles(b[1]) if b[1] else set())))
+
+def minhash_signatures(texts):
+    """MinHash signatures of `texts`, DEDUP_HASHES values per text, in one array."""
+    hashes = {}
+    signatures = array("I")
+    for text in texts:
+        rows = []
+        for shingle in dedup_shingles(text):
+            row = hashes.get(shingle)
+            if row is None:
+                x = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "little")
+                row = hashes[shingle] = tuple(((a * x + b) & 0xFFFFFFFFFFFFFFFF) >> 32 for a, b in DEDUP_COEFFICIENTS)
+            rows.append(row)
+        signatures.extend(map(min, zip(*rows)))
+    return signatures
+
+def find_duplicates(threshold=DEDUP_THRESHOLD):
+    """Clusters of probable duplicates, as [[(book id, similarity, matched id), ...]], the most similar clusters first.
+
+    A cluster starts with its oldest book, with similarity 1.0 and matched id
+    None. Every other book was joined through one pair: its similarity is
+    book_similarity with the book `matched id` of that pair, so it is never
+    below the threshold, while two books of a chain can be less similar.
+    Books with different ISBN-13s are different editions and never end up in
+    one cluster.
+    """
+    ids, books, isbn13s = [], [], []
+    for book_id, title, authors, isbn13 in db.session.execute(
+            db.select(Book.id, Book.title, Book.authors, Book.isbn13).order_by(Book.id)):
+        # Authors as sorted words: "Simpson, Joe" is "Joe Simpson"
+        book = (dedup_text(title), " ".join(sorted(dedup_text(authors).split())))
+        if book[0]:
+            ids.append(book_id)
+            books.append(book)
+            isbn13s.append(isbn13)
+    signatures = minhash_signatures(f"{title} {authors}" for title, authors in books)
+    parent = list(range(len(ids)))
+    # ISBN-13 of each cluster, by its root
+    cluster_isbn13s = list(isbn13s)
+    links = {}
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def join(i, j, estimate=True):
+        a, b = root(i), root(j)
+        if a == b or (cluster_isbn13s[a] and cluster_isbn13s[b] and cluster_isbn13s[a] != cluster_isbn13s[b]):
+            return
+        # Share of equal signature values: the estimated Jaccard index of the
+        # whole text, a cheap filter before the exact comparison
+        if estimate and sum(map(int.__eq__, signatures[i * DEDUP_HASHES:(i + 1) * DEDUP_HASHES],
+                                signatures[j * DEDUP_HASHES:(j + 1) * DEDUP_HASHES])) < threshold * DEDUP_HASHES:
+            return
+        similarity = book_similarity(books[i], books[j])
+        if similarity >= threshold:
+            parent[b] = a
+            cluster_isbn13s[a] = cluster_isbn13s[a] or cluster_isbn13s[b]
+            links.setdefault(i, []).append((j, similarity))
+            links.setdefault(j, []).append((i, similarity))
+
+    first = {}
+    for i, (title, authors) in enumerate(books):
+        j = first.setdefault(" ".join(sorted(set(f"{title} {authors}".split()))), i)
+        if j != i:
+            join(j, i, estimate=False)
+    for band in range(0, DEDUP_HASHES, DEDUP_BAND):
+        first = {}
+        for i in range(len(ids)):
+            start = i * DEDUP_HASHES + band
+            j = first.setdefault(signatures[start:start + DEDUP_BAND].tobytes(), i)
+            if j != i:
+                join(j, i)
+
+    members = {}
+    for i in range(len(ids)):
+        members.setdefault(root(i), []).append(i)
+    clusters = []
+    for cluster in members.values():
+        if len(cluster) < 2:
+            continue
+        # The joined pairs form a tree; walk it from the oldest book
+        matched = {cluster[0]: (1.0, None)}
+        queue = [cluster[0]]
+        for i in queue:
+            for j, similarity in links[i]:
+                if j not in matched:
+                    matched[j] = (similarity, ids[i])
+                    queue.append(j)
+        clusters.append([(ids[i], *matched[i]) for i in cluster])
+    clusters.sort(key=lambda cluster: (-sum(s for _, s, _ in cluster[1:]) / (len(cluster) - 1), cluster[0][0]))
+    return clusters
+
+def merge_books(keep, duplicates):
+    """Merge the books `duplicates` into the book `keep`, and commit.
+
+    Empty fields of `keep` are filled from the duplicates (MERGE_FIELDS), and
+    the duplicates are deleted. Each gets a MERGE log entry with its details,
+    which restore_book can restore like a DELETE; `keep` gets an EDIT entry.
+    """
+    filled = {}
+    for duplicate in duplicates:
+        for field in MERGE_FIELDS:
+            if not getattr(keep, field) and field not in filled and getattr(duplicate, field):
+                filled[field] = getattr(duplicate, field)
+    for duplicate in duplicates:
+        db.session.add(TransactionLog(
+            action="MERGE",
+            book_id=duplicate.id,
+            book_title=f"{duplicate.authors} - {duplicate.title}",
+            details=book_log_details(duplicate, format_location_label(location_registry.get(duplicate.location)),
+                                     merged_into=keep.id),
+        ))
+    drop_book_facets([duplicate.id for duplicate in duplicates])
+    for duplicate in duplicates:
+        db.session.delete(duplicate)
+    db.session.flush()  # frees the ISBN of a duplicate for the kept book
+    for field, value in filled.items():
+        setattr(keep, field, value)
+    sync_book_facets([keep])
+    db.session.add(TransactionLog(
+        action="EDIT",
+        book_id=keep.id,
+        book_title=f"{keep.authors} - {keep.title}",
+        details=f"Merged duplicates {', '.join(f'#{duplicate.id}' for duplicate in duplicates)}"
+                + (f"; filled in {', '.join(filled)}" if filled else ""),
+    ))
+    db.session.commit()
+    # The document of a duplicate is deleted unless it moved to the kept book
+    for duplicate in duplicates:
+        release_document(duplicate.document_path)
+
+@bp.cli.command("find-duplicates")
+@click.option("--threshold", default=DEDUP_THRESHOLD, show_default=True,
+              help="Similarity (0..1) of title and authors from which books are listed.")
+@click.option("--merge", is_flag=True, help="Ask for each cluster whether to merge it into its oldest book.")
+def find_duplicates_command(threshold, merge):
+    """List clusters of probable duplicate books, with the similarity to the book each was matched with."""
+    started = time.perf_counter()
+    clusters = find_duplicates(threshold)
+    click.echo(f"{len(clusters)} clusters in {Book.query.count()} books ({time.perf_counter() - started:.1f}s)")
+    for cluster in clusters:
+        books = {book.id: book for book in Book.query.filter(Book.id.in_([book_id for book_id, _, _ in cluster]))}
+        click.echo("")
+        for book_id, similarity, matched_id in cluster:
+            book = books[book_id]
+            matched = f"{similarity:4.2f} to #{matched_id:<6}" if matched_id else " " * 15
+            click.echo(f"  {matched}  #{book.id:<6} {book.title} / {book.authors} [{book.isbn or '-'}]")
+        if merge and click.confirm(f"Merge into #{cluster[0][0]}?", default=False):
+            merge_books(books[cluster[0][0]], [books[book_id] for book_id, _, _ in cluster[1:]])
+
+
+# Static assets
+CSS_URL = re.compile(r"""url\(\s*(["']?)([^"')]+)\1\s*\)""")
+
+def asset_name(name, data):
+    """`name` with the content hash of `data` before its extension: main.css -> main.1a2b3c4d.css."""
+    stem, ext = posixpath.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:8]}{ext}"
+
+def rewrite_css_urls(css, name, manifest):
+    """Point the url() references of the stylesheet `name` at the built files, as in `manifest`."""
+    def replace(match):
+        quote, url = match.groups()
+        if re.match(r"[a-z]+:|/|#", url):  # data:, absolute and fragment-only URLs
+            return match.group(0)
+        path, suffix = re.match(r"([^?#]*)(.*)", url).groups()
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(name), path))
+        if target not in manifest:
+            return match.group(0)
+        built = posixpath.relpath(manifest[target], posixpath.dirname(manifest[name]))
+        return f"url({quote}{built}{suffix}{quote})"
+    return CSS_URL.sub(replace, css)
+
+def build_assets():
+    """Build static/build from static/dist and return the manifest, {"dist/<file>": "build/<hashed file>"}.
+
+    Every file is copied with its content hash in the name; stylesheets refer
+    to the hashed names of the images they use. Text files also get .gz and,
+    when brotli is installed, .br siblings, sent to browsers that accept them.
+    Needs no app or config, so it can run while building the docker image.
+    """
+    source = os.path.join(STATIC_FOLDER, ASSET_SOURCE)
+    target = os.path.join(STATIC_FOLDER, ASSET_BUILD)
+    brotli = optional_import("brotli")
+    names = sorted(posixpath.join(ASSET_SOURCE, Path(os.path.relpath(os.path.join(folder, file), source)).as_posix())
+                   for folder, _, files in os.walk(source) for file in files)
+    shutil.rmtree(target, ignore_errors=True)
+    manifest = {}
+    # Stylesheets last, as they refer to the other files
+    for name in sorted(names, key=lambda name: name.endswith(".css")):
+        with open(os.path.join(STATIC_FOLDER, name), "rb") as f:
+            data = f.read()
+        built = posixpath.join(ASSET_BUILD, posixpath.relpath(name, ASSET_SOURCE))
+        if name.endswith(".css"):
+            manifest[name] = built  # the folder, for the relative references
+            data = rewrite_css_urls(data.decode(), name, manifest).encode()
+        manifest[name] = asset_name(built, data)
+        path = os.path.join(STATIC_FOLDER, manifest[name])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        if not name.endswith(ASSET_COMPRESS):
+            continue
+        variants = {".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants[".br"] = brotli.compress(data, quality=11)
+        for suffix, compressed in variants.items():
+            if len(compressed) < len(data):
+                with open(path + suffix, "wb") as f:
+                    f.write(compressed)
+    with open(os.path.join(target, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    asset_manifest.cache_clear()
+    return manifest
+
+@cache
+def asset_manifest():
+    """The manifest of the last `flask build-assets`; empty when the assets are not built."""
+    try:
+        with open(os.path.join(STATIC_FOLDER, ASSET_BUILD, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+@bp.app_template_global()
+def asset_url(filename):
+    """url_for("static", filename=...) of the built, hashed file when there is one, else of the file itself."""
+    return url_for("static", filename=asset_manifest().get(filename, filename))
+
+def static_file(filename):
+    """The static view. Built files are cached by browsers for good, and sent precompressed when accepted."""
+    if not filename.startswith(f"{ASSET_BUILD}/") or filename.endswith(("manifest.json", ".gz", ".br")):
+        return current_app.send_static_file(filename)
+    path = safe_join(STATIC_FOLDER, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    encoding = next((encoding for encoding, suffix in ASSET_ENCODINGS
+                     if request.accept_encodings[encoding] and os.path.isfile(path + suffix)), None)
+    response = send_file(path + dict(ASSET_ENCODINGS)[encoding] if encoding else path, mimetype=mimetype,
+                         max_age=ASSET_MAX_AGE, conditional=True)
+    if encoding:
+        response.content_encoding = encoding
+    if os.path.isfile(path + ".gz"):
+        response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@bp.cli.command("build-assets")
+def build_assets_command():
+    """Copy static/dist to static/build with hashed names and precompressed variants."""
+    manifest = build_assets()
+    built = [os.path.join(STATIC_FOLDER, name) for name in manifest.values()]
+    click.echo(f"Built {len(manifest)} files in {os.path.join(STATIC_FOLDER, ASSET_BUILD)}.")
+    for encoding, suffix in ASSET_ENCODINGS:
+        compressed = [path for path in built if os.path.isfile(path + suffix)]
+        if compressed:
+            click.echo(f"{encoding}: {len(compressed)} files, {sum(map(os.path.getsize, compressed))} -> "
+                       f"{sum(os.path.getsize(path + suffix) for path in compressed)} bytes")
+    if optional_import("brotli") is None:
+        click.echo("Install brotli (pip install brotli) for smaller .br variants.")
+    click.echo("Restart the app to use the new files.")
+
+
+# Query plans
+def query_plan(query):
+    """The EXPLAIN QUERY PLAN lines (SQLite) of an ORM query or select()."""
+    statement = getattr(query, "statement", query)
+    compiled = statement.compile(dialect=db.engine.dialect)
+    params = compiled.construct_params()
+    args = tuple(params[name] for name in compiled.positiontup)
+    rows = db.session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", args).all()
+    return [row[-1] for row in rows]
+
+def hot_queries():
+    """The queries behind the busiest routes, as {name: (query, may_sort)}.
+
+    may_sort marks queries where a temp b-tree sort is expected (bm25 ranking
+    can only be sorted after matching).
+    """
+    queries = {
+        "add_book: duplicate ISBN": (Book.query.filter_by(isbn13="9780306406157"), False),
+        "edit_book: duplicate ISBN": (Book.query.filter(Book.isbn13 == "9780306406157", Book.id != 1), False),
+        "detail: book": (Book.query.filter_by(id=1), False),
+        "log entries of a book": (TransactionLog.query.filter_by(book_id=1), False),
+        "release_document: books of a document": (
+            db.session.query(Book.id).filter(Book.document_path == "documents/ab/ab.pdf"), False),
+    }
+    log_key = (db.type_coerce(TransactionLog.timestamp, db.String), TransactionLog.id)
+    queries["view_logs: first page"] = (
+        TransactionLog.query.order_by(log_key[0].desc(), log_key[1].desc()).limit(LOGS_PER_PAGE), False)
+    queries["view_logs: cursor page"] = (
+        TransactionLog.query.filter(tuple_(*log_key) < tuple_("2025-01-01 00:00:00", 100))
+        .order_by(log_key[0].desc(), log_key[1].desc()).limit(LOGS_PER_PAGE), False)
+    for sort_by, sort_key in BOOK_SORT_KEYS.items():
+        query, _ = book_search_query()
+        for order in (asc, desc):
+            queries[f"index: sort by {sort_by} {order.__name__}"] = (
+                query.order_by(order(sort_key), order(Book.id)).limit(PAGINATE_BY_HOWMANY), False)
+        queries[f"index: sort by {sort_by}, cursor page"] = (
+            query.filter(tuple_(sort_key, Book.id) > tuple_("m" if sort_by != "location" else 1, 100))
+            .order_by(sort_key, Book.id).limit(PAGINATE_BY_HOWMANY), False)
+    query, fts_hits = book_search_query("rock climb", similarity=0)
+    if fts_hits is not None:
+        queries["index: search by relevance"] = (
+            query.order_by(fts_hits.c.rank, Book.id).limit(PAGINATE_BY_HOWMANY), True)
+    query, fts_hits = book_search_query("mountian climbnig", similarity=SEARCH_SIMILARITY or 0.3)
+    if fts_hits is not None:
+        queries["index: typo-tolerant search"] = (
+            query.order_by(fts_hits.c.rank, Book.id).limit(PAGINATE_BY_HOWMANY), True)
+    query, _ = book_search_query(filters={"author": "Reinhold Messner"})
+    queries["index: books by author"] = (
+        query.order_by(BOOK_SORT_KEYS["title"], Book.id).limit(PAGINATE_BY_HOWMANY), True)
+    return queries
+
+def bad_plan_lines(plan, may_sort=False):
+    """The lines of a query plan that scan a whole table, or sort one unless `may_sort`."""
+    # Scanning the rows a subquery produced (e.g. the search hits) is fine
+    subqueries = {line.split(" ", 1)[1] for line in plan if line.startswith(("MATERIALIZE ", "CO-ROUTINE "))}
+    return [line for line in plan
+            if (line.startswith("SCAN") and " USING " not in line and "VIRTUAL TABLE" not in line
+                and line[len("SCAN "):] not in subqueries)
+            or ("TEMP B-TREE" in line and not may_sort)]
+
+@bp.cli.command("explain-queries")
+def explain_queries():
+    """Check that the hot queries use indexes: no full table scans, no sorting of whole tables.
+
+    Prints every plan and exits non-zero on a failure, so it can run in CI.
+    """
+    if db.engine.dialect.name != "sqlite":
+        raise click.ClickException("Query plans are only checked for SQLite.")
+    init_sort_indexes()
+    init_search_index()
+    init_trigram_index()
+    failures = 0
+    for name, (query, may_sort) in hot_queries().items():
+        plan = query_plan(query)
+        bad = bad_plan_lines(plan, may_sort)
+        failures += bool(bad)
+        click.echo(f"{'FAIL' if bad else 'ok'}  {name}")
+        for line in plan:
+            click.echo(f"      {'!' if line in bad else ' '} {line}")
+    if failures:
+        raise click.ClickException(f"{failures} queries do not use an index.")
+
+# Load test workload: the book list, instant search, and an edit with its log entry
+LOAD_TEST_READS = [
+    ("SELECT book.*, location.label_name FROM book JOIN location ON book.location = location.id "
+     "ORDER BY coalesce(book.title, '') COLLATE NOCASE, book.id LIMIT 50 OFFSET ?",
+     lambda rng, n: (rng.randrange(max(n - 50, 1)),)),
+    ("SELECT book.*, location.label_name FROM book JOIN location ON book.location = location.id "
+     "WHERE book.title LIKE ? OR book.authors LIKE ? LIMIT 50",
+     lambda rng, n: (f"%{rng.choice('aeiou')}{rng.choice('nrst')}%",) * 2),
+]
+
+def load_test_worker(path, pragmas, write, deadline, latencies, errors, seed):
+    """Run reads (or edits) against `path` until `deadline`, recording latencies in seconds."""
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    if pragmas:
+        apply_sqlite_pragmas(connection, pragmas)
+    book_ids = [row[0] for row in connection.execute("SELECT id FROM book")]
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if write:
+                book_id = rng.choice(book_ids)
+                connection.execute("UPDATE book SET title = title WHERE id = ?", (book_id,))
+                connection.execute(
+                    "INSERT INTO transaction_log (timestamp, action, book_id, book_title, details) "
+                    "VALUES (CURRENT_TIMESTAMP, 'EDIT', ?, 'load test', '{}')", (book_id,))
+                connection.commit()
+            else:
+                sql, params = rng.choice(LOAD_TEST_READS)
+                connection.execute(sql, params(rng, len(book_ids))).fetchall()
+        except sqlite3.OperationalError as e:
+            connection.rollback()
+            errors.append(str(e))
+            continue
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+@bp.cli.command("load-test")
+@click.option("--seconds", default=10.0, show_default=True)
+@click.option("--readers", default=8, show_default=True, help="Concurrent reading connections.")
+@click.option("--writers", default=2, show_default=True, help="Concurrent writing connections.")
+@click.option("--baseline", is_flag=True, help="Use SQLite defaults instead of the [database] settings.")
+def load_test(seconds, readers, writers, baseline):
+    """Concurrent read/write load test against a copy of the catalogue.
+
+    Every reader and writer has its own connection, like gunicorn workers do.
+    Run it once with --baseline and once without to compare the settings.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "books.sqlite")
+        snapshot_database(path)
+        with sqlite3.connect(path) as connection:
+            # The copy keeps the journal mode of the live database
+            connection.execute("PRAGMA journal_mode = DELETE" if baseline else
+                               f"PRAGMA journal_mode = {SQLITE_PRAGMAS['journal_mode'] or 'DELETE'}")
+        pragmas = None if baseline else SQLITE_PRAGMAS
+        results = {"read": ([], []), "write": ([], [])}
+        deadline = time.perf_counter() + seconds
+        threads = [
+            threading.Thread(target=load_test_worker,
+                             args=(path, pragmas, kind == "write", deadline, *results[kind], i))
+            for i, kind in enumerate(["read"] * readers + ["write"] * writers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    click.echo("SQLite defaults" if baseline else
+               "Settings: " + ", ".join(f"{k}={v}" for k, v in SQLITE_PRAGMAS.items() if v))
+    click.echo(f"{'':6} {'ops':>7} {'ops/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for kind, (latencies, errors) in results.items():
+        click.echo(f"{kind:6} {len(latencies):7d} {len(latencies) / seconds:8.1f} "
+                   f"{percentile(latencies, 0.5) * 1000:8.2f} {percentile(latencies, 0.99) * 1000:8.2f} "
+                   f"{len(errors):7d}")
+        for message, count in sorted({m: errors.count(m) for m in errors}.items()):
+            click.echo(f"       {count} x {message}")
 
 def login_required():
     """Redirects to login page if user is not logged in."""
     if not session.get("logged_in"):
         flash("You must be logged in to perform this action.", "danger")
-        return redirect(url_for("login"))
+        return redirect(url_for("library.login"))
     return None
 
 
-@app.errorhandler(RequestEntityTooLarge)
+@bp.app_errorhandler(RequestEntityTooLarge)
 def handle_large_file(error):
     flash(f"File size exceeds the maximum limit of {MAX_UPLOAD_SIZE / 1024 / 1024} MB.", "danger")
-    return redirect(url_for("add_book"))
+    return redirect(url_for("library.add_book"))
 
 # routes
-@app.route("/index")
-@app.route("/")
+@bp.route("/index")
+@bp.route("/")
 def home():
-    return redirect(url_for("index", page=1))
+    return redirect(url_for("library.index", page=1))
 
-@app.route("/howto")
+@bp.route("/howto")
 def howto():
     # Fetch all locations to display
-    locations = Location.query.order_by(Location.label_name).all()
-    return render_template("howto.html", locations=locations)
+    return render_template("howto.html", locations=location_registry.all())
 
 
-@app.route("/add_book", methods=["GET", "POST"])
+@bp.route("/add_book", methods=["GET", "POST"])
 def add_book():
     """Add a new book to the system by entering ISBN or manually filling fields."""
     auth_redirect = login_required()
     if auth_redirect:
         return auth_redirect
 
-    # Fetch locations from the database (or use predefined list if necessary)
-    locations = Location.query.order_by("label_name").all()
-    location_choices = [(l.id, f"{l.label_name}, {l.full_name}") for l in locations]  # Populate choices dynamically
+    location_choices = location_registry.choices()
     location_form = LocationForm()
     # Pre-fill location choices
     location_form.location.choices = location_choices + [(-1, u"-- Add the correct location --")]
@@ -302,12 +3316,13 @@ def add_book():
 
         elif "submit_book" in request.form:  # Handle form submission
 
-           # Check if the book already exists by ISBN
-            isbn = request.form.get("isbn")
-            existing_book = Book.query.filter_by(isbn=isbn).first()
-            if existing_book and isbn != "":
+           # Check if the book already exists by ISBN, in any notation
+            isbn = request.form.get("isbn", "")
+            isbn13 = normalize_isbn(isbn)
+            existing_book = Book.query.filter_by(isbn13=isbn13).first() if isbn13 else None
+            if existing_book:
                 flash(f"This book with ISBN {isbn} already exists in the system. Redirecting to its details page.", "info")
-                return redirect(url_for("detail", id=existing_book.id))  # Redirect to the existing book's detail page
+                return redirect(url_for("library.detail", id=existing_book.id))  # Redirect to the existing book's detail page
 
             title=request.form.get("title", "").strip()
             authors=request.form.get("authors", "").strip()
@@ -316,30 +3331,18 @@ def add_book():
             location_id = int(location_id) if location_id and location_id != "-1" else None
             if not title or not authors or not location_id:
                 flash("Title, Authors, and Location are required fields!", "danger")
-                return redirect(url_for('add_book'))
+                return redirect(url_for('library.add_book'))
 
-            # Handle file upload
+            # Handle file upload: streamed into the document store, which
+            # checks the size and type while copying
             document_path = None
-            if 'document' in request.files:
-                file = request.files['document']
-                print(file)
-                if file and allowed_file(file.filename):
-                    # Even though Flask will reject files larger than
-                    # MAX_UPLOAD_SIZE, it's a good practice to validate the file
-                    # size
-                    file.seek(0, os.SEEK_END)  # Move to the end of the file
-                    file_size = file.tell()  # Get the file size in bytes
-                    file.seek(0)  # Reset the file pointer to the beginning
-
-                    if file_size > MAX_UPLOAD_SIZE:
-                        flash("add_book: File size exceeds the maximum limit of MB.", "danger")
-                        return redirect(url_for('add_book'))
-
-                    # sanitizes the filename to make it safe for storage.
-                    filename = secure_filename(file.filename)
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    document_path = file_path
+            file = request.files.get('document')
+            if file and allowed_file(file.filename):
+                try:
+                    document_path = store_document(file.stream)
+                except ValueError as e:
+                    flash(f"add_book: {e}", "danger")
+                    return redirect(url_for('library.add_book'))
 
             # Save the book to the database
             book = Book(
@@ -360,38 +3363,87 @@ def add_book():
             db.session.add(book)
             db.session.commit()
 
+            sync_book_facets([book])
+            queue_document_index(document_path)
+
             # Store all book details in JSON format
-            location = Location.query.get(book.location)
-            location_label = f"{location.label_name}, {location.full_name}" if location else "Unknown"
-            book_data = {
-                "isbn": book.isbn,
-                "title": book.title,
-                "authors": book.authors,
-                "publish_date": book.publish_date,
-                "subjects": book.subjects,
-                "pages": book.number_of_pages,
-                "openlibrary_preview_url": book.openlibrary_preview_url,
-                "thumbnail": book.openlibrary_medcover_url,
-                "location_id": book.location,
-                "location_label": location_label,
-                "document_path": book.document_path,
-            }
             transaction = TransactionLog(
                 action="ADD",
                 book_id=book.id,
                 book_title=f"{book.authors} - {book.title}",
-                details=json.dumps(book_data)
+                details=book_log_details(book, format_location_label(location_registry.get(book.location)))
             )
             db.session.add(transaction)
             db.session.commit()
 
-            return redirect(url_for("detail", id=book.id))
+            return redirect(url_for("library.detail", id=book.id))
 
     # locations = LibraryLocation.query.all()  # Fetch available library locations
     return render_template("add_book.html", location_form=location_form)
 
 
-@app.route("/edit_book/<int:id>", methods=["GET", "POST"])
+@bp.route("/import_books", methods=["GET", "POST"])
+def import_books():
+    """Bulk import from an uploaded CSV / ISBN list. The import runs in a background thread."""
+    auth_redirect = login_required()
+    if auth_redirect:
+        return auth_redirect
+
+    os.makedirs(IMPORT_FOLDER, exist_ok=True)
+    locations = location_registry.all()
+
+    if request.method == "POST":
+        location_id = request.form.get("location", type=int)
+        if "resume_import" in request.form:
+            name = secure_filename(request.form.get("name", ""))
+            path = os.path.join(IMPORT_FOLDER, name)
+            checkpoint = read_checkpoint(f"{path}.checkpoint") or {}
+            location_id = checkpoint.get("location_id")
+            if not name or not os.path.exists(path):
+                flash("Import not found.", "danger")
+                return redirect(url_for("library.import_books"))
+        else:
+            file = request.files.get("isbn_file")
+            text = request.form.get("isbns", "").strip()
+            if not (file and file.filename) and not text:
+                flash("Upload a file or paste a list of ISBNs.", "danger")
+                return redirect(url_for("library.import_books"))
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{secure_filename(file.filename) if file and file.filename else 'pasted.txt'}"
+            path = os.path.join(IMPORT_FOLDER, name)
+            if file and file.filename:
+                file.save(path)
+            else:
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(text + "\n")
+            write_checkpoint(f"{path}.checkpoint", {
+                "line": 0, "added": 0, "duplicates": 0, "invalid": 0, "not_found": [], "done": False,
+                "location_id": location_id,
+            })
+
+        app = current_app._get_current_object()
+
+        def run_import():
+            with app.app_context():
+                try:
+                    with open(path, newline="", encoding="utf-8-sig") as f:
+                        import_isbns(iter_import_rows(f), location_id, f"{path}.checkpoint")
+                except Exception:
+                    current_app.logger.exception(f"Import of {name} failed")
+
+        threading.Thread(target=run_import, name=f"import-{name}", daemon=True).start()
+        flash(f"Import of {name} started. Reload this page to follow its progress.", "info")
+        return redirect(url_for("library.import_books"))
+
+    # Progress of recent imports, newest first
+    imports = []
+    for name in sorted(os.listdir(IMPORT_FOLDER), reverse=True):
+        if name.endswith(".checkpoint") or name.endswith(".tmp"):
+            continue
+        imports.append((name, read_checkpoint(os.path.join(IMPORT_FOLDER, f"{name}.checkpoint")) or {}))
+    return render_template("import_books.html", locations=locations, imports=imports[:20])
+
+
+@bp.route("/edit_book/<int:id>", methods=["GET", "POST"])
 def edit_book(id):
     """Edit an existing book's details with an ISBN search option."""
    # Check if user is logged in
@@ -402,11 +3454,9 @@ def edit_book(id):
     book = Book.query.get(id)
     if book is None:
         flash(f"Book with ID {id} does not exist.", "danger")
-        return redirect(url_for("index", page=1))
+        return redirect(url_for("library.index", page=1))
 
-    # Fetch available locations
-    locations = Location.query.order_by("label_name").all()
-    location_choices = [(l.id, f"{l.label_name}, {l.full_name}") for l in locations]
+    location_choices = location_registry.choices()
 
     if request.method == "POST":
         # Fetch book details by ISBN and overwrite fields only if they have meaningful data
@@ -414,12 +3464,16 @@ def edit_book(id):
             isbn = str(request.form.get("isbn", "")).strip()
             if not check_isbn(isbn):
                 flash("Invalid ISBN. Please enter a valid 10 or 13-digit ISBN.", "danger")
-                return redirect(url_for("edit_book", id=book.id))
+                return redirect(url_for("library.edit_book", id=book.id))
+            existing_book = Book.query.filter(Book.isbn13 == normalize_isbn(isbn), Book.id != book.id).first()
+            if existing_book:
+                flash("A book with this ISBN already exists.", "danger")
+                return redirect(url_for("library.detail", id=existing_book.id))
 
             book_data = fetch_book_details(isbn)
             if not book_data:
                 flash("Book not found. Please enter details manually.", "warning")
-                return redirect(url_for("edit_book", id=book.id))
+                return redirect(url_for("library.edit_book", id=book.id))
 
             # Set ISBN, in case it was missing in the DB
             book.isbn = isbn
@@ -439,10 +3493,11 @@ def edit_book(id):
         elif "submit_book" in request.form:
             # Ensure ISBN is unique (excluding the current book)
             isbn = str(request.form.get("isbn", "")).strip()
-            existing_book = Book.query.filter(Book.isbn == isbn, Book.id != book.id).first()
+            isbn13 = normalize_isbn(isbn)
+            existing_book = Book.query.filter(Book.isbn13 == isbn13, Book.id != book.id).first() if isbn13 else None
             if existing_book:
                 flash("A book with this ISBN already exists.", "danger")
-                return redirect(url_for("detail", id=existing_book.id))
+                return redirect(url_for("library.detail", id=existing_book.id))
 
             # Save previous state for logging
             old_data = book.__dict__.copy()
@@ -463,10 +3518,8 @@ def edit_book(id):
 
             # for logging location changes
             old_location_id = book.location
-            old_location = Location.query.get(old_location_id)
-            old_location_label = f"{old_location.label_name}, {old_location.full_name}" if old_location else "Unknown"
-            new_location = Location.query.get(location_id)
-            new_location_label = f"{new_location.label_name}, {new_location.full_name}" if new_location else "Unknown"
+            old_location_label = format_location_label(location_registry.get(old_location_id))
+            new_location_label = format_location_label(location_registry.get(location_id))
 
             book.location = location_id
             db.session.commit()
@@ -484,6 +3537,7 @@ def edit_book(id):
             if old_location_id != location_id:
                 changes.append(f"Location: '{old_location_label}' (ID: {old_location_id}) → '{new_location_label}' (ID: {location_id})")
 
+            sync_book_facets([book])
             transaction = TransactionLog(
                 action="EDIT",
                 book_id=book.id,
@@ -494,12 +3548,12 @@ def edit_book(id):
             db.session.commit()
 
             flash("Book details updated successfully!", "success")
-            return redirect(url_for("detail", id=book.id))
+            return redirect(url_for("library.detail", id=book.id))
 
     return render_template("edit_book.html", book=book, locations=location_choices)
 
 
-@app.route("/delete_book/<int:id>", methods=["POST"])
+@bp.route("/delete_book/<int:id>", methods=["POST"])
 def delete_book(id):
     """Delete a book from the database."""
     auth_redirect = login_required()
@@ -509,66 +3563,51 @@ def delete_book(id):
     book = Book.query.get(id)
     if book is None:
         flash(f"Book with ID {id} does not exist.", "danger")
-        return redirect(url_for("index", page=1))
-
-    # Delete the associated file (if it exists)
-    if book.document_path and os.path.exists(book.document_path):
-        try:
-            os.remove(book.document_path)  # Delete the file
-        except Exception as e:
-            flash(f"Error deleting the document file: {str(e)}", "danger")
+        return redirect(url_for("library.index", page=1))
 
     # Log full book details before deleting
-    # Retrieve location details
-    location = Location.query.get(book.location)
-    location_label = f"{location.label_name}, {location.full_name}" if location else "Unknown"
     # Store all book details in JSON format
-    book_data = {
-        "isbn": book.isbn,
-        "title": book.title,
-        "authors": book.authors,
-        "publish_date": book.publish_date,
-        "subjects": book.subjects,
-        "pages": book.number_of_pages,
-        "openlibrary_preview_url": book.openlibrary_preview_url,
-        "thumbnail": book.openlibrary_medcover_url,
-        "location_id": book.location,
-        "location_label": location_label,
-        "document_path": book.document_path,
-    }
     transaction = TransactionLog(
         action="DELETE",
         book_id=book.id,
         book_title=f"{book.authors} - {book.title}",
-        details=json.dumps(book_data)  # Convert to JSON string
+        details=book_log_details(book, format_location_label(location_registry.get(book.location)))
     )
     db.session.add(transaction)
     db.session.commit()
 
+    drop_book_facets([book.id])
+    document_path = book.document_path
     db.session.delete(book)
     db.session.commit()
 
+    # Delete the associated file, unless another book has the same document
+    try:
+        release_document(document_path)
+    except OSError as e:
+        flash(f"Error deleting the document file: {str(e)}", "danger")
+
     flash("Book deleted successfully!", "success")
-    return redirect(url_for("index", page=1))
+    return redirect(url_for("library.index", page=1))
 
 
-@app.route("/restore_book/<int:log_id>", methods=["POST"])
+@bp.route("/restore_book/<int:log_id>", methods=["POST"])
 def restore_book(log_id):
     auth_redirect = login_required()
     if auth_redirect:
         return auth_redirect
 
     log_entry = TransactionLog.query.get(log_id)
-    if not log_entry or log_entry.action != "DELETE":
+    if not log_entry or log_entry.action not in ("DELETE", "MERGE"):
         flash("Invalid log entry for restoration.", "danger")
-        return redirect(url_for("view_logs"))
+        return redirect(url_for("library.view_logs"))
 
     # Load JSON data
     try:
         book_data = json.loads(log_entry.details)
     except json.JSONDecodeError:
         flash("Error decoding book data from log.", "danger")
-        return redirect(url_for("view_logs"))
+        return redirect(url_for("library.view_logs"))
 
     # Restore the book
     book = Book(
@@ -585,75 +3624,333 @@ def restore_book(log_id):
         lccn="", # not used
         olid="", # not used
     )
+    existing_book = Book.query.filter_by(isbn13=book.isbn13).first() if book.isbn13 else None
+    if existing_book:
+        flash(f"A book with ISBN {book.isbn} already exists; it was not restored.", "danger")
+        return redirect(url_for("library.detail", id=existing_book.id))
+    # The document is still there if another book shares it
+    document_path = book_data.get("document_path")
+    if document_path and os.path.exists(document_file(document_path)):
+        book.document_path = document_path
 
     db.session.add(book)
     db.session.commit()
 
+    sync_book_facets([book])
     transaction = TransactionLog(
         action="RESTORE",
         book_id=book.id,
         book_title=f"{book.authors} - {book.title}",
-        details=f"Restored from a DELETE ({log_entry.timestamp})"
+        details=f"Restored from a {log_entry.action} ({log_entry.timestamp})"
         )
     db.session.add(transaction)
     db.session.commit()
 
     flash(f"Book '{book.title}' has been restored!", "success")
-    # return redirect(url_for("detail", id=book.id))
-    return redirect(url_for("view_logs"))
+    # return redirect(url_for("library.detail", id=book.id))
+    return redirect(url_for("library.view_logs"))
+
+
+@bp.route("/duplicates", methods=["GET", "POST"])
+def duplicates():
+    """Probable duplicate books (see find_duplicates), to merge."""
+    auth_redirect = login_required()
+    if auth_redirect:
+        return auth_redirect
+
+    threshold = request.args.get("threshold", DEDUP_THRESHOLD, type=float)
+    if request.method == "POST":
+        keep = db.session.get(Book, request.form.get("keep", 0, type=int))
+        merge_ids = [book_id for book_id in request.form.getlist("merge", type=int) if not keep or book_id != keep.id]
+        books = Book.query.filter(Book.id.in_(merge_ids)).all()
+        if keep is None or not books:
+            flash("Select the book to keep and the duplicates to merge into it.", "danger")
+        else:
+            merge_books(keep, books)
+            flash(f"Merged {len(books)} books into '{keep.title}'.", "success")
+        return redirect(url_for("library.duplicates", threshold=threshold))
+
+    clusters = find_duplicates(threshold)
+    shown = clusters[:DUPLICATES_PER_PAGE]
+    ids = [book_id for cluster in shown for book_id, _, _ in cluster]
+    books = {book.id: book for book in Book.query.filter(Book.id.in_(ids))} if ids else {}
+    return render_template(
+        "duplicates.html",
+        clusters=[[(books[book_id], similarity, matched_id) for book_id, similarity, matched_id in cluster]
+                  for cluster in shown],
+        total=len(clusters),
+        threshold=threshold,
+        locations={location.id: format_location_label(location) for location in location_registry.all()},
+    )
 
 
-@app.route("/download_document/<int:id>")
+@bp.route("/download_document/<int:id>")
 def download_document(id):
     book = Book.query.get(id)
     if not book or not book.document_path:
         flash("Document not found.", "danger")
-        return redirect(url_for("index", page=1))
+        return redirect(url_for("library.index", page=1))
+
+    path = document_file(book.document_path)
+    if not os.path.exists(path):
+        flash("Document not found.", "danger")
+        return redirect(url_for("library.detail", id=book.id))
+
+    # Conditional and Range requests are answered from the file, so large
+    # downloads can resume. A stored file never changes: its hash is the ETag
+    etag = True if os.path.isabs(book.document_path) else os.path.basename(path).split(".")[0]
+    download_name = f"{secure_filename(book.title or '') or 'document'}.pdf"
+    return send_file(path, mimetype="application/pdf", download_name=download_name,
+                     conditional=True, etag=etag)
+
+EXPORT_MIMETYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+@bp.route("/cover/<int:id>")
+def cover(id):
+    """The book's cover from the local store, as ?size=thumb|detail|original."""
+    size = request.args.get("size", "detail")
+    if size not in COVER_SIZES and size != "original":
+        abort(404)
+    book = db.session.get(Book, id)
+    name = fetch_cover(book.openlibrary_medcover_url) if book else None
+    if not name:
+        return redirect(asset_url(COVER_PLACEHOLDER))
+    fmt = "webp" if "webp" in cover_formats() and "image/webp" in request.headers.get("Accept", "") else "jpeg"
+    path, mimetype = cover_variant(name, size, fmt)
+    # The file name is the content hash (plus size and format): a strong ETag
+    response = send_file(path, mimetype=mimetype, etag=os.path.basename(path),
+                         max_age=COVER_MAX_AGE, conditional=True)
+    response.vary.add("Accept")
+    return response
+
+@bp.app_template_global()
+def cover_url(book, size="detail"):
+    """URL of the book's cover. `v` changes with the thumbnail URL, so cached covers are replaced after an edit."""
+    version = hashlib.sha256(book.openlibrary_medcover_url.encode()).hexdigest()[:8]
+    return url_for("library.cover", id=book.id, size=size, v=version)
+
+@bp.route("/export/<any(books, logs):what>.<any(csv, jsonl):fmt>")
+def export(what, fmt):
+    """Stream the catalogue or the transaction log as CSV / JSON Lines.
+
+    ?gzip=1 compresses the download and ?since=<ISO date> limits the log to newer entries.
+    """
+    since = parse_since(request.args.get("since"))
+    if request.args.get("since") and since is None:
+        abort(400, "since must be an ISO date, e.g. 2025-01-31")
+    query = export_books_query() if what == "books" else export_logs_query(since)
+    compress = request.args.get("gzip", type=int) == 1
+    filename = f"{what}.{fmt}" + (".gz" if compress else "")
+    return Response(
+        stream_with_context(iter_encoded(iter_export(query, fmt), compress)),
+        mimetype="application/gzip" if compress else EXPORT_MIMETYPES[fmt],
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
 
-    return send_from_directory(app.config['UPLOAD_FOLDER'], os.path.basename(book.document_path))
 
-@app.route("/logs")
+@bp.route("/export/catalogue.sqlite")
+def export_snapshot():
+    """Download a consistent copy of the whole database."""
+    auth_redirect = login_required()
+    if auth_redirect:
+        return auth_redirect
+
+    tmp = tempfile.NamedTemporaryFile(suffix=".sqlite", delete=False)
+    tmp.close()
+    snapshot_database(tmp.name)
+    # Stream from an unlinked file, so nothing is left behind if the client disconnects
+    f = open(tmp.name, "rb")
+    os.remove(tmp.name)
+    size = os.fstat(f.fileno()).st_size
+
+    def chunks():
+        with f:
+            while data := f.read(256 * 1024):
+                yield data
+
+    return Response(chunks(), mimetype="application/vnd.sqlite3", headers={
+        "Content-Disposition": "attachment; filename=catalogue.sqlite",
+        "Content-Length": str(size),
+    })
+
+
+@bp.route("/facets/<any(authors, subjects, locations):facet>")
+def facets(facet):
+    """Book counts per author / subject / location as JSON, for the books matching the
+    optional author, subject and location filters. ?q= limits the names to a prefix.
+    """
+    filters = {
+        "author": request.args.get("author"),
+        "subject": request.args.get("subject"),
+        "location": request.args.get("location", type=int),
+    }
+    limit = min(request.args.get("limit", 50, type=int), 1000)
+    counts = facet_counts(facet, filters, prefix=request.args.get("q"), limit=limit)
+    return {facet: [{"id": id, "name": name, "count": count} for id, name, count in counts]}
+
+
+# Columns of the /api/v1/search rows
+SEARCH_API_FIELDS = ["id", "title", "authors", "location", "isbn"]
+
+@bp.route("/api/v1/search")
+@cached_page
+def api_search():
+    """One cursor page of search results as compact JSON, for the instant search.
+
+    Takes the arguments of the index (q instead of s): q, similarity, sort_by,
+    sort_order, per_page, cursor and the author/subject/location filters. Rows are lists
+    of SEARCH_API_FIELDS, the location being a key of `locations` (id: label).
+    `next`/`prev` are the cursors of the adjacent pages.
+    """
+    s = request.args.get("q", "").strip() or None
+    per_page = request_per_page()
+    sort_order = request.args.get("sort_order", "asc")
+    filters = request_filters()
+
+    similarity = request_similarity()
+
+    init_sort_indexes()
+    query, fts_hits = book_search_query(s, filters, similarity)
+    sort_by, sort_key = book_sort_key(request.args.get("sort_by") or ("relevance" if s else "title"), fts_hits)
+    match = fts_match_query(s) if s else ""
+    total = cached_count(("index", match or s, similarity, tuple(sorted(filters.items()))), query)
+    query = query.with_entities(Book.id, Book.title, Book.authors, Book.location, Book.isbn,
+                                Location.label_name, Location.full_name)
+    books = keyset_paginate(query, sort_key, Book.id, descending=sort_order != "asc",
+                            cursor=request.args.get("cursor"), per_page=per_page, total=total)
+    snippets = document_snippets(match, [row[0] for row in books.items])
+    payload = {
+        "fields": SEARCH_API_FIELDS,
+        "books": [list(row[:5]) for row in books.items],
+        # Text around the match in a book's document, marked with \x02 ... \x03
+        "snippets": {row[0]: snippets[row[0]] for row in books.items if row[0] in snippets},
+        # Few locations, many books: the labels are sent once
+        "locations": {row[3]: f"{row[5]}, {row[6]}" for row in books.items},
+        "prev": books.prev_cursor,
+        "next": books.next_cursor,
+        "total": books.total,
+        "sort_by": sort_by,
+        "sort_order": sort_order,
+    }
+    return Response(json.dumps(payload, separators=(",", ":"), ensure_ascii=False), mimetype="application/json")
+
+
+@bp.route("/api/suggest")
+def api_suggest():
+    """Completions of ?q= for the search box, as JSON.
+
+    Returns {"fields": SUGGEST_FIELDS, "suggestions": [[kind, text, books]]}:
+    up to ?limit= (default SUGGEST_LIMIT) titles, authors and subjects with
+    a word starting with q, the ones of most books first.
+    """
+    limit = max(1, min(request.args.get("limit", SUGGEST_LIMIT, type=int), MAX_SUGGEST_LIMIT))
+    payload = {"fields": SUGGEST_FIELDS, "suggestions": suggest_index.suggest(request.args.get("q", ""), limit)}
+    return Response(json.dumps(payload, separators=(",", ":"), ensure_ascii=False), mimetype="application/json")
+
+
+@bp.route("/metrics")
+def metrics():
+    """Request, query and outbound HTTP metrics in the Prometheus text format.
+
+    Each gunicorn worker keeps its own numbers (and answers for itself only).
+    """
+    if not METRICS_ENABLED:
+        abort(404)
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        abort(401)
+    lines = [line for metric in METRICS for line in metric.render()]
+    lines += ["# HELP library_response_cache_requests_total Page cache lookups of this worker.",
+              "# TYPE library_response_cache_requests_total counter",
+              f'library_response_cache_requests_total{{result="hit"}} {response_cache.hits}',
+              f'library_response_cache_requests_total{{result="miss"}} {response_cache.misses}',
+              "# HELP library_metadata_cache_requests_total ISBN metadata cache lookups (all workers).",
+              "# TYPE library_metadata_cache_requests_total counter"]
+    for source, counters in sorted(metadata_cache.stats().items()):
+        for result, key in (("hit", "hits"), ("miss", "misses")):
+            lines.append(f'library_metadata_cache_requests_total{{source="{source}",result="{result}"}} {counters[key]}')
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+@bp.route("/logs")
 def view_logs():
-    logs = TransactionLog.query.order_by(TransactionLog.timestamp.desc()).all()
+    """Newest first, paged with a (timestamp, id) cursor so old pages are as cheap as the first."""
+    query = TransactionLog.query
+    logs = keyset_paginate(
+        query,
+        # Compare the stored timestamp text as-is. A bound datetime would be
+        # rendered with microseconds and no longer equal the stored value.
+        db.type_coerce(TransactionLog.timestamp, db.String),
+        TransactionLog.id,
+        descending=True,
+        cursor=request.args.get("cursor"),
+        per_page=LOGS_PER_PAGE,
+        total=cached_count(("logs",), query),
+    )
     return render_template("logs.html", logs=logs)
 
 
-@app.route("/detail/<int:id>", methods=["GET", "POST"])
+@bp.route("/detail/<int:id>", methods=["GET", "POST"])
+@cached_page
 def detail(id=1):
     """Show an individual work"""
 
     book = Book.query.get(id)
     if book is None:
         flash(f"Book with ID {id} does not exist.", "danger")
-        return redirect(url_for("index", page=1))
+        return redirect(url_for("library.index", page=1))
 
-    # Fetch available locations
-    locations = Location.query.order_by("label_name").all()
-
-    # Set the location to be displayed
-    location_display = None
-    if book.location:
-        location_display = next((l for l in locations if l.id == book.location), None)
+    location_display = location_registry.get(book.location) if book.location else None
 
     return render_template(
         "detail.html", book=book, location_display=location_display
     )
 
 
-@app.route("/index/", defaults={"page": 1})  # Default page to 1 if not provided
-@app.route("/index/<int:page>", methods=["GET", "POST"])
+def request_per_page():
+    """?per_page= of the request, clamped to 1..MAX_PER_PAGE."""
+    return max(1, min(request.args.get("per_page", PAGINATE_BY_HOWMANY, type=int), MAX_PER_PAGE))
+
+def request_similarity():
+    """?similarity= of the request (0..1), or None for the configured default."""
+    similarity = request.args.get("similarity", type=float)
+    return None if similarity is None else max(0.0, min(similarity, 1.0))
+
+def request_filters():
+    """Facet filters of the request: an author / subject name or a location id."""
+    return {key: value for key, value in (
+        ("author", request.args.get("author")),
+        ("subject", request.args.get("subject")),
+        ("location", request.args.get("location", type=int)),
+    ) if value}
+
+def book_sort_key(sort_by, fts_hits):
+    """(sort_by, sort expression). Relevance needs a search; unknown keys sort by title."""
+    if sort_by == "relevance" and fts_hits is not None:
+        return sort_by, fts_hits.c.rank
+    if sort_by not in BOOK_SORT_KEYS:
+        sort_by = "title"
+    return sort_by, BOOK_SORT_KEYS[sort_by]
+
+@bp.route("/index/", defaults={"page": 1})  # Default page to 1 if not provided
+@bp.route("/index/<int:page>", methods=["GET", "POST"])
+@cached_page
 def index(page=1):  # Default value for page is 1
     """Show an index of books, provide some basic searchability."""
 
     if request.method == "POST":
         s = request.form["search"]
-        return redirect(url_for("index", page=1, s=s))
+        return redirect(url_for("library.index", page=1, s=s))
 
     # Get the search term and number of items per page from the request
     s = request.args.get("s")
-    per_page = request.args.get("per_page", PAGINATE_BY_HOWMANY, type=int)
-    sort_by = request.args.get("sort_by", "title")  # Default sort by title
+    cursor = request.args.get("cursor")
+    keyset = cursor is not None or PAGINATION_MODE == "keyset"
+    per_page = request_per_page()
+    # Default sort by relevance when searching, else by title
+    sort_by = request.args.get("sort_by", "relevance" if s else "title")
     sort_order = request.args.get("sort_order", "asc")  # Default order is ascending
+    filters = request_filters()
+    similarity = request_similarity()
 
     # Set sorting direction (ascending or descending)
     if sort_order == "asc":
@@ -661,46 +3958,52 @@ def index(page=1):  # Default value for page is 1
     else:
         sort_direction = desc
 
-    # Create the query to select books
-    query = db.session.query(Book, Location).join(Location, Book.location == Location.id)
-    # Apply fuzzy filtering if a search term is provided
-    # Use ilike method instead of contains. The ilike method allows for pattern
-    # matching with wildcards, which can be used to create a more flexible,
-    # fuzzy search.
-    if s:
-        search_pattern = f"%{s}%"
-        query = query.filter(
-            or_(
-                Book.title.ilike(search_pattern),
-                Book.authors.ilike(search_pattern),
-                Book.subjects.ilike(search_pattern),
-                Book.isbn.ilike(search_pattern),
-            )
-        )
+    init_sort_indexes()
+    query, fts_hits = book_search_query(s, filters, similarity)
+    match = fts_match_query(s) if s else ""
 
     # Apply sorting based on the 'sort_by' and 'sort_order' parameters
-    query = query.order_by(sort_direction(getattr(Book, sort_by)))
-
-    # Execute the pagination
-    books = query.paginate(page=page, per_page=per_page, error_out=False)
+    sort_by, sort_key = book_sort_key(sort_by, fts_hits)
+
+    if keyset:
+        # Seek to the cursor; the total is only an (up to a minute old) estimate
+        total = cached_count(("index", match or s, similarity, tuple(sorted(filters.items()))), query)
+        books = keyset_paginate(query, sort_key, Book.id, descending=sort_order != "asc",
+                                cursor=cursor, per_page=per_page, total=total)
+        items = books.items
+        book_ids = [book.id for book, _ in items]
+    else:
+        query = query.order_by(sort_direction(sort_key), sort_direction(Book.id))
+        if per_page > STREAM_ABOVE:
+            # Large pages: the pagination of the book ids (read from the
+            # indexes) gives the counts and links, and the books are read
+            # while the page is sent
+            books = query.with_entities(Book.id).paginate(page=page, per_page=per_page, max_per_page=MAX_PER_PAGE,
+                                                          error_out=False)
+            items = stream_rows(query, (books.page - 1) * books.per_page, books.per_page)
+            book_ids = [book_id for (book_id,) in books.items]
+        else:
+            books = query.paginate(page=page, per_page=per_page, max_per_page=MAX_PER_PAGE, error_out=False)
+            items = books.items
+            book_ids = [book.id for book, _ in items]
+    render = stream_page if per_page > STREAM_ABOVE and not keyset else render_template
+    context = dict(books=books, items=items, s=s, similarity=similarity, sort_by=sort_by, sort_order=sort_order, per_page=per_page,
+                   filters=filters, max_per_page=MAX_PER_PAGE, snippets=document_snippets(match, book_ids))
 
     # Check if the request is an AJAX request
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        """Handle instant search requests.
+        """Return only the search results and pagination controls.
 
-        This route is used to handle AJAX requests for instant search. It
-        fetches the search results based on the query and returns the rendered
-        list_books.html template as HTML. This allows the client-side JavaScript
-        to dynamically update the search results without reloading the page. """
-
-        # Return only the search results and pagination controls
-        return render_template("list_books.html", books=books, s=s, sort_by=sort_by, sort_order=sort_order, per_page=per_page)
+        The rendered list_books.html fragment lets client-side JavaScript
+        update the results without reloading the page (the instant search
+        itself uses /api/v1/search). """
+        return render("list_books.html", **context)
     else:
         # Return the full page for non-AJAX requests
-        return render_template("index.html", books=books, s=s, sort_by=sort_by, sort_order=sort_order, per_page=per_page)
+        return render("index.html", **context)
 
 
-@app.route("/manage_locations", methods=["GET", "POST"])
+@bp.route("/manage_locations", methods=["GET", "POST"])
 def manage_locations():
     """View, add, edit, and delete locations."""
     auth_redirect = login_required()
@@ -774,38 +4077,78 @@ def manage_locations():
                 db.session.commit()
                 flash("Location deleted successfully!", "success")
 
-        return redirect(url_for("manage_locations"))
+        return redirect(url_for("library.manage_locations"))
 
-    # Fetch all locations to display
-    locations = Location.query.order_by(Location.label_name).all()
-    return render_template("manage_locations.html", locations=locations)
+    return render_template("manage_locations.html", locations=location_registry.all())
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         username = request.form["username"]
         password = request.form["password"]
 
-        if username == USER['username'] and password == USER['password']:
+        if username == current_app.config["LIBRARY_USERNAME"] and password == current_app.config["LIBRARY_PASSWORD"]:
             session["logged_in"] = True
             flash("Login successful!", "success")
-            return redirect(url_for("index", page=1))
+            return redirect(url_for("library.index", page=1))
         else:
             flash("Invalid username or password.", "danger")
 
     return render_template("login.html")
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     session.pop("logged_in", None)
     flash("You have been logged out.", "info")
-    return redirect(url_for("index", page=1))
+    return redirect(url_for("library.index", page=1))
+
+
+# Application factory
+def create_app(config=None):
+    """Build the app. Settings come from library.cfg; `config` overrides entries
+    of app.config (e.g. {"SQLALCHEMY_DATABASE_URI": ..., "TESTING": True}).
+
+    Nothing here opens a connection or starts a thread, so gunicorn can build
+    the app once in its master process and fork the workers from it (see
+    gunicorn.conf.py).
+    """
+    if not CONFIG_PATH:
+        raise RuntimeError(f"{CONFIG_FILE} not found in src or parent dir. Create it from 'LIBRARY.cfg_EXAMPLE'.")
+    app = Flask(__name__)
+    app.config['DEBUG'] = True
+    app.config['SECRET_KEY'] = CONFIG.get("secrets", "APP_SECRET_KEY")
+    app.config["LIBRARY_USERNAME"] = CONFIG.get("secrets", "USERNAME")
+    app.config["LIBRARY_PASSWORD"] = CONFIG.get("secrets", "PASSWORD")
+    app.config["SQLALCHEMY_DATABASE_URI"] = sqlite_db
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = ENGINE_OPTIONS
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
+    app.config.update(config or {})
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    db.init_app(app)
+    # `flask db` (Flask-Migrate) only when the app is built by a flask command,
+    # so web workers do not import Alembic
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db, include_object=include_in_migrations)
+    app.register_blueprint(bp)
+    app.view_functions["static"] = static_file
+
+    # Trust reverse proxy headers (Caddy)
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
+    # Mount under a URL prefix when set (e.g. /apps/dbkk)
+    app.wsgi_app = ScriptNameMiddleware(app.wsgi_app, os.environ.get("SCRIPT_NAME", ""))
+    if METRICS_ENABLED:
+        # Outermost, so the time spent in ProxyFix and the prefix handling counts too
+        app.wsgi_app = TimingMiddleware(app.wsgi_app, app.logger)
+    return app
 
 
 if __name__ == "__main__":
     # flask can execute arbitrary python if you do this.
     # app.run(host='0.0.0.0') # listens on all public IPs.
 
-    app.run()
+    create_app().run()
@@ -0,0 +1,100 @@
+"""Test setup shared by all tests.
+
+controller reads its config when it is imported, so a config for a new
+database in a temporary folder is written first. Its ISBN lookups go to a
+stub of Open Library and Google Books on a local port (see StubSources).
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+
+class StubSources(BaseHTTPRequestHandler):
+    """Open Library (/api/books) and Google Books (/books/v1/volumes) answers from the dicts below.
+
+    Every request is recorded in `requests` as (source, ISBN). ISBNs in
+    `failing` get a 503.
+    """
+    openlibrary = {}  # ISBN: the record under "ISBN:<isbn>"
+    googlebooks = {}  # ISBN: volumeInfo
+    failing = set()
+    requests = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/api/books":
+            source, isbn = "openlibrary", query["bibkeys"][0].removeprefix("ISBN:")
+            record = self.openlibrary.get(isbn)
+            data = {f"ISBN:{isbn}": record} if record else {}
+        elif url.path == "/books/v1/volumes":
+            source, isbn = "googlebooks", query["q"][0].removeprefix("isbn:")
+            info = self.googlebooks.get(isbn)
+            data = {"totalItems": 1, "items": [{"volumeInfo": info}]} if info else {"totalItems": 0}
+        else:
+            self.send_error(404)
+            return
+        self.requests.append((source, isbn))
+        if isbn in self.failing:
+            self.send_error(503)
+            return
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+STUB_SERVER = ThreadingHTTPServer(("127.0.0.1", 0), StubSources)
+threading.Thread(target=STUB_SERVER.serve_forever, daemon=True).start()
+STUB_URL = f"http://127.0.0.1:{STUB_SERVER.server_port}"
+
+TEST_DIR = tempfile.mkdtemp(prefix="library-test-")
+CONFIG = os.path.join(TEST_DIR, "library.cfg")
+with open(CONFIG, "w") as f:
+    f.write(f"""[secrets]
+USERNAME = test
+PASSWORD = test
+APP_SECRET_KEY = test
+
+[database]
+PATH = {os.path.join(TEST_DIR, "books.sqlite")}
+
+[metadata]
+OPENLIBRARY_URL = {STUB_URL}
+GOOGLE_BOOKS_URL = {STUB_URL}
+CACHE_PATH = {os.path.join(TEST_DIR, "metadata_cache.sqlite")}
+TIMEOUT_OPENLIBRARY = 5
+TIMEOUT_GOOGLEBOOKS = 5
+RETRIES = 0
+""")
+os.environ["LIBRARY_CONFIG"] = CONFIG
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def test_dir():
+    yield TEST_DIR
+    STUB_SERVER.shutdown()
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def stub_sources():
+    """The stub sources, emptied before each test."""
+    StubSources.openlibrary.clear()
+    StubSources.googlebooks.clear()
+    StubSources.failing.clear()
+    StubSources.requests.clear()
+    return StubSources
@@ -0,0 +1,118 @@
+"""ISBN lookups through the metadata cache, against the stub sources of conftest.py."""
+import pytest
+
+import controller
+
+TOTEM_POLE = "9780224035583"
+NOT_FOUND = "9780099438519"
+
+
+class Clock:
+    """Stands in for time.time, so entries can age."""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(controller.time, "time", clock)
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(stub_sources):
+    controller.metadata_cache.clear()
+
+
+@pytest.fixture
+def totem_pole(stub_sources):
+    # Without authors from Open Library a lookup waits for both sources, so no
+    # request of one test is still running in the next
+    stub_sources.openlibrary[TOTEM_POLE] = {"title": "The Totem Pole", "number_of_pages": 208}
+    stub_sources.googlebooks[TOTEM_POLE] = {"title": "The Totem Pole", "authors": ["Joe Simpson"]}
+    return TOTEM_POLE
+
+
+def test_second_lookup_is_a_hit(stub_sources, totem_pole):
+    first = controller.fetch_book_details(totem_pole)
+    assert first["title"] == "The Totem Pole"
+    assert first["authors"] == ["Joe Simpson"]
+    assert first["number_of_pages"] == 208
+    assert sorted(stub_sources.requests) == [("googlebooks", totem_pole), ("openlibrary", totem_pole)]
+
+    assert controller.fetch_book_details(totem_pole) == first
+    assert len(stub_sources.requests) == 2
+    stats = controller.metadata_cache.stats()
+    for source in controller.METADATA_SOURCES:
+        assert stats[source] == {"hits": 1, "misses": 1, "entries": 1, "negative": 0}
+
+
+def test_isbn10_is_looked_up_and_cached_as_isbn13(stub_sources):
+    stub_sources.openlibrary["9780306406157"] = {"title": "Sample"}
+    stub_sources.googlebooks["9780306406157"] = {"title": "Sample", "authors": ["A. Author"]}
+    assert controller.fetch_book_details("0-306-40615-2")["title"] == "Sample"
+    assert {isbn for _, isbn in stub_sources.requests} == {"9780306406157"}
+
+    hit, details = controller.metadata_cache.get("9780306406157", "openlibrary")
+    assert hit and details["title"] == "Sample"
+    stub_sources.requests.clear()
+    assert controller.fetch_book_details("9780306406157")["title"] == "Sample"
+    assert controller.fetch_book_details("0306406152")["title"] == "Sample"
+    assert stub_sources.requests == []
+
+
+def test_found_records_expire_after_their_ttl(stub_sources, totem_pole, clock):
+    controller.fetch_book_details(totem_pole)
+    clock.advance(controller.METADATA_CACHE_TTL["openlibrary"] - 1)
+    controller.fetch_book_details(totem_pole)
+    assert len(stub_sources.requests) == 2
+
+    clock.advance(2)
+    assert controller.fetch_book_details(totem_pole)["authors"] == ["Joe Simpson"]
+    assert len(stub_sources.requests) == 4
+
+
+def test_not_found_is_cached_for_the_negative_ttl(stub_sources, clock):
+    assert controller.fetch_book_details(NOT_FOUND) == {}
+    assert controller.fetch_book_details(NOT_FOUND) == {}
+    assert len(stub_sources.requests) == 2
+    stats = controller.metadata_cache.stats()
+    assert stats["openlibrary"]["negative"] == stats["googlebooks"]["negative"] == 1
+
+    clock.advance(controller.METADATA_CACHE_NEGATIVE_TTL + 1)
+    # Listed meanwhile
+    stub_sources.openlibrary[NOT_FOUND] = {"title": "Touching the Void"}
+    assert controller.fetch_book_details(NOT_FOUND)["title"] == "Touching the Void"
+
+
+def test_failed_requests_are_not_cached(stub_sources, totem_pole):
+    stub_sources.failing.add(totem_pole)
+    assert controller.fetch_book_details(totem_pole) == {}
+    assert controller.metadata_cache.stats()["openlibrary"]["misses"] == 1
+
+    stub_sources.failing.clear()
+    assert controller.fetch_book_details(totem_pole)["authors"] == ["Joe Simpson"]
+    assert len(stub_sources.requests) == 4
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = controller.MetadataCache(str(tmp_path / "cache.sqlite"), {"openlibrary": 3600}, 3600, max_entries=2)
+    for isbn13 in ["9780000000001", "9780000000002"]:
+        cache.put(isbn13, "openlibrary", {"title": isbn13})
+        clock.advance(1)
+    assert cache.get("9780000000001", "openlibrary") == (True, {"title": "9780000000001"})
+    clock.advance(1)
+
+    cache.put("9780000000003", "openlibrary", {})
+    assert cache.get("9780000000002", "openlibrary") == (False, None)
+    assert cache.get("9780000000001", "openlibrary") == (True, {"title": "9780000000001"})
+    assert cache.get("9780000000003", "openlibrary") == (True, {})
+    assert cache.stats()["openlibrary"]["entries"] == 2
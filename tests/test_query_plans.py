@@ -0,0 +1,41 @@
+"""The hot queries (see hot_queries in controller.py) must be answered from indexes.
+
+Runs the same check as `flask explain-queries` on a new, empty SQLite database
+created from the models (see conftest.py), so a dropped or unusable index fails
+the tests.
+"""
+import pytest
+
+import controller
+
+
+@pytest.fixture(scope="module")
+def plans():
+    """{query name: (plan lines, may_sort)} of the hot queries."""
+    app = controller.create_app({"TESTING": True})
+    with app.test_request_context():
+        controller.db.create_all()
+        controller.init_sort_indexes()
+        controller.init_search_index()
+        controller.init_trigram_index()
+        yield {name: (controller.query_plan(query), may_sort)
+               for name, (query, may_sort) in controller.hot_queries().items()}
+        controller.db.session.remove()
+        controller.db.engine.dispose()
+
+
+def test_hot_queries_use_indexes(plans):
+    failures = {name: plan for name, (plan, may_sort) in plans.items() if controller.bad_plan_lines(plan, may_sort)}
+    assert not failures, "\n".join(f"{name}: {plan}" for name, plan in failures.items())
+
+
+def test_isbn_lookup_searches_the_isbn13_index(plans):
+    plan, _ = plans["add_book: duplicate ISBN"]
+    assert any(line.startswith("SEARCH book USING") and "isbn13" in line for line in plan), plan
+
+
+@pytest.mark.parametrize("name", ["view_logs: first page", "index: sort by title asc", "index: sort by title, cursor page"])
+def test_pages_do_not_scan_or_sort(name, plans):
+    plan, _ = plans[name]
+    assert not any(line.startswith("SCAN book") and " USING " not in line for line in plan), plan
+    assert not any("TEMP B-TREE" in line for line in plan), plan